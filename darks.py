@@ -73,6 +73,12 @@ if __name__ == "__main__":
         type=int,
         default=0,
     )
+    argparser.add_argument(
+        '--npy',
+        '-n',
+        help='also store frames as numpy files which can be memory mapped',
+        action='store_true',
+    )
 
 
     args = argparser.parse_args()
@@ -83,6 +89,7 @@ if __name__ == "__main__":
     iad.temp_delta = args.temp_delta
     iad.time_delta = args.time_delta
     iad.bitmax = args.bitmax
+    iad.npy = args.npy
 
     action_func = getattr(iad, args.action)
     action_func()
@@ -0,0 +1,200 @@
+import time
+import logging
+
+import cv2
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyAduMeter(object):
+    # Measures the brightness for the exposure calculation from a decimated
+    # sample of the stacked data before debayering.  Each sample is a 2x2
+    # bayer block (or a single mono/rgb pixel) taken every "stride" pixels.
+    # The samples are passed through the same stretch table as the final
+    # image and mixed with the cv2 BGR2GRAY weights, so the result is on the
+    # same 8 bit scale as TARGET_ADU.
+    #
+    # The ADU_ROI and detection mask are defined on the final image, they are
+    # rotated and flipped back to the orientation of the raw data.
+
+    # cv2.COLOR_BGR2GRAY
+    gray_weights = {
+        'R' : 0.299,
+        'G' : 0.587,
+        'B' : 0.114,
+    }
+
+    __rotate_inverse_map = {
+        'ROTATE_90_CLOCKWISE'        : cv2.ROTATE_90_COUNTERCLOCKWISE,
+        'ROTATE_90_COUNTERCLOCKWISE' : cv2.ROTATE_90_CLOCKWISE,
+        'ROTATE_180'                 : cv2.ROTATE_180,
+    }
+
+
+    def __init__(self, config, bin_v, mask=None):
+        self.config = config
+        self.bin_v = bin_v
+
+        self.mode = self.config.get('ADU_METER_MODE', 'average')
+        self.stride = max(int(self.config.get('ADU_METER_STRIDE', 8)), 1)
+        self.percentile = float(self.config.get('ADU_METER_PERCENTILE', 50))
+
+        # both masks will be combined
+        self._external_mask = mask
+
+        # sample mask and weights, keyed by raw shape and stride
+        self._sample_key = None
+        self._sample_mask = None
+        self._sample_weights = None
+
+
+    def measure(self, data, image_bayerpat, stretch_func):
+        start = time.time()
+
+        if len(data.shape) == 2 and image_bayerpat:
+            # bayer blocks must start on an even pixel
+            stride = self.stride + (self.stride % 2)
+            sample_gray = self._sampleBayer(data, image_bayerpat, stride, stretch_func)
+        elif len(data.shape) == 2:
+            stride = self.stride
+            sample_gray = stretch_func(numpy.ascontiguousarray(data[::stride, ::stride])).astype(numpy.float32)
+        else:
+            stride = self.stride
+            sample_bgr = stretch_func(numpy.ascontiguousarray(data[::stride, ::stride]))
+            sample_gray = cv2.cvtColor(sample_bgr, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+
+
+        sample_mask, sample_weights = self._getSampleMask(data.shape[:2], stride, sample_gray.shape)
+
+        values = sample_gray[sample_mask]
+        if not values.size:
+            logger.error('ADU mask does not contain any samples')
+            return 0.0
+
+
+        if self.mode == 'percentile':
+            adu = float(numpy.percentile(values, self.percentile))
+        elif self.mode == 'center':
+            weights = sample_weights[sample_mask]
+            adu = float(numpy.sum(values * weights) / max(numpy.sum(weights), 1e-6))
+        else:
+            # average
+            adu = float(numpy.mean(values))
+
+
+        elapsed_s = time.time() - start
+        logger.info('ADU %0.2f (%s, %d samples) in %0.4f s', adu, self.mode, values.size, elapsed_s)
+
+        return adu
+
+
+    def _sampleBayer(self, data, image_bayerpat, stride, stretch_func):
+        image_height, image_width = data.shape[:2]
+
+        # only complete blocks
+        data = data[:image_height - (image_height % 2), :image_width - (image_width % 2)]
+
+        sample_gray = None
+        for idx, (y, x) in enumerate(((0, 0), (0, 1), (1, 0), (1, 1))):
+            color = image_bayerpat[idx]
+
+            # green is in the pattern twice
+            weight = self.gray_weights[color] / image_bayerpat.count(color)
+
+            plane = stretch_func(numpy.ascontiguousarray(data[y::stride, x::stride]))
+
+            if isinstance(sample_gray, type(None)):
+                sample_gray = plane * numpy.float32(weight)
+            else:
+                sample_gray += plane * numpy.float32(weight)
+
+
+        return sample_gray
+
+
+    def _getSampleMask(self, raw_shape, stride, sample_shape):
+        sample_key = (raw_shape, stride, sample_shape)
+        if sample_key == self._sample_key:
+            return self._sample_mask, self._sample_weights
+
+
+        raw_mask = self._generateAduMask(raw_shape)
+        sample_mask = raw_mask[::stride, ::stride][:sample_shape[0], :sample_shape[1]] > 0
+
+
+        # weight falls off linearly from the center to the edge of the image circle
+        image_height, image_width = raw_shape
+        y, x = numpy.mgrid[0:image_height:stride, 0:image_width:stride]
+        r = numpy.hypot(y - (image_height / 2), x - (image_width / 2))
+        sample_weights = numpy.clip(1.0 - (r / (min(image_height, image_width) / 2)), 0.0, 1.0).astype(numpy.float32)
+        sample_weights = sample_weights[:sample_shape[0], :sample_shape[1]]
+
+
+        self._sample_key = sample_key
+        self._sample_mask = sample_mask
+        self._sample_weights = sample_weights
+
+        return sample_mask, sample_weights
+
+
+    def _generateAduMask(self, raw_shape):
+        logger.info('Generating mask based on ADU_ROI')
+
+        # the mask is generated in the orientation of the final image
+        rotate = self.config.get('IMAGE_ROTATE')
+        if rotate in ('ROTATE_90_CLOCKWISE', 'ROTATE_90_COUNTERCLOCKWISE'):
+            image_width, image_height = raw_shape
+        else:
+            image_height, image_width = raw_shape
+
+
+        # create a black background
+        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+
+        adu_roi = self.config.get('ADU_ROI', [])
+
+        try:
+            x1 = int(adu_roi[0] / self.bin_v.value)
+            y1 = int(adu_roi[1] / self.bin_v.value)
+            x2 = int(adu_roi[2] / self.bin_v.value)
+            y2 = int(adu_roi[3] / self.bin_v.value)
+        except IndexError:
+            logger.warning('Using central ROI for ADU calculations')
+            x1 = int((image_width / 2) - (image_width / 3))
+            y1 = int((image_height / 2) - (image_height / 3))
+            x2 = int((image_width / 2) + (image_width / 3))
+            y2 = int((image_height / 2) + (image_height / 3))
+
+        # The white area is what we keep
+        cv2.rectangle(
+            img=mask,
+            pt1=(x1, y1),
+            pt2=(x2, y2),
+            color=(255),  # mono
+            thickness=cv2.FILLED,
+        )
+
+
+        if not isinstance(self._external_mask, type(None)):
+            if self._external_mask.shape[:2] == mask.shape[:2]:
+                # the detection mask replaces the ROI
+                mask = self._external_mask
+            else:
+                logger.error('Detection mask size does not match the image, using ADU_ROI')
+
+
+        # undo the flips and rotation of the final image
+        if self.config.get('IMAGE_FLIP_H'):
+            mask = cv2.flip(mask, 1)
+
+        if self.config.get('IMAGE_FLIP_V'):
+            mask = cv2.flip(mask, 0)
+
+        if rotate in self.__rotate_inverse_map:
+            mask = cv2.rotate(mask, self.__rotate_inverse_map[rotate])
+
+
+        return mask
@@ -34,6 +34,18 @@ from .image import ImageWorker
 from .video import VideoWorker
 from .uploader import FileUploader
 
+try:
+    # multiprocessing.shared_memory requires python 3.8
+    from .framering import IndiAllSkyFrameRing
+except ImportError:
+    IndiAllSkyFrameRing = None
+
+try:
+    # multiprocessing.shared_memory requires python 3.8
+    from .imagecache import IndiAllSkyImageCache
+except ImportError:
+    IndiAllSkyImageCache = None
+
 from .exceptions import TimeOutException
 from .exceptions import TemperatureException
 from .exceptions import CameraException
@@ -65,6 +77,11 @@ class IndiAllSky(object):
 
     periodic_reconfigure_offset = 300.0  # 5 minutes
 
+    # segments are only allocated when used
+    frame_ring_stages = 3  # process, persist and commit
+    frame_ring_spare_slots = 4  # frames waiting in the image queue
+    image_cache_slots = 4
+
 
     def __init__(self, f_config_file):
         self.config = self._parseConfig(f_config_file.read())
@@ -111,6 +128,22 @@ class IndiAllSky(object):
         self.upload_worker = None
         self.upload_worker_idx = 0
 
+        if self.config.get('IMAGE_FRAME_RING', True) and not IndiAllSkyFrameRing:
+            logger.warning('Shared memory frame ring requires python 3.8, using temporary files')
+            self.frame_ring = None
+        elif self.config.get('IMAGE_FRAME_RING', True):
+            self.frame_ring = IndiAllSkyFrameRing(self._frameRingSlots(), 'indi_allsky_{0:d}'.format(os.getpid()))
+        else:
+            self.frame_ring = None
+
+        if self.config.get('IMAGE_CACHE', True) and not IndiAllSkyImageCache:
+            logger.warning('Shared memory image cache requires python 3.8, uploads are read from disk')
+            self.image_cache = None
+        elif self.config.get('IMAGE_CACHE', True):
+            self.image_cache = IndiAllSkyImageCache(self.image_cache_slots, 'indi_allsky_cache_{0:d}'.format(os.getpid()))
+        else:
+            self.image_cache = None
+
         self.periodic_reconfigure_time = time.time() + self.periodic_reconfigure_offset
 
         self._miscDb = miscDb(self.config)
@@ -167,6 +200,10 @@ class IndiAllSky(object):
             self.longitude_v.value = float(self.config['LOCATION_LONGITUDE'])
 
 
+        if self.frame_ring and self._frameRingSlots() > self.frame_ring.slots:
+            logger.warning('Frame ring has %d slots, restart to increase to %d slots', self.frame_ring.slots, self._frameRingSlots())
+
+
         # reconfigure if needed
         self.reconfigureCcd()
 
@@ -296,6 +333,17 @@ class IndiAllSky(object):
             pid_f.flush()
 
 
+    def _frameRingSlots(self):
+        # stacked frames keep their slots until they leave the stack
+        stack_count = int(self.config.get('IMAGE_STACK_COUNT', 1))
+        queue_depth = int(self.config.get('IMAGE_PIPELINE_DEPTH', 2))
+
+        # each stage holds one frame and has a queue in front of it
+        pipeline_slots = (queue_depth + 1) * self.frame_ring_stages
+
+        return stack_count + pipeline_slots + self.frame_ring_spare_slots
+
+
     def _parseConfig(self, json_config):
         c = json.loads(json_config, object_pairs_hook=OrderedDict)
 
@@ -381,6 +429,9 @@ class IndiAllSky(object):
             self.bin_v,
         )
 
+        # frames are handed to the image worker via shared memory
+        self.indiclient.frame_ring = self.frame_ring
+
         # set indi server localhost and port
         self.indiclient.setServer(self.config['INDI_SERVER'], self.config['INDI_PORT'])
 
@@ -619,6 +670,10 @@ class IndiAllSky(object):
 
         self.image_worker_idx += 1
 
+        if self.frame_ring:
+            # free frame slots held by the previous worker
+            self.frame_ring.reset()
+
         logger.info('Starting ImageWorker process')
         self.image_worker = ImageWorker(
             self.image_worker_idx,
@@ -636,6 +691,8 @@ class IndiAllSky(object):
             self.sensortemp_v,
             self.night_v,
             self.moonmode_v,
+            frame_ring=self.frame_ring,
+            image_cache=self.image_cache,
         )
         self.image_worker.start()
 
@@ -726,6 +783,7 @@ class IndiAllSky(object):
             self.config,
             self.upload_error_q,
             self.upload_q,
+            image_cache=self.image_cache,
         )
 
         self.upload_worker.start()
@@ -886,6 +944,12 @@ class IndiAllSky(object):
 
                     self.indiclient.disconnectServer()
 
+                    if self.frame_ring:
+                        self.frame_ring.close()
+
+                    if self.image_cache:
+                        self.image_cache.close()
+
                     sys.exit()
 
 
@@ -948,6 +1012,12 @@ class IndiAllSky(object):
 
                     self.indiclient.disconnectServer()
 
+                    if self.frame_ring:
+                        self.frame_ring.close()
+
+                    if self.image_cache:
+                        self.image_cache.close()
+
                     sys.exit()
 
 
@@ -64,6 +64,8 @@ class FakeIndiClient(object):
 
         self._filename_t = 'ccd{0:d}_{1:s}.{2:s}'
 
+        self._frame_ring = None
+
         self._timeout = 65.0
         self._exposure = 0.0
 
@@ -124,6 +126,16 @@ class FakeIndiClient(object):
     def filename_t(self, new_filename_t):
         self._filename_t = new_filename_t
 
+    @property
+    def frame_ring(self):
+        # fake clients do not receive FITS blobs, frames are handed off as files
+        return self._frame_ring
+
+    @frame_ring.setter
+    def frame_ring(self, new_frame_ring):
+        self._frame_ring = new_frame_ring
+
+
 
     def setServer(self, *args, **kwargs):
         # does nothing
@@ -127,6 +127,8 @@ class IndiClient(PyIndi.BaseClient):
 
         self._filename_t = 'ccd{0:d}_{1:s}.{2:s}'
 
+        self._frame_ring = None
+
         self._timeout = 10.0
         self._exposure = 0.0
 
@@ -193,6 +195,14 @@ class IndiClient(PyIndi.BaseClient):
     def filename_t(self, new_filename_t):
         self._filename_t = new_filename_t
 
+    @property
+    def frame_ring(self):
+        return self._frame_ring
+
+    @frame_ring.setter
+    def frame_ring(self, new_frame_ring):
+        self._frame_ring = new_frame_ring
+
 
     def newDevice(self, d):
         logger.info("new device %s", d.getDeviceName())
@@ -221,17 +231,33 @@ class IndiClient(PyIndi.BaseClient):
         blobfile = io.BytesIO(imgdata)
         hdulist = fits.open(blobfile)
 
-        try:
-            f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
-            f_tmpfile_p = Path(f_tmpfile.name)
 
-            hdulist.writeto(f_tmpfile)
+        frame_slot = None
+        if self._frame_ring:
+            # hand off the pixel data via shared memory, the header is passed as metadata
+            frame_data = hdulist[0].data  # data must be accessed before the header is serialized
+            frame_meta = {
+                'header' : hdulist[0].header.tostring(),
+            }
 
-            f_tmpfile.flush()
-            f_tmpfile.close()
-        except OSError as e:
-            logger.error('OSError: %s', str(e))
-            return
+            frame_slot = self._frame_ring.put(frame_data, frame_meta)
+
+
+        if isinstance(frame_slot, type(None)):
+            # fallback to temp file
+            try:
+                f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+                f_tmpfile_p = Path(f_tmpfile.name)
+
+                hdulist.writeto(f_tmpfile)
+
+                f_tmpfile.flush()
+                f_tmpfile.close()
+            except OSError as e:
+                logger.error('OSError: %s', str(e))
+                return
+        else:
+            f_tmpfile_p = None
 
 
         #elapsed_s = time.time() - start
@@ -241,7 +267,6 @@ class IndiClient(PyIndi.BaseClient):
 
         ### process data in worker
         jobdata = {
-            'filename'    : str(f_tmpfile_p),
             'exposure'    : self._exposure,
             'exp_time'    : datetime.timestamp(exp_date),  # datetime objects are not json serializable
             'exp_elapsed' : exposure_elapsed_s,
@@ -249,6 +274,11 @@ class IndiClient(PyIndi.BaseClient):
             'filename_t'  : self._filename_t,
         }
 
+        if isinstance(frame_slot, type(None)):
+            jobdata['filename'] = str(f_tmpfile_p)
+        else:
+            jobdata['frame_slot'] = frame_slot
+
         ### Not using DB task queue to reduce DB I/O
         #with app.app_context():
         #    task = IndiAllSkyDbTaskQueueTable(
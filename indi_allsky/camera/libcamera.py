@@ -216,6 +216,8 @@ class IndiClientLibCameraGeneric(IndiClient):
 
         exp_date = datetime.now()
 
+        # libcamera-still writes the frame to a file, decoding it here would
+        # stall the main loop, so the frame ring is not used
         ### process data in worker
         jobdata = {
             'filename'    : str(self.current_exposure_file_p),
@@ -0,0 +1,151 @@
+import time
+import logging
+
+import cv2
+import numpy
+
+from .scnr import IndiAllskyScnr
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyColorBalance(object):
+    # SCNR, manual and auto white balance implemented with lookup tables.
+    # Each white balance step is a per channel function of the pixel value,
+    # so the steps are applied to a ramp of all possible values and composed
+    # into a single table per channel.  The tables are applied to the frame
+    # in one pass.
+    #
+    # The output is identical to the original chain except for the auto
+    # white balance channel means.  The means are calculated from histograms
+    # instead of cv2.mean(), the difference is limited to floating point
+    # rounding and may change a pixel by at most 1.
+
+    def __init__(self, config):
+        self.config = config
+
+        self._scnr = IndiAllskyScnr(self.config)
+
+        # manual white balance table, keyed by factors
+        self._manual_wb_key = None
+        self._manual_wb_lut = None
+
+        self._ramp = numpy.arange(256, dtype=numpy.uint8)
+
+
+    def balance(self, data, scnr_algo=None, auto_wb=False):
+        if len(data.shape) == 2:
+            # mono
+            return data
+
+
+        manual_lut_list = self._manualWbLut()
+
+        if not scnr_algo and not auto_wb and isinstance(manual_lut_list, type(None)):
+            # nothing to do
+            return data
+
+
+        start = time.time()
+
+        if isinstance(manual_lut_list, type(None)):
+            lut_list = [self._ramp, self._ramp, self._ramp]
+        else:
+            lut_list = list(manual_lut_list)
+
+
+        if scnr_algo:
+            b, g, r = cv2.split(data)
+
+            try:
+                g = self._scnr.neutral_green(scnr_algo, b, g, r)
+            except AttributeError:
+                logger.error('Unknown SCNR algorithm: %s', scnr_algo)
+
+            plane_list = [b, g, r]
+        else:
+            plane_list = None
+
+
+        if auto_wb:
+            lut_list = self._autoWbLut(data, plane_list, lut_list)
+        elif isinstance(manual_lut_list, type(None)):
+            # only SCNR
+            balanced_data = cv2.merge(plane_list)
+
+            elapsed_s = time.time() - start
+            logger.info('Color balance in %0.4f s', elapsed_s)
+
+            return balanced_data
+
+
+        if isinstance(plane_list, type(None)):
+            lut = numpy.dstack(lut_list)  # 1 x 256 x 3
+            balanced_data = cv2.LUT(data, lut)
+        else:
+            balanced_data = cv2.merge([cv2.LUT(p, l) for p, l in zip(plane_list, lut_list)])
+
+
+        elapsed_s = time.time() - start
+        logger.info('Color balance in %0.4f s', elapsed_s)
+
+        return balanced_data
+
+
+    def _manualWbLut(self):
+        for key in ('WBB_FACTOR', 'WBG_FACTOR', 'WBR_FACTOR'):
+            if not self.config.get(key):
+                logger.error('Missing %s setting', key)
+                return None
+
+
+        wb_key = (
+            float(self.config['WBB_FACTOR']),
+            float(self.config['WBG_FACTOR']),
+            float(self.config['WBR_FACTOR']),
+        )
+
+        if wb_key == (1.0, 1.0, 1.0):
+            return None
+
+        if wb_key == self._manual_wb_key:
+            return self._manual_wb_lut
+
+
+        logger.info('Applying manual color balance settings')
+
+        # identical to cv2.multiply() on each channel
+        self._manual_wb_lut = [cv2.multiply(self._ramp, factor).reshape(-1) for factor in wb_key]
+        self._manual_wb_key = wb_key
+
+        return self._manual_wb_lut
+
+
+    def _autoWbLut(self, data, plane_list, lut_list):
+        avg_list = list()
+        for c in range(3):
+            if isinstance(plane_list, type(None)):
+                hist = cv2.calcHist([data], [c], None, [256], [0, 256])
+            else:
+                hist = cv2.calcHist([plane_list[c]], [0], None, [256], [0, 256])
+
+            # channel mean after the manual white balance
+            hist = hist.reshape(-1).astype(numpy.float64)
+            avg_list.append(float(numpy.dot(hist, lut_list[c])) / hist.sum())
+
+
+        # Find the gain of each channel
+        k = sum(avg_list) / 3
+
+        gain_list = list()
+        for avg in avg_list:
+            try:
+                gain_list.append(k / avg)
+            except ZeroDivisionError:
+                gain_list.append(k / 0.1)
+
+
+        # identical to cv2.addWeighted() on each channel
+        return [cv2.addWeighted(src1=lut, alpha=gain, src2=0, beta=0, gamma=0).reshape(-1) for lut, gain in zip(lut_list, gain_list)]
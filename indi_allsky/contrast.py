@@ -0,0 +1,169 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyContrastEnhance(object):
+    # CLAHE contrast enhancement applied to the luminance of the image.
+    #
+    # The CLAHE objects are created once.  Luminance is taken from YCrCb by
+    # default, the conversion is cheaper than LAB and only the luminance
+    # plane is extracted and replaced instead of splitting and merging all
+    # channels.
+    #
+    # Large images may be split into horizontal bands that are processed in
+    # a thread pool.  Bands are aligned to the CLAHE tile rows and include
+    # one tile row above and below, the tile lookup tables and interpolation
+    # for the kept rows are the same as processing the whole image.  The
+    # interpolation weights are calculated from band relative coordinates,
+    # floating point rounding may change a few pixels by at most 1.
+
+    clip_limit = 3.0
+    tile_grid_size = (8, 8)  # columns, rows
+
+    band_min_pixels = 2 * 1024 * 1024  # smaller images are not split
+
+
+    __luminance_map = {
+        'ycrcb' : (cv2.COLOR_BGR2YCrCb, cv2.COLOR_YCrCb2BGR),
+        'lab'   : (cv2.COLOR_BGR2LAB, cv2.COLOR_LAB2BGR),
+    }
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._luminance = str(self.config.get('IMAGE_CLAHE_LUMINANCE', 'ycrcb')).lower()
+        if self._luminance not in self.__luminance_map:
+            logger.error('Unknown CLAHE luminance option: %s', self._luminance)
+            self._luminance = 'ycrcb'
+
+
+        # bands need at least 2 tile rows to be worth the overlap
+        self._bands = max(min(int(self.config.get('IMAGE_CLAHE_BANDS', 1)), self.tile_grid_size[1] // 2), 1)
+
+        # CLAHE objects keep internal buffers, one per band
+        self._clahe_list = [self._createClahe() for x in range(self._bands)]
+
+        self._pool = None  # created on first use
+
+
+    @property
+    def bands(self):
+        return self._bands
+
+    @bands.setter
+    def bands(self, *args):
+        pass  # read only
+
+
+    def _createClahe(self):
+        return cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
+
+
+    def apply(self, data):
+        start = time.time()
+
+        if len(data.shape) == 2:
+            # mono
+            enhanced_data = self._clahe(data)
+        else:
+            to_lum, from_lum = self.__luminance_map[self._luminance]
+
+            lum_data = cv2.cvtColor(data, to_lum)
+
+            l = cv2.extractChannel(lum_data, 0)
+            cv2.insertChannel(self._clahe(l), lum_data, 0)
+
+            enhanced_data = cv2.cvtColor(lum_data, from_lum)
+
+
+        elapsed_s = time.time() - start
+        logger.info('CLAHE in %0.4f s', elapsed_s)
+
+        return enhanced_data
+
+
+    def _clahe(self, data):
+        height, width = data.shape[:2]
+
+        if self._bands == 1 or height * width < self.band_min_pixels:
+            return self._clahe_list[0].apply(data)
+
+
+        tiles_x, tiles_y = self.tile_grid_size
+
+        # pad the same as cv2 so the bands divide evenly into tiles
+        if width % tiles_x == 0 and height % tiles_y == 0:
+            pad_x = 0
+            pad_y = 0
+        else:
+            pad_x = tiles_x - (width % tiles_x)
+            pad_y = tiles_y - (height % tiles_y)
+
+        if pad_x or pad_y:
+            data_ext = cv2.copyMakeBorder(data, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+        else:
+            data_ext = data
+
+        tile_height = data_ext.shape[0] // tiles_y
+
+
+        if not self._pool:
+            self._pool = ThreadPoolExecutor(max_workers=self._bands, thread_name_prefix='clahe')
+
+
+        enhanced_data = numpy.empty_like(data)  # bands are written in place
+
+        future_list = list()
+        for band in range(self._bands):
+            row_start = band * tiles_y // self._bands
+            row_end = (band + 1) * tiles_y // self._bands
+
+            # one tile row of overlap for the interpolation
+            ext_row_start = max(row_start - 1, 0)
+            ext_row_end = min(row_end + 1, tiles_y)
+
+            future = self._pool.submit(
+                self._clahe_band,
+                self._clahe_list[band],
+                data_ext,
+                enhanced_data,
+                row_start * tile_height,
+                min(row_end * tile_height, height),
+                ext_row_start * tile_height,
+                ext_row_end * tile_height,
+                (tiles_x, ext_row_end - ext_row_start),
+                width,
+            )
+            future_list.append(future)
+
+
+        for future in future_list:
+            future.result()
+
+        return enhanced_data
+
+
+    def _clahe_band(self, clahe, data_ext, enhanced_data, y1, y2, ext_y1, ext_y2, band_grid_size, width):
+        clahe.setTilesGridSize(band_grid_size)
+
+        band_data = clahe.apply(data_ext[ext_y1:ext_y2])
+
+        enhanced_data[y1:y2] = band_data[y1 - ext_y1:y2 - ext_y1, :width]
+
+
+    def shutdown(self):
+        if not self._pool:
+            return
+
+        self._pool.shutdown(wait=True)
+        self._pool = None
+
@@ -0,0 +1,144 @@
+import bisect
+import time
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyDarkLibrary(object):
+    # In memory index of the dark frame or bad pixel map table.  The matching
+    # rules are the same as the original SQL queries
+    #
+    #   exposure >= X, T <= temp <= T + range
+    #     order by exposure asc, temp asc, createDate asc
+    #
+    # with a fallback of
+    #
+    #   exposure >= X
+    #     order by exposure asc, temp desc, createDate asc
+
+    def __init__(self, table):
+        self._table = table
+
+        # (camera_id, bitdepth, gain, binmode) -> sorted exposure list, groups
+        self._index = dict()
+
+        self._count = 0
+
+
+    @property
+    def count(self):
+        return self._count
+
+    @count.setter
+    def count(self, *args):
+        pass  # read only
+
+
+    def load(self, query=None):
+        if isinstance(query, type(None)):
+            query = self._table.query
+
+        load_start = time.time()
+
+        entry_map = dict()
+        count = 0
+
+        for row in query:
+            if isinstance(row.exposure, type(None)):
+                continue
+
+            key = (row.camera_id, row.bitdepth, row.gain, row.binmode)
+
+            entry = {
+                'id'         : row.id,
+                'filename'   : row.filename,
+                'exposure'   : row.exposure,
+                'temp'       : row.temp,
+                'createDate' : row.createDate,
+            }
+
+            entry_map.setdefault(key, dict()).setdefault(row.exposure, list()).append(entry)
+            count += 1
+
+
+        index = dict()
+        for key, exposure_map in entry_map.items():
+            exposure_list = sorted(exposure_map.keys())
+
+            group_list = list()
+            for exposure in exposure_list:
+                group_list.append(self._buildGroup(exposure_map[exposure]))
+
+            index[key] = (exposure_list, group_list)
+
+
+        self._index = index
+        self._count = count
+
+        load_elapsed_s = time.time() - load_start
+        logger.info('Loaded %d %s entries in %0.4f s', count, self._table.__tablename__, load_elapsed_s)
+
+
+    def _buildGroup(self, entry_list):
+        # entries with a temperature, sorted by temp then date for bisect
+        temp_entries = sorted(
+            [e for e in entry_list if not isinstance(e['temp'], type(None))],
+            key=lambda e: (e['temp'], e['createDate']),
+        )
+
+        temp_list = [e['temp'] for e in temp_entries]
+
+
+        # fallback is the highest temperature, oldest entry
+        if temp_entries:
+            max_temp = temp_list[-1]
+            fallback = temp_entries[bisect.bisect_left(temp_list, max_temp)]
+        else:
+            # null temperatures sort last
+            fallback = sorted(entry_list, key=lambda e: e['createDate'])[0]
+
+
+        group = {
+            'temp_list'    : temp_list,
+            'temp_entries' : temp_entries,
+            'fallback'     : fallback,
+        }
+
+        return group
+
+
+    def find(self, camera_id, bitdepth, gain, binmode, exposure, temp, temp_range):
+        try:
+            exposure_list, group_list = self._index[(camera_id, bitdepth, gain, binmode)]
+        except KeyError:
+            return None
+
+
+        start = bisect.bisect_left(exposure_list, exposure)
+
+        for group in group_list[start:]:
+            idx = bisect.bisect_left(group['temp_list'], temp)
+            if idx == len(group['temp_list']):
+                continue
+
+            if group['temp_list'][idx] <= (temp + temp_range):
+                return group['temp_entries'][idx]
+
+        return None
+
+
+    def findFallback(self, camera_id, bitdepth, gain, binmode, exposure):
+        try:
+            exposure_list, group_list = self._index[(camera_id, bitdepth, gain, binmode)]
+        except KeyError:
+            return None
+
+
+        start = bisect.bisect_left(exposure_list, exposure)
+        if start == len(exposure_list):
+            return None
+
+        return group_list[start]['fallback']
@@ -60,6 +60,8 @@ class IndiAllSkyDarks(object):
         # this is used to set a max value of data returned by the camera
         self._bitmax = 0
 
+        self._npy = False
+
 
         self.image_q = Queue()
         self.indiclient = None
@@ -135,6 +137,15 @@ class IndiAllSkyDarks(object):
         self._hotpixel_adu_percent = int(new_hotpixel_adu_percent)
 
 
+    @property
+    def npy(self):
+        return self._npy
+
+    @npy.setter
+    def npy(self, new_npy):
+        self._npy = bool(new_npy)
+
+
 
     def _initialize(self):
         camera_interface = getattr(camera_module, self.config.get('CAMERA_INTERFACE', 'indi'))
@@ -614,6 +625,7 @@ class IndiAllSkyDarks(object):
         s = stacking_class(self.gain_v, self.bin_v)
         s.bitmax = self._bitmax
         s.hotpixel_adu_percent = self._hotpixel_adu_percent
+        s.npy = self._npy
 
         s.buildBadPixelMap(tmp_fit_dir_p, full_bpm_filename_p, exposure_f, image_bitpix)
         s.stack(tmp_fit_dir_p, full_dark_filename_p, exposure_f, image_bitpix)
@@ -659,6 +671,10 @@ class IndiAllSkyDarks(object):
                 logger.warning('Removing bad pixel map: %s', filename)
                 filename.unlink()
 
+            npy_filename = filename.with_suffix('.npy')
+            if npy_filename.exists():
+                npy_filename.unlink()
+
         for dark_frame_entry in dark_frames_all:
             filename = Path(dark_frame_entry.filename)
 
@@ -666,11 +682,17 @@ class IndiAllSkyDarks(object):
                 logger.warning('Removing dark frame: %s', filename)
                 filename.unlink()
 
+            npy_filename = filename.with_suffix('.npy')
+            if npy_filename.exists():
+                npy_filename.unlink()
+
 
         badpixelmaps_all.delete()
         dark_frames_all.delete()
         db.session.commit()
 
+        self._miscDb.updateCalibrationGeneration()
+
 
 
     def getSensorTemperature(self):
@@ -792,6 +814,8 @@ class IndiAllSkyDarksProcessor(object):
 
         self._bitmax = 0
 
+        self._npy = False
+
 
     @property
     def bitmax(self):
@@ -811,6 +835,26 @@ class IndiAllSkyDarksProcessor(object):
         self._hotpixel_adu_percent = int(new_hotpixel_adu_percent)
 
 
+    @property
+    def npy(self):
+        return self._npy
+
+    @npy.setter
+    def npy(self, new_npy):
+        self._npy = bool(new_npy)
+
+
+    def _writeNpy(self, filename_p, data):
+        if not self._npy:
+            return
+
+        # raw copy next to the fits file, ImageProcessor will memory map this file
+        npy_filename_p = Path(filename_p).with_suffix('.npy')
+
+        logger.info('Writing numpy data: %s', npy_filename_p)
+        numpy.save(str(npy_filename_p), numpy.ascontiguousarray(data))
+
+
 
     def buildBadPixelMap(self, tmp_fit_dir_p, filename_p, exposure, image_bitpix):
         logger.info('Building bad pixel map for exposure %0.1fs, gain %d, bin %d', exposure, self.gain_v.value, self.bin_v.value)
@@ -856,6 +900,8 @@ class IndiAllSkyDarksProcessor(object):
         # reuse the last fits file for the stacked data
         hdulist.writeto(filename_p)
 
+        self._writeNpy(filename_p, bpm)
+
 
     def stack(self, tmp_fit_dir_p, filename_p, exposure, image_bitpix):
         raise Exception('Must be redefined in sub-class')
@@ -896,6 +942,8 @@ class IndiAllSkyDarksAverage(IndiAllSkyDarksProcessor):
         # reuse the last fits file for the stacked data
         hdulist.writeto(filename_p)
 
+        self._writeNpy(filename_p, data)
+
 
 
 class IndiAllSkyDarksSigmaClip(IndiAllSkyDarksProcessor):
@@ -934,4 +982,6 @@ class IndiAllSkyDarksSigmaClip(IndiAllSkyDarksProcessor):
 
         combined_dark.write(filename_p)
 
+        self._writeNpy(filename_p, combined_dark.data.astype(numpy_type))
+
 
@@ -1,8 +1,11 @@
 import time
+from collections import deque
 import cv2
 import numpy
 import logging
 
+from .pyramid import IndiAllSkyImagePyramid
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -23,6 +26,21 @@ class IndiAllskyDetectLines(object):
 
     mask_blur_kernel_size = 75
 
+    # frame differencing, distances are in pixels of the pyramid level
+    difference_level = 1
+    difference_min_frames = 3  # background frames needed before detecting
+    difference_max_gap = 900  # seconds between frames before the history is reset
+    difference_sigma = 4.0  # threshold above the difference noise
+    difference_min_threshold = 6
+    difference_noise_sample_step = 4
+    difference_hough_threshold = 25
+    difference_min_line_length = 20
+    difference_max_line_gap = 5
+
+    # lines close to a line from the previous frames are static
+    static_angle = numpy.pi / 36  # 5 degrees
+    static_distance = 10  # level 0 pixels
+
 
     def __init__(self, config, bin_v, mask=None):
         self.config = config
@@ -31,8 +49,27 @@ class IndiAllskyDetectLines(object):
         self._sqm_mask = mask
         self._sqm_gradient_mask = None
 
+        self._method = str(self.config.get('DETECT_METEORS_METHOD', 'hough')).lower()
+        if self._method not in ('hough', 'difference'):
+            logger.error('Unknown meteor detection method: %s', self._method)
+            self._method = 'hough'
+
+        self._history = max(int(self.config.get('DETECT_METEORS_HISTORY', 5)), self.difference_min_frames)
+
+        self._background = None  # created on first use
+        self._difference_gradient_mask = None
+        self._line_history = deque(maxlen=self._history)
+        self._last_frame_time = 0
+
+
+    def detectLines(self, original_img, pyramid=None):
+        if self._method == 'difference':
+            return self.detectLinesDifference(original_img, pyramid=pyramid)
+
+        return self.detectLinesHough(original_img, pyramid=pyramid)
 
-    def detectLines(self, original_img):
+
+    def detectLinesHough(self, original_img, pyramid=None):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_img)
@@ -42,16 +79,14 @@ class IndiAllskyDetectLines(object):
             self._generateSqmGradientMask(original_img)
 
 
-        # apply the gradient to the image
-        masked_img = (original_img * self._sqm_gradient_mask).astype(numpy.uint8)
+        if isinstance(pyramid, type(None)):
+            pyramid = IndiAllSkyImagePyramid(original_img)
 
-        #cv2.imwrite('/tmp/masked.jpg', masked_img, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
+        # apply the gradient to the luminance
+        img_gray = (pyramid.level(0) * self._sqm_gradient_mask).astype(numpy.uint8)
 
-        if len(original_img.shape) == 2:
-            img_gray = masked_img
-        else:
-            img_gray = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+        #cv2.imwrite('/tmp/masked.jpg', img_gray, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
 
 
@@ -89,6 +124,168 @@ class IndiAllskyDetectLines(object):
         return lines
 
 
+    def detectLinesDifference(self, original_img, pyramid=None):
+        # Hough on the difference to a rolling median of the previous frames
+        if isinstance(self._sqm_mask, type(None)):
+            # This only needs to be done once if a mask is not provided
+            self._generateSqmMask(original_img)
+
+        if isinstance(self._sqm_gradient_mask, type(None)):
+            # This only needs to be done once
+            self._generateSqmGradientMask(original_img)
+
+
+        if isinstance(pyramid, type(None)):
+            pyramid = IndiAllSkyImagePyramid(original_img)
+
+
+        lines_start = time.time()
+
+        level_gray = pyramid.level(self.difference_level)
+
+        if isinstance(self._difference_gradient_mask, type(None)) or self._difference_gradient_mask.shape != level_gray.shape:
+            level_height, level_width = level_gray.shape[:2]
+            self._difference_gradient_mask = cv2.resize(self._sqm_gradient_mask, (level_width, level_height), interpolation=cv2.INTER_AREA)
+
+
+        img_gray = (level_gray * self._difference_gradient_mask).astype(numpy.uint8)
+
+
+        now = time.time()
+        if isinstance(self._background, type(None)) \
+                or self._background.shape not in (None, img_gray.shape) \
+                or now - self._last_frame_time > self.difference_max_gap:
+            logger.info('Resetting meteor detection background')
+            self._background = ImageRollingMedian(self._history)
+            self._line_history.clear()
+
+        self._last_frame_time = now
+
+
+        if self._background.count < self.difference_min_frames:
+            # not enough frames for a background
+            self._background.add(img_gray)
+
+            lines_elapsed_s = time.time() - lines_start
+            logger.info('Meteor background %d/%d frames in %0.4f s', self._background.count, self.difference_min_frames, lines_elapsed_s)
+            return list()
+
+
+        background = self._background.median
+
+        # only brighter than the background
+        diff = cv2.blur(cv2.subtract(img_gray, background), (3, 3))
+
+        # noise from a sample of the absolute difference, the subtraction is clipped at 0
+        step = self.difference_noise_sample_step
+        noise_sample = cv2.absdiff(img_gray[::step, ::step], background[::step, ::step])
+        noise_sample = noise_sample[self._difference_gradient_mask[::step, ::step] > 0.5]
+
+        if noise_sample.size:
+            # 3x3 blur reduces uncorrelated noise by 3
+            sigma = 1.4826 * float(numpy.median(noise_sample)) / 3
+        else:
+            sigma = 0.0
+
+        thold = max(self.difference_sigma * sigma, self.difference_min_threshold)
+
+        # update after differencing so the current frame is not in its own background
+        self._background.add(img_gray)
+
+
+        _, diff_mask = cv2.threshold(diff, thold, 255, cv2.THRESH_BINARY)
+
+        #cv2.imwrite('/tmp/difference.png', diff_mask)  # debugging
+
+
+        # Hough on the sparse difference mask
+        lines = cv2.HoughLinesP(
+            diff_mask,
+            self.rho,
+            self.theta,
+            self.difference_hough_threshold,
+            numpy.array([]),
+            self.difference_min_line_length,
+            self.difference_max_line_gap,
+        )
+
+        if isinstance(lines, type(None)):
+            lines = numpy.zeros((0, 1, 4), dtype=numpy.int32)
+        else:
+            # level 0 coordinates
+            lines = lines * (2 ** self.difference_level)
+
+
+        if len(self._line_history) < self.difference_min_frames:
+            # static lines are not known yet
+            moving = numpy.zeros(len(lines), dtype=bool)
+        else:
+            moving = self._movingLines(lines)
+
+        # all candidates are kept, a line that keeps returning stays static
+        self._line_history.append(lines)
+
+        lines = lines[moving]
+
+        lines_elapsed_s = time.time() - lines_start
+        logger.info('Difference line detection in %0.4f s (threshold %0.1f)', lines_elapsed_s, thold)
+
+
+        if not len(lines):
+            logger.info('Detected 0 lines')
+            return list()
+
+
+        logger.info('Detected %d lines', len(lines))
+
+        self._drawLines(original_img, lines)
+
+        return lines
+
+
+    def _movingLines(self, lines):
+        # lines with a similar line from the previous frames are rejected
+        moving = numpy.ones(len(lines), dtype=bool)
+
+        if not len(lines) or not self._line_history:
+            return moving
+
+        previous = numpy.concatenate(list(self._line_history)).reshape(-1, 4).astype(numpy.float64)
+        if not len(previous):
+            return moving
+
+
+        current = lines.reshape(-1, 4).astype(numpy.float64)
+
+        # angles modulo 180 degrees
+        current_angle = numpy.arctan2(current[:, 3] - current[:, 1], current[:, 2] - current[:, 0]) % numpy.pi
+        previous_angle = numpy.arctan2(previous[:, 3] - previous[:, 1], previous[:, 2] - previous[:, 0]) % numpy.pi
+
+        angle_diff = numpy.abs(current_angle[:, None] - previous_angle[None, :])
+        angle_diff = numpy.minimum(angle_diff, numpy.pi - angle_diff)
+
+
+        # distance from the midpoint of the current line to each previous segment
+        mid_x = ((current[:, 0] + current[:, 2]) / 2)[:, None]
+        mid_y = ((current[:, 1] + current[:, 3]) / 2)[:, None]
+
+        seg_x = (previous[:, 2] - previous[:, 0])[None, :]
+        seg_y = (previous[:, 3] - previous[:, 1])[None, :]
+        seg_len2 = numpy.maximum((seg_x ** 2) + (seg_y ** 2), 1.0)
+
+        t = numpy.clip((((mid_x - previous[None, :, 0]) * seg_x) + ((mid_y - previous[None, :, 1]) * seg_y)) / seg_len2, 0.0, 1.0)
+        dist = numpy.hypot(previous[None, :, 0] + (t * seg_x) - mid_x, previous[None, :, 1] + (t * seg_y) - mid_y)
+
+
+        static = numpy.any((angle_diff <= self.static_angle) & (dist <= self.static_distance), axis=1)
+        moving[static] = False
+
+        if numpy.any(static):
+            logger.info('Rejected %d static lines', numpy.count_nonzero(static))
+
+        return moving
+
+
     def _generateSqmMask(self, img):
         logger.info('Generating mask based on SQM_ROI')
 
@@ -141,14 +338,8 @@ class IndiAllskyDetectLines(object):
         # blur the mask to prevent mask edges from being detected as lines
         blur_mask = cv2.blur(self._sqm_mask, (self.mask_blur_kernel_size, self.mask_blur_kernel_size), cv2.BORDER_DEFAULT)
 
-        if len(img.shape) == 2:
-            # mono
-            mask = blur_mask
-        else:
-            # color
-            mask = cv2.cvtColor(blur_mask, cv2.COLOR_GRAY2BGR)
-
-        self._sqm_gradient_mask = mask / 255
+        # applied to the luminance
+        self._sqm_gradient_mask = (blur_mask / 255).astype(numpy.float32)
 
 
     def _drawLines(self, img, lines):
@@ -169,3 +360,94 @@ class IndiAllskyDetectLines(object):
                     3,
                 )
 
+
+
+
+class ImageRollingMedian(object):
+    # Exact per pixel median of the last N frames.  The frames are kept as
+    # layers sorted per pixel.  Removing the oldest frame shifts the layers
+    # above its value down by one and inserting a frame is a min/max merge,
+    # about 4 operations per layer instead of sorting the whole stack.
+
+    def __init__(self, size):
+        self._size = size
+
+        self._frames = deque()  # oldest first
+        self._layers = list()  # sorted per pixel, lowest first
+
+        self._mask = None
+
+
+    @property
+    def count(self):
+        return len(self._frames)
+
+    @count.setter
+    def count(self, *args):
+        pass  # read only
+
+
+    @property
+    def shape(self):
+        if not self._frames:
+            return None
+
+        return self._frames[0].shape
+
+    @shape.setter
+    def shape(self, *args):
+        pass  # read only
+
+
+    @property
+    def median(self):
+        # lower median when the count is even
+        return self._layers[(len(self._layers) - 1) // 2]
+
+    @median.setter
+    def median(self, *args):
+        pass  # read only
+
+
+    def add(self, data):
+        if isinstance(self._mask, type(None)):
+            self._mask = numpy.empty(data.shape[:2], dtype=numpy.uint8)
+
+        if len(self._frames) >= self._size:
+            new_layer = self._remove(self._frames.popleft())
+        else:
+            new_layer = numpy.empty_like(data)
+
+        self._insert(data, new_layer)
+        self._frames.append(data.copy())
+
+
+    def _remove(self, data):
+        # the first layer equal to the value is removed, layers above shift down
+        layers = self._layers
+
+        for i in range(len(layers) - 1):
+            cv2.compare(layers[i], data, cv2.CMP_GE, dst=self._mask)
+            cv2.bitwise_and(layers[i + 1], layers[i + 1], dst=layers[i], mask=self._mask)
+
+        return layers.pop()  # reused for the next insert
+
+
+    def _insert(self, data, new_layer):
+        layers = self._layers
+
+        if not layers:
+            numpy.copyto(new_layer, data)
+            layers.append(new_layer)
+            return
+
+
+        # top down so the layer below is still unchanged
+        cv2.max(layers[-1], data, dst=new_layer)
+
+        for i in range(len(layers) - 1, 0, -1):
+            cv2.max(layers[i - 1], cv2.min(layers[i], data), dst=layers[i])
+
+        cv2.min(layers[0], data, dst=layers[0])
+
+        layers.append(new_layer)
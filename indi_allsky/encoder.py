@@ -0,0 +1,235 @@
+import os
+import time
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import cv2
+import numpy
+
+
+try:
+    from turbojpeg import TurboJPEG  # not available in all cases
+    from turbojpeg import TJPF_BGR
+    from turbojpeg import TJPF_GRAY
+    from turbojpeg import TJSAMP_420
+    from turbojpeg import TJSAMP_GRAY
+except ImportError:
+    TurboJPEG = None
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyEncoder(object):
+    # Encodes images to jpg/png/tif in a bounded thread pool.  cv2 and
+    # libjpeg-turbo release the GIL, so encodes run in parallel with the
+    # caller.  When the pool is full, submit() blocks until a slot is free.
+    #
+    # Each image is encoded by a single cv2.imencode() call, large png and
+    # tif images are not split between threads.
+
+    def __init__(self, config, workers=None):
+        self.config = config
+
+        if isinstance(workers, type(None)):
+            workers = int(self.config.get('IMAGE_ENCODE_THREADS', 2))
+
+        self._workers = max(workers, 1)
+
+        # executors are started on first use, threads do not survive a fork
+        self._job_executor = None
+        self._executor_lock = threading.Lock()
+
+        # limits the number of queued encodes and their image data
+        self._job_slots = threading.BoundedSemaphore(self._workers * 2)
+
+        self._elapsed = dict()
+        self._elapsed_lock = threading.Lock()
+
+
+        self._turbojpeg = None
+        if self.config.get('IMAGE_ENCODE_TURBOJPEG', True) and TurboJPEG:
+            try:
+                self._turbojpeg = TurboJPEG()
+            except (OSError, RuntimeError) as e:
+                logger.error('Unable to load libjpeg-turbo: %s', str(e))
+
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, *args):
+        pass  # read only
+
+
+    @property
+    def elapsed(self):
+        # last encode time per file type
+        with self._elapsed_lock:
+            return dict(self._elapsed)
+
+    @elapsed.setter
+    def elapsed(self, *args):
+        pass  # read only
+
+
+    def _getExecutor(self):
+        with self._executor_lock:
+            if isinstance(self._job_executor, type(None)):
+                self._job_executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='encode')
+
+        return self._job_executor
+
+
+    def shutdown(self):
+        # waits for queued encodes and writes
+        with self._executor_lock:
+            if isinstance(self._job_executor, type(None)):
+                return
+
+            self._job_executor.shutdown(wait=True)
+            self._job_executor = None
+
+
+    def submit(self, data, file_type):
+        # returns a future with the encoded bytes
+        self._checkFileType(file_type)
+        return self._submit(self.encode, data, file_type)
+
+
+    def submitWrite(self, data, file_type, outfile, mtime=None):
+        self._checkFileType(file_type)
+
+        future = self._submit(self.write, data, file_type, outfile, mtime=mtime)
+        future.add_done_callback(self._logWriteError)
+        return future
+
+
+    def _submit(self, func, *args, **kwargs):
+        job_executor = self._getExecutor()
+
+        self._job_slots.acquire()
+
+        try:
+            future = job_executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._job_slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._job_slots.release())
+
+        return future
+
+
+    def _logWriteError(self, future):
+        e = future.exception()
+        if e:
+            logger.error('Image write failed: %s', str(e))
+
+
+    def write(self, data, file_type, outfile, mtime=None):
+        img_bytes = self.encode(data, file_type)
+
+        outfile_p = Path(outfile)
+
+        # temp file in the same folder, readers never see a partial file
+        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', dir=str(outfile_p.parent), prefix='.{0:s}_'.format(outfile_p.name), suffix='.tmp', delete=False)
+
+        tmpfile_name = Path(f_tmpfile.name)
+
+        try:
+            f_tmpfile.write(img_bytes)
+            f_tmpfile.close()
+
+            tmpfile_name.chmod(0o644)
+
+            if mtime:
+                os.utime(str(tmpfile_name), times=(mtime, mtime))
+
+            os.replace(str(tmpfile_name), str(outfile_p))
+        except OSError:
+            f_tmpfile.close()
+
+            try:
+                tmpfile_name.unlink()
+            except FileNotFoundError:
+                pass
+
+            raise
+
+
+    def encode(self, data, file_type):
+        self._checkFileType(file_type)
+
+        encode_start = time.time()
+
+        if file_type in ('jpg', 'jpeg'):
+            file_type = 'jpg'
+            img_bytes, method = self._encodeJpeg(data)
+        elif file_type in ('png',):
+            img_bytes, method = self._encodePng(data)
+        else:
+            file_type = 'tif'
+            img_bytes, method = self._encodeTiff(data)
+
+        encode_elapsed_s = time.time() - encode_start
+        logger.info('Image encoded to %s (%s) in %0.4f s', file_type, method, encode_elapsed_s)
+
+        with self._elapsed_lock:
+            self._elapsed[file_type] = round(encode_elapsed_s, 4)
+
+        return img_bytes
+
+
+    def _checkFileType(self, file_type):
+        if file_type not in ('jpg', 'jpeg', 'png', 'tif', 'tiff'):
+            raise Exception('Unknown file type: {0:s}'.format(str(file_type)))
+
+
+    def _imencode(self, ext, data, params):
+        result, img_buf = cv2.imencode(ext, data, params)
+        if not result:
+            raise Exception('Unable to encode {0:s} image'.format(ext))
+
+        return img_buf.tobytes()
+
+
+    def _encodeJpeg(self, data):
+        quality = int(self.config['IMAGE_FILE_COMPRESSION']['jpg'])
+
+        if self._turbojpeg and data.dtype == numpy.uint8:
+            if len(data.shape) == 2:
+                img_bytes = self._turbojpeg.encode(
+                    numpy.ascontiguousarray(data).reshape(data.shape[0], data.shape[1], 1),
+                    quality=quality,
+                    pixel_format=TJPF_GRAY,
+                    jpeg_subsample=TJSAMP_GRAY,
+                )
+                return img_bytes, 'turbojpeg'
+            elif data.shape[2] == 3:
+                img_bytes = self._turbojpeg.encode(
+                    numpy.ascontiguousarray(data),
+                    quality=quality,
+                    pixel_format=TJPF_BGR,
+                    jpeg_subsample=TJSAMP_420,  # same as opencv
+                )
+                return img_bytes, 'turbojpeg'
+
+
+        return self._imencode('.jpg', data, [cv2.IMWRITE_JPEG_QUALITY, quality]), 'opencv'
+
+
+    def _encodePng(self, data):
+        level = int(self.config['IMAGE_FILE_COMPRESSION']['png'])
+        return self._imencode('.png', data, [cv2.IMWRITE_PNG_COMPRESSION, level]), 'opencv'
+
+
+    def _encodeTiff(self, data):
+        compression = int(self.config['IMAGE_FILE_COMPRESSION']['tif'])
+        return self._imencode('.tif', data, [cv2.IMWRITE_TIFF_COMPRESSION, compression]), 'opencv'
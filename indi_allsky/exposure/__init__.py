@@ -0,0 +1,9 @@
+from .step import step
+from .pid import pid
+from .model import model
+
+__all__ = (
+    'step',
+    'pid',
+    'model',
+)
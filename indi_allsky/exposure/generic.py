@@ -0,0 +1,73 @@
+import collections
+import logging
+
+logger = logging.getLogger('indi_allsky')
+
+
+class GenericExposureController(object):
+    # Exposure controllers are called once per frame with the measured ADU
+    # and return the next exposure, or None when the exposure should not
+    # change.
+
+    history_max_vals = 6  # number of entries to use to calculate average
+
+    def __init__(self, *args, **kwargs):
+        self.config = args[0]
+        self.latitude_v = args[1]
+        self.longitude_v = args[2]
+
+        self.target_adu = float(self.config['TARGET_ADU'])
+
+        self._stable = False
+        self._current_adu_target = 0
+
+        self._adu_history = collections.deque(maxlen=self.history_max_vals)
+
+
+    @property
+    def stable(self):
+        return self._stable
+
+    @stable.setter
+    def stable(self, *args):
+        pass  # read only
+
+
+    @property
+    def current_adu_target(self):
+        return self._current_adu_target
+
+    @current_adu_target.setter
+    def current_adu_target(self, *args):
+        pass  # read only
+
+
+    def calculate(self, exposure, adu, exp_date):
+        """Returns the next exposure (or None) and the ADU average"""
+        raise Exception('Must be redefined in sub-class')
+
+
+    def _aduDev(self, exposure):
+        # Brightness when the sun is in view (very short exposures) can change drastically when clouds pass through the view
+        # Setting a deviation that is too short can cause exposure flapping
+        if exposure < 0.001000:
+            # DAY
+            return float(self.config.get('TARGET_ADU_DEV_DAY', 20))
+
+        # NIGHT
+        return float(self.config.get('TARGET_ADU_DEV', 10))
+
+
+    def _aduAverage(self, adu):
+        self._adu_history.append(adu)
+        return sum(self._adu_history) / len(self._adu_history)
+
+
+    def _limitExposure(self, new_exposure):
+        # Do not exceed the limits
+        if new_exposure < self.config['CCD_EXPOSURE_MIN']:
+            return self.config['CCD_EXPOSURE_MIN']
+        elif new_exposure > self.config['CCD_EXPOSURE_MAX']:
+            return self.config['CCD_EXPOSURE_MAX']
+
+        return new_exposure
@@ -0,0 +1,157 @@
+from .generic import GenericExposureController
+
+import math
+import time
+import collections
+from datetime import timedelta
+from datetime import timezone
+import logging
+
+import ephem
+import numpy
+
+from ..flask.models import IndiAllSkyDbImageTable
+
+logger = logging.getLogger('indi_allsky')
+
+
+class model(GenericExposureController):
+    # Sky brightness model.  The sensitivity of each frame is ln(ADU / exposure),
+    # during twilight it is close to linear with the sun altitude.  A line is
+    # fit to the recent frames and the sensitivity at the time of the next
+    # frame is used to predict the exposure that reaches the target ADU.
+    # Without enough history, the exposure is scaled directly.
+
+    linear_adu_min = 1.0  # samples outside of this range are not linear
+    linear_adu_max = 250.0
+
+    slope_limit = 1.0  # ln units per degree, about 1 magnitude per degree
+    fit_alt_spread = 0.2  # degrees of sun altitude required to fit a slope
+    history_minutes = 30
+
+
+    def __init__(self, *args, **kwargs):
+        super(model, self).__init__(*args, **kwargs)
+
+        model_config = self.config.get('EXPOSURE_CONTROLLER', {}).get('MODEL', {})
+
+        # (sun altitude, sensitivity)
+        self._model_history = collections.deque(maxlen=int(model_config.get('HISTORY', 10)))
+
+        self._history_loaded = False
+
+
+    def calculate(self, exposure, adu, exp_date):
+        if not self._history_loaded:
+            self._loadHistory(exp_date)
+
+
+        adu_dev = self._aduDev(exposure)
+        adu_average = self._aduAverage(adu)
+
+        sun_alt = self._sunAlt(exp_date)
+        self._addSample(sun_alt, exposure, adu)
+
+
+        if exposure < 0.001000:
+            period = self.config.get('EXPOSURE_PERIOD_DAY', self.config['EXPOSURE_PERIOD'])
+        else:
+            period = self.config['EXPOSURE_PERIOD']
+
+        next_sun_alt = self._sunAlt(exp_date + timedelta(seconds=period))
+
+
+        sensitivity = self._predictSensitivity(next_sun_alt)
+        if isinstance(sensitivity, type(None)) or adu > self.linear_adu_max:
+            # not enough data or saturated, scale directly
+            predicted_adu = adu
+            new_exposure = exposure * (self.target_adu / adu)
+        else:
+            predicted_adu = math.exp(sensitivity) * exposure
+            new_exposure = self.target_adu / math.exp(sensitivity)
+
+        logger.info('Sun altitude: %0.2f, next: %0.2f, predicted ADU: %0.2f', sun_alt, next_sun_alt, predicted_adu)
+
+
+        if abs(adu - self.target_adu) <= adu_dev and abs(predicted_adu - self.target_adu) <= adu_dev:
+            if not self._stable:
+                logger.warning('Found target value for exposure')
+
+            self._stable = True
+            self._current_adu_target = self.target_adu
+            return None, adu_average
+
+
+        self._stable = False
+
+        return self._limitExposure(new_exposure), adu_average
+
+
+    def _predictSensitivity(self, sun_alt):
+        if len(self._model_history) < 3:
+            return None
+
+
+        alt_array = numpy.array([x[0] for x in self._model_history])
+        sensitivity_array = numpy.array([x[1] for x in self._model_history])
+
+        if (alt_array.max() - alt_array.min()) < self.fit_alt_spread:
+            # sky is not changing, use the recent frames
+            return float(numpy.median(sensitivity_array[-3:]))
+
+
+        slope, intercept = numpy.polyfit(alt_array, sensitivity_array, 1)
+        slope = min(max(slope, -self.slope_limit), self.slope_limit)
+
+        # anchor the line on the newest frame
+        return float(sensitivity_array[-1] + (slope * (sun_alt - alt_array[-1])))
+
+
+    def _sunAlt(self, exp_date):
+        obs = ephem.Observer()
+        obs.lon = math.radians(self.longitude_v.value)
+        obs.lat = math.radians(self.latitude_v.value)
+
+        # exposure dates are local time, ephem expects UTC
+        obs.date = exp_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+        sun = ephem.Sun()
+        sun.compute(obs)
+
+        return math.degrees(sun.alt)
+
+
+    def _loadHistory(self, exp_date):
+        self._history_loaded = True
+
+        camera_id = self.config.get('DB_CCD_ID')
+        if not camera_id:
+            return
+
+        start = time.time()
+
+        image_list = IndiAllSkyDbImageTable.query\
+            .filter(IndiAllSkyDbImageTable.camera_id == camera_id)\
+            .filter(IndiAllSkyDbImageTable.createDate > exp_date - timedelta(minutes=self.history_minutes))\
+            .order_by(IndiAllSkyDbImageTable.createDate.desc())\
+            .limit(self._model_history.maxlen)
+
+        for image in reversed(image_list.all()):
+            self.addHistory(image.createDate, image.exposure, image.adu)
+
+        load_elapsed_s = time.time() - start
+        logger.info('Loaded %d exposure history entries in %0.4f s', len(self._model_history), load_elapsed_s)
+
+
+    def addHistory(self, exp_date, exposure, adu):
+        self._addSample(self._sunAlt(exp_date), exposure, adu)
+
+
+    def _addSample(self, sun_alt, exposure, adu):
+        if not exposure:
+            return
+
+        if not (self.linear_adu_min <= adu <= self.linear_adu_max):
+            return
+
+        self._model_history.append((sun_alt, math.log(adu / exposure)))
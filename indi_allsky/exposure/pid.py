@@ -0,0 +1,64 @@
+from .generic import GenericExposureController
+
+import math
+import logging
+
+logger = logging.getLogger('indi_allsky')
+
+
+class pid(GenericExposureController):
+    # PID loop on the log of the ADU error.  The ADU is proportional to the
+    # exposure, so a proportional gain of 1.0 would correct the full error in
+    # one frame.  The integral term removes offsets caused by a non-linear
+    # stretch or the black level.
+
+    integral_limit = math.log(4.0)
+
+
+    def __init__(self, *args, **kwargs):
+        super(pid, self).__init__(*args, **kwargs)
+
+        pid_config = self.config.get('EXPOSURE_CONTROLLER', {}).get('PID', {})
+
+        self.kp = float(pid_config.get('KP', 0.8))
+        self.ki = float(pid_config.get('KI', 0.1))
+        self.kd = float(pid_config.get('KD', 0.0))
+
+        self._integral = 0.0
+        self._last_error = None
+
+
+    def calculate(self, exposure, adu, exp_date):
+        adu_dev = self._aduDev(exposure)
+        adu_average = self._aduAverage(adu)
+
+        error = math.log(self.target_adu / adu)
+
+        if isinstance(self._last_error, type(None)):
+            derivative = 0.0
+        else:
+            derivative = error - self._last_error
+
+        self._last_error = error
+
+
+        if abs(adu - self.target_adu) <= adu_dev:
+            if not self._stable:
+                logger.warning('Found target value for exposure')
+
+            self._stable = True
+            self._current_adu_target = self.target_adu
+            return None, adu_average
+
+
+        self._stable = False
+
+        self._integral += error
+        self._integral = min(max(self._integral, -self.integral_limit), self.integral_limit)
+
+        correction = (self.kp * error) + (self.ki * self._integral) + (self.kd * derivative)
+        logger.info('PID error: %0.3f, integral: %0.3f, derivative: %0.3f', error, self._integral, derivative)
+
+        new_exposure = exposure * math.exp(correction)
+
+        return self._limitExposure(new_exposure), adu_average
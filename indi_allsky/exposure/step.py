@@ -0,0 +1,82 @@
+from .generic import GenericExposureController
+
+import copy
+import logging
+
+logger = logging.getLogger('indi_allsky')
+
+
+class step(GenericExposureController):
+    # Original step and settle algorithm.  The exposure is scaled until the
+    # ADU is within the deviation of the target, then the exposure is held
+    # until the average of the last values leaves the deviation.
+
+    def __init__(self, *args, **kwargs):
+        super(step, self).__init__(*args, **kwargs)
+
+        self.hist_adu = []
+
+
+    def calculate(self, exposure, adu, exp_date):
+        adu_dev = self._aduDev(exposure)
+
+        target_adu_min = self.target_adu - adu_dev
+        target_adu_max = self.target_adu + adu_dev
+        current_adu_target_min = self._current_adu_target - adu_dev
+        current_adu_target_max = self._current_adu_target + adu_dev
+
+        if exposure < 0.001000:
+            # DAY
+            exp_scale_factor = 0.50  # scale exposure calculation
+        else:
+            # NIGHT
+            exp_scale_factor = 1.0  # scale exposure calculation
+
+
+        if not self._stable:
+            new_exposure = self.recalculate_exposure(exposure, adu, target_adu_min, target_adu_max, exp_scale_factor)
+            return new_exposure, 0.0
+
+
+        self.hist_adu.append(adu)
+        self.hist_adu = self.hist_adu[(self.history_max_vals * -1):]  # remove oldest values, up to history_max_vals
+
+        logger.info('Current target ADU: %0.2f (%0.2f/%0.2f)', self._current_adu_target, current_adu_target_min, current_adu_target_max)
+        logger.info('Current ADU history: (%d) [%s]', len(self.hist_adu), ', '.join(['{0:0.2f}'.format(x) for x in self.hist_adu]))
+
+
+        adu_average = sum(self.hist_adu) / len(self.hist_adu)
+        logger.info('ADU average: %0.2f', adu_average)
+
+
+        ### Need at least x values to continue
+        if len(self.hist_adu) < self.history_max_vals:
+            return None, 0.0
+
+
+        ### only change exposure when 70% of the values exceed the max or minimum
+        if adu_average > current_adu_target_max:
+            logger.warning('ADU increasing beyond limits, recalculating next exposure')
+            self._stable = False
+        elif adu_average < current_adu_target_min:
+            logger.warning('ADU decreasing beyond limits, recalculating next exposure')
+            self._stable = False
+
+        return None, adu_average
+
+
+    def recalculate_exposure(self, exposure, adu, target_adu_min, target_adu_max, exp_scale_factor):
+
+        # Until we reach a good starting point, do not calculate a moving average
+        if adu <= target_adu_max and adu >= target_adu_min:
+            logger.warning('Found target value for exposure')
+            self._current_adu_target = copy.copy(adu)
+            self._stable = True
+            self.hist_adu = []
+            return None
+
+
+        # Scale the exposure up and down based on targets
+        new_exposure = exposure - ((exposure - (exposure * (self.target_adu / adu))) * exp_scale_factor)
+
+        return self._limitExposure(new_exposure)
@@ -1,4 +1,5 @@
 #from pathlib import Path
+import io
 import logging
 
 logger = logging.getLogger('indi_allsky')
@@ -47,5 +48,23 @@ class GenericFileTransfer(object):
     def put(self, *args, **kwargs):
         local_file = kwargs['local_file']
 
-        logger.info('Uploading %s', local_file)
+        if isinstance(kwargs.get('local_data'), type(None)):
+            logger.info('Uploading %s', local_file)
+        else:
+            logger.info('Uploading %s (cached)', local_file)
+
+
+    def _openLocalFile(self, local_file_p, local_data):
+        # encoded image from the image cache
+        if not isinstance(local_data, type(None)):
+            return io.BytesIO(local_data)
+
+        return io.open(str(local_file_p), 'rb')
+
+
+    def _localFileSize(self, local_file_p, local_data):
+        if not isinstance(local_data, type(None)):
+            return len(local_data)
+
+        return local_file_p.stat().st_size
 
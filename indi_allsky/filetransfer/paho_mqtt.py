@@ -7,7 +7,6 @@ from pathlib import Path
 import paho.mqtt.publish as publish
 from paho.mqtt import MQTTException
 import ssl
-import io
 import socket
 import time
 import logging
@@ -69,6 +68,7 @@ class paho_mqtt(GenericFileTransfer):
         super(paho_mqtt, self).put(*args, **kwargs)
 
         local_file = kwargs['local_file']
+        local_data = kwargs.get('local_data')
         base_topic = kwargs['base_topic']
         qos        = kwargs['qos']
         mq_data    = kwargs['mq_data']
@@ -79,7 +79,7 @@ class paho_mqtt(GenericFileTransfer):
         message_list = list()
 
         # publish image
-        with io.open(local_file_p, 'rb') as f_localfile:
+        with self._openLocalFile(local_file_p, local_data) as f_localfile:
             image_data = f_localfile.read()
             message_list.append({
                 'topic'    : '/'.join((base_topic, 'latest')),
@@ -123,7 +123,7 @@ class paho_mqtt(GenericFileTransfer):
             raise AuthenticationFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
+        local_file_size = self._localFileSize(local_file_p, local_data)
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
@@ -84,6 +84,7 @@ class paramiko_sftp(GenericFileTransfer):
         super(paramiko_sftp, self).put(*args, **kwargs)
 
         local_file = kwargs['local_file']
+        local_data = kwargs.get('local_data')
         remote_file = kwargs['remote_file']
 
         local_file_p = Path(local_file)
@@ -110,16 +111,17 @@ class paramiko_sftp(GenericFileTransfer):
 
         start = time.time()
 
-        try:
-            self.sftp.put(str(local_file_p), str(remote_file_p))
-        except PermissionError as e:
-            raise TransferFailure(str(e)) from e
-        except FileNotFoundError as e:
-            logger.error('Upload failed.  Paramiko does not support ~ in remote paths')
-            raise TransferFailure(str(e)) from e
+        with self._openLocalFile(local_file_p, local_data) as f_localfile:
+            try:
+                self.sftp.putfo(f_localfile, str(remote_file_p))
+            except PermissionError as e:
+                raise TransferFailure(str(e)) from e
+            except FileNotFoundError as e:
+                logger.error('Upload failed.  Paramiko does not support ~ in remote paths')
+                raise TransferFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
+        local_file_size = self._localFileSize(local_file_p, local_data)
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
         try:
@@ -7,7 +7,6 @@ from .exceptions import TransferFailure
 
 from pathlib import Path
 import pycurl
-import io
 import time
 import logging
 
@@ -84,6 +83,7 @@ class pycurl_ftps(GenericFileTransfer):
         super(pycurl_ftps, self).put(*args, **kwargs)
 
         local_file = kwargs['local_file']
+        local_data = kwargs.get('local_data')
         remote_file = kwargs['remote_file']
 
         local_file_p = Path(local_file)
@@ -102,7 +102,7 @@ class pycurl_ftps(GenericFileTransfer):
 
 
         start = time.time()
-        f_localfile = io.open(str(local_file_p), 'rb')
+        f_localfile = self._openLocalFile(local_file_p, local_data)
 
         self.client.setopt(pycurl.URL, url)
         #self.client.setopt(pycurl.PREQUOTE, pre_commands)
@@ -111,7 +111,7 @@ class pycurl_ftps(GenericFileTransfer):
         self.client.setopt(pycurl.READDATA, f_localfile)
         self.client.setopt(
             pycurl.INFILESIZE_LARGE,
-            local_file_p.stat().st_size,
+            self._localFileSize(local_file_p, local_data),
         )
 
         try:
@@ -142,7 +142,7 @@ class pycurl_ftps(GenericFileTransfer):
         f_localfile.close()
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
+        local_file_size = self._localFileSize(local_file_p, local_data)
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
@@ -6,7 +6,6 @@ from .exceptions import TransferFailure
 
 from pathlib import Path
 import ftplib
-import io
 import socket
 import time
 import logging
@@ -64,6 +63,7 @@ class python_ftpes(GenericFileTransfer):
         super(python_ftpes, self).put(*args, **kwargs)
 
         local_file = kwargs['local_file']
+        local_data = kwargs.get('local_data')
         remote_file = kwargs['remote_file']
 
         local_file_p = Path(local_file)
@@ -92,7 +92,7 @@ class python_ftpes(GenericFileTransfer):
 
         start = time.time()
 
-        with io.open(str(local_file_p), 'rb') as f_localfile:
+        with self._openLocalFile(local_file_p, local_data) as f_localfile:
             try:
                 self.client.storbinary('STOR {0}'.format(str(remote_file_p)), f_localfile, blocksize=262144)
             except ftplib.error_perm as e:
@@ -102,7 +102,7 @@ class python_ftpes(GenericFileTransfer):
             f_localfile.close()
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
+        local_file_size = self._localFileSize(local_file_p, local_data)
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
         try:
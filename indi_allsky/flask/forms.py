@@ -678,6 +678,10 @@ def IMAGE_STACK_METHOD_validator(form, field):
         'maximum',
         'average',
         'minimum',
+        'rolling_maximum',
+        'rolling_minimum',
+        'median',
+        'sigmaclip',
     )
 
     if field.data not in stack_methods:
@@ -1234,6 +1238,10 @@ class IndiAllskyConfigForm(FlaskForm):
         ('maximum', 'Maximum'),
         ('average', 'Average'),
         ('minimum', 'Minimum'),
+        ('rolling_maximum', 'Maximum (rolling)'),
+        ('rolling_minimum', 'Minimum (rolling)'),
+        ('median', 'Median'),
+        ('sigmaclip', 'Sigma Clip'),
     )
 
     IMAGE_STACK_COUNT_choices = (
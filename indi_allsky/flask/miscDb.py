@@ -1,4 +1,6 @@
+import io
 import datetime
+import tempfile
 from pathlib import Path
 import logging
 #from pprint import pformat
@@ -22,6 +24,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class miscDb(object):
+
+    # bumped when calibration frames are added or removed
+    calibration_generation_file = Path('/var/lib/indi-allsky/calibration_generation')
+
     def __init__(self, config):
         self.config = config
 
@@ -68,7 +74,9 @@ class miscDb(object):
         adu_roi=False,
         calibrated=False,
         stars=None,
+        star_stats=None,
         detections=0,
+        commit=True,
     ):
         if not filename:
             return
@@ -103,6 +111,11 @@ class miscDb(object):
         adu_roi_val = bool(adu_roi)
 
 
+        # median values of the detected stars
+        if not star_stats:
+            star_stats = dict()
+
+
         if night:
             # day date for night is offset by 12 hours
             dayDate = (datetime.datetime.now() - datetime.timedelta(hours=12)).date()
@@ -129,11 +142,17 @@ class miscDb(object):
             moonphase=moonphase_val,
             sqm=sqm,
             stars=stars,
+            stars_fwhm=star_stats.get('fwhm'),
+            stars_flux=star_stats.get('flux'),
+            stars_ellipticity=star_stats.get('ellipticity'),
+            stars_limiting_mag=star_stats.get('limiting_mag'),
             detections=detections,
         )
 
         db.session.add(image)
-        db.session.commit()
+
+        if commit:
+            db.session.commit()
 
         return image
 
@@ -178,6 +197,8 @@ class miscDb(object):
         db.session.add(dark)
         db.session.commit()
 
+        self.updateCalibrationGeneration()
+
         return dark
 
 
@@ -221,6 +242,8 @@ class miscDb(object):
         db.session.add(bpm)
         db.session.commit()
 
+        self.updateCalibrationGeneration()
+
         return bpm
 
 
@@ -364,7 +387,7 @@ class miscDb(object):
         return startrail_video
 
 
-    def addFitsImage(self, filename, camera_id, createDate, exposure, gain, binmode, night=True):
+    def addFitsImage(self, filename, camera_id, createDate, exposure, gain, binmode, night=True, commit=True):
         if not filename:
             return
 
@@ -398,12 +421,14 @@ class miscDb(object):
         )
 
         db.session.add(fits_image)
-        db.session.commit()
+
+        if commit:
+            db.session.commit()
 
         return fits_image
 
 
-    def addRawImage(self, filename, camera_id, createDate, exposure, gain, binmode, night=True):
+    def addRawImage(self, filename, camera_id, createDate, exposure, gain, binmode, night=True, commit=True):
         if not filename:
             return
 
@@ -437,14 +462,39 @@ class miscDb(object):
         )
 
         db.session.add(fits_image)
-        db.session.commit()
+
+        if commit:
+            db.session.commit()
 
         return fits_image
 
 
-    def addUploadedFlag(self, entry):
+    def addUploadedFlag(self, entry, commit=True):
         entry.uploaded = True
-        db.session.commit()
+
+        if commit:
+            db.session.commit()
+
+
+    def getCalibrationGeneration(self):
+        try:
+            with io.open(str(self.calibration_generation_file), 'r') as f_gen:
+                return int(f_gen.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+
+    def updateCalibrationGeneration(self):
+        generation = self.getCalibrationGeneration() + 1
+
+        # atomic replace, readers never see a partial file
+        f_tmp_gen = tempfile.NamedTemporaryFile(mode='w', dir=str(self.calibration_generation_file.parent), delete=False)
+        f_tmp_gen.write('{0:d}'.format(generation))
+        f_tmp_gen.close()
+
+        tmp_gen_p = Path(f_tmp_gen.name)
+        tmp_gen_p.chmod(0o644)
+        tmp_gen_p.replace(self.calibration_generation_file)
 
 
     def getCurrentCameraId(self):
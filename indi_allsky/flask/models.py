@@ -68,6 +68,10 @@ class IndiAllSkyDbImageTable(db.Model):
     adu_roi = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     sqm = db.Column(db.Float, nullable=True)
     stars = db.Column(db.Integer, nullable=True)
+    stars_fwhm = db.Column(db.Float, nullable=True)
+    stars_flux = db.Column(db.Float, nullable=True)
+    stars_ellipticity = db.Column(db.Float, nullable=True)
+    stars_limiting_mag = db.Column(db.Float, nullable=True)
     uploaded = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     calibrated = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     detections = db.Column(db.Integer, server_default='0', nullable=False, index=True)
@@ -679,6 +679,8 @@ class JsonChartView(JsonView):
                 IndiAllSkyDbImageTable.createDate,
                 IndiAllSkyDbImageTable.sqm,
                 func.avg(IndiAllSkyDbImageTable.stars).over(order_by=IndiAllSkyDbImageTable.createDate, rows=(-5, 0)).label('stars_rolling'),
+                IndiAllSkyDbImageTable.stars_fwhm,
+                IndiAllSkyDbImageTable.stars_limiting_mag,
                 IndiAllSkyDbImageTable.temp,
                 IndiAllSkyDbImageTable.exposure,
                 IndiAllSkyDbImageTable.detections,
@@ -696,6 +698,8 @@ class JsonChartView(JsonView):
             'sqm'   : [],
             'sqm_d' : [],
             'stars' : [],
+            'fwhm'  : [],
+            'limiting_mag' : [],
             'temp'  : [],
             'exp'   : [],
             'detection': [],
@@ -719,6 +723,18 @@ class JsonChartView(JsonView):
             }
             chart_data['stars'].append(star_data)
 
+            fwhm_data = {
+                'x' : i.createDate.strftime('%H:%M:%S'),
+                'y' : i.stars_fwhm,
+            }
+            chart_data['fwhm'].append(fwhm_data)
+
+            limiting_mag_data = {
+                'x' : i.createDate.strftime('%H:%M:%S'),
+                'y' : i.stars_limiting_mag,
+            }
+            chart_data['limiting_mag'].append(limiting_mag_data)
+
 
             if self.indi_allsky_config.get('TEMP_DISPLAY') == 'f':
                 sensortemp = ((i.temp * 9.0) / 5.0) + 32
@@ -0,0 +1,198 @@
+import json
+import struct
+import logging
+
+from multiprocessing import Array
+from multiprocessing import shared_memory
+
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyFrameRing(object):
+    # Each slot is a separate shared memory segment laid out as
+    #   [ 8 byte metadata length | json metadata ... | pixel data ]
+    # The segment is allocated on first use and only grown when a larger
+    # frame arrives, so unused slots never consume memory.
+
+    STATE_FREE  = 0
+    STATE_WRITE = 1
+    STATE_READY = 2
+    STATE_USED  = 3
+
+    meta_size = 65536  # fits headers are usually less than 20k
+
+
+    def __init__(self, slots, name_prefix):
+        self._slots = int(slots)
+        self._name_prefix = str(name_prefix)
+
+        self._state = Array('i', self._slots)  # shared between processes
+        self._size = Array('q', self._slots)  # allocated segment size, 0 = not allocated
+
+        # per process mapping of attached segments
+        self._shm = dict()
+        self._stale_shm = list()
+
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @slots.setter
+    def slots(self, *args):
+        pass  # read only
+
+
+    def _slotName(self, idx):
+        return '{0:s}_{1:d}'.format(self._name_prefix, idx)
+
+
+    def _acquire(self):
+        with self._state.get_lock():
+            for idx in range(self._slots):
+                if self._state[idx] == self.STATE_FREE:
+                    self._state[idx] = self.STATE_WRITE
+                    return idx
+
+        return None
+
+
+    def _attach(self, idx, min_size=0):
+        shm_size = self._size[idx]
+
+        if shm_size < min_size:
+            # writer needs a larger segment
+            self._detach(idx)
+            self._unlink(idx)
+
+            shm = shared_memory.SharedMemory(name=self._slotName(idx), create=True, size=min_size)
+
+            self._size[idx] = shm.size
+            self._shm[idx] = shm
+
+            logger.info('Allocated frame slot %d: %d bytes', idx, shm.size)
+
+            return shm
+
+
+        shm = self._shm.get(idx)
+        if shm and shm.size == shm_size:
+            return shm
+
+
+        # segment was reallocated by another process
+        self._detach(idx)
+
+        shm = shared_memory.SharedMemory(name=self._slotName(idx), create=False)
+        self._shm[idx] = shm
+
+        return shm
+
+
+    def _detach(self, idx):
+        shm = self._shm.pop(idx, None)
+        if not shm:
+            return
+
+        try:
+            shm.close()
+        except BufferError:
+            # numpy views of the old segment are still referenced
+            self._stale_shm.append(shm)
+
+
+    def _unlink(self, idx):
+        try:
+            shm = shared_memory.SharedMemory(name=self._slotName(idx), create=False)
+        except FileNotFoundError:
+            return
+
+        shm.close()
+        shm.unlink()
+
+        self._size[idx] = 0
+
+
+    def put(self, data, meta):
+        """Copy frame data into a free slot, returns the slot index or None if no slot is available"""
+        idx = self._acquire()
+        if isinstance(idx, type(None)):
+            logger.warning('No free frame slots')
+            return None
+
+
+        meta_dict = {
+            'shape' : list(data.shape),
+            'dtype' : data.dtype.str,
+            'meta'  : meta,
+        }
+
+        meta_bytes = json.dumps(meta_dict).encode()
+        if (len(meta_bytes) + 8) > self.meta_size:
+            logger.error('Frame metadata too large: %d bytes', len(meta_bytes))
+            self._state[idx] = self.STATE_FREE
+            return None
+
+
+        try:
+            shm = self._attach(idx, min_size=self.meta_size + data.nbytes)
+        except OSError as e:
+            logger.error('Unable to allocate frame slot: %s', str(e))
+            self._state[idx] = self.STATE_FREE
+            return None
+
+
+        struct.pack_into('<Q', shm.buf, 0, len(meta_bytes))
+        shm.buf[8:8 + len(meta_bytes)] = meta_bytes
+
+        frame = numpy.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf, offset=self.meta_size)
+        frame[:] = data
+        del frame  # release buffer export
+
+        self._state[idx] = self.STATE_READY
+
+        return idx
+
+
+    def get(self, idx):
+        """Returns a numpy view of the frame in shared memory and the metadata, the slot must be released when no longer needed"""
+        if self._state[idx] != self.STATE_READY:
+            raise Exception('Frame slot {0:d} is not ready'.format(idx))
+
+        shm = self._attach(idx)
+
+        meta_len = struct.unpack_from('<Q', shm.buf, 0)[0]
+        meta_dict = json.loads(bytes(shm.buf[8:8 + meta_len]))
+
+        data = numpy.ndarray(
+            tuple(meta_dict['shape']),
+            dtype=numpy.dtype(meta_dict['dtype']),
+            buffer=shm.buf,
+            offset=self.meta_size,
+        )
+
+        self._state[idx] = self.STATE_USED
+
+        return data, meta_dict['meta']
+
+
+    def release(self, idx):
+        self._state[idx] = self.STATE_FREE
+
+
+    def reset(self):
+        # return slots held by a previous consumer
+        with self._state.get_lock():
+            for idx in range(self._slots):
+                if self._state[idx] == self.STATE_USED:
+                    self._state[idx] = self.STATE_FREE
+
+
+    def close(self):
+        for idx in range(self._slots):
+            self._detach(idx)
+            self._unlink(idx)
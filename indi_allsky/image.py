@@ -1,4 +1,5 @@
 import io
+import os
 import json
 from pathlib import Path
 from datetime import datetime
@@ -8,8 +9,8 @@ import time
 import functools
 import tempfile
 import shutil
-import copy
 import math
+import collections
 import logging
 import traceback
 #from pprint import pformat
@@ -17,11 +18,11 @@ import traceback
 import ephem
 
 from multiprocessing import Process
-#from threading import Thread
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import queue
 
 from astropy.io import fits
-import astroalign
 
 import cv2
 import numpy
@@ -29,9 +30,18 @@ import numpy
 from .orb import IndiAllskyOrbGenerator
 from .sqm import IndiAllskySqm
 from .stars import IndiAllSkyStars
+from .pyramid import IndiAllSkyImagePyramid
 from .detectLines import IndiAllskyDetectLines
 from .draw import IndiAllSkyDraw
-from .scnr import IndiAllskyScnr
+from .colorBalance import IndiAllSkyColorBalance
+from .stretch import IndiAllSkyStretch
+from .contrast import IndiAllSkyContrastEnhance
+from .aduMeter import IndiAllSkyAduMeter
+from .encoder import IndiAllSkyEncoder
+from .darkLibrary import IndiAllSkyDarkLibrary
+from . import exposure as exposure_controllers
+
+from flask import current_app
 
 from .flask import db
 from .flask.miscDb import miscDb
@@ -65,6 +75,8 @@ class ImageWorker(Process):
     sqm_history_minutes = 30
     stars_history_minutes = 30
 
+    db_batch_seconds = 30  # pending frames are committed at least this often
+
     def __init__(
         self,
         idx,
@@ -82,6 +94,8 @@ class ImageWorker(Process):
         sensortemp_v,
         night_v,
         moonmode_v,
+        frame_ring=None,
+        image_cache=None,
     ):
         super(ImageWorker, self).__init__()
 
@@ -93,6 +107,9 @@ class ImageWorker(Process):
         self.image_q = image_q
         self.upload_q = upload_q
 
+        self.frame_ring = frame_ring
+        self.image_cache = image_cache
+
         self.latitude_v = latitude_v
         self.longitude_v = longitude_v
 
@@ -119,20 +136,37 @@ class ImageWorker(Process):
 
         self.target_adu_found = False
         self.current_adu_target = 0
-        self.hist_adu = []
         self.target_adu = float(self.config['TARGET_ADU'])
 
+        controller_classname = self.config.get('EXPOSURE_CONTROLLER', {}).get('CLASSNAME', 'step')
+
+        try:
+            controller_class = getattr(exposure_controllers, controller_classname)
+        except AttributeError:
+            logger.error('Unknown exposure controller: %s', controller_classname)
+            controller_class = exposure_controllers.step
+
+        self.exposure_controller = controller_class(self.config, latitude_v, longitude_v)
+
         self.image_count = 0
 
         self.sqm_value = 0
 
+        self._stages = list()  # pipeline threads, started in saferun()
+
+        # database writes of the commit stage
+        self._db_pending_frames = 0
+        self._db_pending_tasks = list()
+        self._db_last_commit = time.time()
+
         self._detection_mask = self._load_detection_mask()
-        self._adu_mask = self._detection_mask  # reuse detection mask for ADU mask (if defined)
 
 
-        self.image_processor = ImageProcessor(self.config, latitude_v, longitude_v, ra_v, dec_v, exposure_v, gain_v, bin_v, sensortemp_v, night_v, moonmode_v, self.astrometric_data, mask=self._detection_mask)
+        self.image_processor = ImageProcessor(self.config, latitude_v, longitude_v, ra_v, dec_v, exposure_v, gain_v, bin_v, sensortemp_v, night_v, moonmode_v, self.astrometric_data, mask=self._detection_mask, frame_ring=self.frame_ring)
 
 
+        self.encoder = IndiAllSkyEncoder(self.config)
+
         self._miscDb = miscDb(self.config)
 
         if self.config.get('IMAGE_FOLDER'):
@@ -150,19 +184,66 @@ class ImageWorker(Process):
             tb = traceback.format_exc()
             self.error_q.put((str(e), tb))
             raise e
+        finally:
+            # commit pending database rows if the worker did not stop normally
+            try:
+                self._stopStages()
+            except Exception as e:
+                logger.error('Unable to stop image stages: %s', str(e))
+
+            # stop registration processes and free shared memory
+            self.image_processor.shutdown()
+
+            # finish queued raw exports
+            self.encoder.shutdown()
 
 
 
     def saferun(self):
         #raise Exception('Test exception handling in worker')
 
+        if self.config.get('IMAGE_STACK_ALIGN'):
+            # registration processes are forked before any threads are started
+            self.image_processor.startRegistration()
+
+        self._stages = list()
+
+        if self.config.get('IMAGE_PIPELINE', True):
+            # frames move through bounded queues so that writing and encoding
+            # of one frame overlaps with processing of the next frame
+            app = current_app._get_current_object()
+            queue_depth = int(self.config.get('IMAGE_PIPELINE_DEPTH', 2))
+
+            self._process_q = queue.Queue(maxsize=queue_depth)
+            self._persist_q = queue.Queue(maxsize=queue_depth)
+            self._commit_q = queue.Queue(maxsize=queue_depth)
+
+            process_stage = ImageWorkerStage('process', app, self.processImage, self._process_q, self._persist_q)
+            persist_stage = ImageWorkerStage('persist', app, self.persistImage, self._persist_q, self._commit_q)
+            commit_stage = ImageWorkerStage('commit', app, self.commitImage, self._commit_q, None, idle_func=self.commitDbIdle, stop_func=self.commitDb)
+
+            self._stages.append(process_stage)
+            self._stages.append(persist_stage)
+            self._stages.append(commit_stage)
+
+            for stage in self._stages:
+                stage.start()
+
+
         while True:
+            self._checkStages()
+
             try:
                 i_dict = self.image_q.get(timeout=23)  # prime number
             except queue.Empty:
+                if not self._stages:
+                    # serial processing
+                    self.commitDbIdle()
+
                 continue
 
             if i_dict.get('stop'):
+                self._stopStages()
                 return
 
             ### Not using DB task queue for image processing to reduce database I/O
@@ -191,219 +272,507 @@ class ImageWorker(Process):
             #filename_t = task.data.get('filename_t')
             ###
 
-            filename_p = Path(i_dict['filename'])
-            exposure = i_dict['exposure']
-            exp_date = datetime.fromtimestamp(i_dict['exp_time'])
-            exp_elapsed = i_dict['exp_elapsed']
-            camera_id = i_dict['camera_id']
-            filename_t = i_dict.get('filename_t')
+            decode_start = time.time()
+
+            frame = self.decodeImage(i_dict)
+            if not frame:
+                continue
+
+            decode_elapsed_s = time.time() - decode_start
+            logger.info('ImageStage-decode: %0.4f s', decode_elapsed_s)
+
+
+            if not self._stages:
+                # serial processing
+                self.processImage(frame)
+                self.persistImage(frame)
+                self.commitImage(frame)
+                continue
+
 
+            self._stagePut(self._process_q, frame)
 
-            if filename_t:
-                self.filename_t = filename_t
 
-            self.image_count += 1
+    def _checkStages(self):
+        for stage in self._stages:
+            if stage.is_alive():
+                continue
+
+            if stage.error:
+                for line in stage.error[1].splitlines():
+                    logger.error('Stage %s: %s', stage.name, line)
+
+                raise Exception('Image stage {0:s} failed: {1:s}'.format(stage.name, stage.error[0]))
+
+            raise Exception('Image stage {0:s} exited'.format(stage.name))
+
+
+    def _stagePut(self, stage_q, frame):
+        # do not block forever if a later stage has died
+        while True:
+            self._checkStages()
+
+            try:
+                stage_q.put(frame, timeout=5)
+                return
+            except queue.Full:
+                logger.warning('Image pipeline is full, waiting')
+
+
+    def _stopStages(self):
+        if not self._stages:
+            self.commitDb()
+            return
+
+        # stages after the last stage that died can still be stopped
+        stage_idx = 0
+        for idx, stage in enumerate(self._stages):
+            if not stage.is_alive():
+                stage_idx = idx + 1
+
+        running_stages = self._stages[stage_idx:]
+
+        if running_stages:
+            # the stop marker is passed down the pipeline after all queued
+            # frames, the commit stage commits pending rows when it stops
+            try:
+                running_stages[0].in_q.put(None, timeout=60.0)
+            except queue.Full:
+                logger.error('Unable to stop %s', running_stages[0].name)
+
+        for stage in running_stages:
+            stage.join(timeout=60.0)
+
+        self._stages = list()  # stopped
+
+
+    def decodeImage(self, i_dict):
+        ### Stage 1: load and calibrate
+        exposure = i_dict['exposure']
+        exp_date = datetime.fromtimestamp(i_dict['exp_time'])
+        exp_elapsed = i_dict['exp_elapsed']
+        camera_id = i_dict['camera_id']
+        filename_t = i_dict.get('filename_t')
+        frame_slot = i_dict.get('frame_slot')
+
+
+        if filename_t:
+            self.filename_t = filename_t
+
+        self.image_count += 1
 
 
+        if isinstance(frame_slot, type(None)):
+            filename_p = Path(i_dict['filename'])
+
             if not filename_p.exists():
                 logger.error('Frame not found: %s', filename_p)
                 #task.setFailed('Frame not found: {0:s}'.format(str(filename_p)))
-                continue
+                return
 
 
             if filename_p.stat().st_size == 0:
                 logger.error('Frame is empty: %s', filename_p)
                 filename_p.unlink()
-                continue
+                return
+
+
+        processing_start = time.time()
 
 
-            processing_start = time.time()
+        # the shared values may change while the frame is in the pipeline,
+        # later stages only use the values captured here
+        frame_state = {
+            'night'       : bool(self.night_v.value),
+            'gain'        : self.gain_v.value,
+            'bin'         : self.bin_v.value,
+            'sensortemp'  : self.sensortemp_v.value,
+            'moonmode'    : bool(self.moonmode_v.value),
+        }
 
 
-            self.image_processor.add(filename_p, exposure, exp_date, exp_elapsed, camera_id)
-            self.image_processor.calibrate()
+        if isinstance(frame_slot, type(None)):
+            i_ref = self.image_processor.load(filename_p, exposure, exp_date, exp_elapsed, camera_id, frame_state)
+        else:
+            # frame data is in shared memory
+            i_ref = self.image_processor.loadFrame(frame_slot, exposure, exp_date, exp_elapsed, camera_id, frame_state)
+
+        self.image_processor.calibrate(i_ref)
+
+
+        frame = {
+            'i_ref'              : i_ref,
+            'image_count'        : self.image_count,
+            'processing_start'   : processing_start,
+            'hdulist'            : None,  # populated below
+            'image'              : None,  # populated later
+            'adu'                : None,  # populated later
+            'adu_average'        : None,  # populated later
+            'target_adu_found'   : None,  # populated later
+            'current_adu_target' : None,  # populated later
+            'astrometric_data'   : None,  # populated later
+        }
 
 
-            if self.config.get('IMAGE_SAVE_FITS'):
-                i_ref = self.image_processor.getLatestImage()
-                self.write_fit(i_ref)
+        if self.config.get('IMAGE_SAVE_FITS') or self.config.get('IMAGE_EXPORT_RAW'):
+            # The persist stage runs after the frame slot may have been
+            # released and the data may be modified in place, keep a copy
+            header = i_ref['hdulist'][0].header.copy()
+            header.remove('BZERO', ignore_missing=True)
+            header.remove('BSCALE', ignore_missing=True)
 
+            hdu = fits.PrimaryHDU(numpy.copy(i_ref['hdulist'][0].data), header=header)
+            frame['hdulist'] = fits.HDUList([hdu])
 
-            self.image_processor.calculateSqm()
 
-            self.image_processor.stack()
+        return frame
 
-            self.image_processor.debayer()
 
+    def processImage(self, frame):
+        ### Stage 2: analyze and compose
+        i_ref = frame['i_ref']
 
+        self.image_processor.insert(i_ref)
 
-            image_height, image_width = self.image_processor.image.shape[:2]
-            logger.info('Image: %d x %d', image_width, image_height)
 
+        self.image_processor.calculateSqm()
 
-            i_ref = self.image_processor.getLatestImage()
+        self.image_processor.stack()
 
-            ### IMAGE IS CALIBRATED ###
+        # metering is done before debayering
+        adu = self.image_processor.calculateAdu()
 
+        # skip the pixels outside of the crop or detection mask
+        self.image_processor.roi_crop()
 
-            if self.config.get('IMAGE_EXPORT_RAW'):
-                self.export_raw_image(i_ref)
+        self.image_processor.debayer()
 
 
-            self.image_processor.convert_16bit_to_8bit()
 
+        image_height, image_width = self.image_processor.image.shape[:2]
+        logger.info('Image: %d x %d', image_width, image_height)
 
-            #with io.open('/tmp/indi_allsky_numpy.npy', 'w+b') as f_numpy:
-            #    numpy.save(f_numpy, self.image_processor.image)
-            #logger.info('Wrote Numpy data: /tmp/indi_allsky_numpy.npy')
 
+        ### IMAGE IS CALIBRATED ###
 
-            # rotation
-            if self.config.get('IMAGE_ROTATE'):
-                try:
-                    rotate_enum = getattr(cv2, self.config['IMAGE_ROTATE'])
-                    self.image_processor.rotate(rotate_enum)
-                except AttributeError:
-                    logger.error('Unknown rotation option: %s', self.config['IMAGE_ROTATE'])
 
+        self.image_processor.convert_16bit_to_8bit()
 
-            # verticle flip
-            if self.config.get('IMAGE_FLIP_V'):
-                self.image_processor.flip(0)
 
-            # horizontal flip
-            if self.config.get('IMAGE_FLIP_H'):
-                self.image_processor.flip(1)
+        #with io.open('/tmp/indi_allsky_numpy.npy', 'w+b') as f_numpy:
+        #    numpy.save(f_numpy, self.image_processor.image)
+        #logger.info('Wrote Numpy data: /tmp/indi_allsky_numpy.npy')
 
 
-            # adu calculate (before processing)
-            adu, adu_average = self.calculate_histogram(self.image_processor.image, exposure)
+        # rotation
+        if self.config.get('IMAGE_ROTATE'):
+            try:
+                rotate_enum = getattr(cv2, self.config['IMAGE_ROTATE'])
+                self.image_processor.rotate(rotate_enum)
+            except AttributeError:
+                logger.error('Unknown rotation option: %s', self.config['IMAGE_ROTATE'])
 
 
-            # line detection
-            if self.night_v.value and self.config.get('DETECT_METEORS'):
-                self.image_processor.detectLines()
+        # verticle flip
+        if self.config.get('IMAGE_FLIP_V'):
+            self.image_processor.flip(0)
 
+        # horizontal flip
+        if self.config.get('IMAGE_FLIP_H'):
+            self.image_processor.flip(1)
 
-            # star detection
-            if self.night_v.value and self.config.get('DETECT_STARS', True):
-                self.image_processor.detectStars()
 
+        # adu calculate (before processing)
+        adu, adu_average = self.calculate_histogram(adu, i_ref['exposure'], i_ref['exp_date'])
 
-            # additional draw code
-            if self.config.get('DETECT_DRAW'):
-                self.image_processor.drawDetections()
 
+        # detection and drawing use full frame coordinates
+        if i_ref['night'] and self.config.get('DETECT_STARS', True):
+            self.image_processor.roi_expand()
+        elif self.config.get('DETECT_DRAW'):
+            self.image_processor.roi_expand()
 
-            # crop
-            if self.config.get('IMAGE_CROP_ROI'):
-                self.image_processor.crop_image()
 
+        # line detection
+        if i_ref['night'] and self.config.get('DETECT_METEORS'):
+            self.image_processor.detectLines()
 
-            # green removal
-            scnr_algo = self.config.get('SCNR_ALGORITHM')
-            if scnr_algo:
-                self.image_processor.scnr(scnr_algo)
 
+        # star detection
+        if i_ref['night'] and self.config.get('DETECT_STARS', True):
+            self.image_processor.detectStars()
 
-            # white balance
-            self.image_processor.white_balance_manual_bgr()
 
-            if self.config.get('AUTO_WB'):
-                self.image_processor.white_balance_auto_bgr()
+        # additional draw code
+        if self.config.get('DETECT_DRAW'):
+            self.image_processor.drawDetections()
 
 
-            if not self.night_v.value and self.config['DAYTIME_CONTRAST_ENHANCE']:
-                # Contrast enhancement during the day
-                self.image_processor.contrast_clahe()
-            elif self.night_v.value and self.config['NIGHT_CONTRAST_ENHANCE']:
-                # Contrast enhancement during night
-                self.image_processor.contrast_clahe()
+        # crop
+        if self.config.get('IMAGE_CROP_ROI'):
+            self.image_processor.crop_image()
 
+        self.image_processor.roi_reduce()
 
-            if self.config['IMAGE_SCALE'] and self.config['IMAGE_SCALE'] != 100:
-                self.image_processor.scale_image()
 
+        # green removal and white balance in a single pass
+        self.image_processor.color_balance()
 
-            # blur
-            #self.image_processor.median_blur()
 
-            # denoise
-            #self.image_processor.fastDenoise()
+        if not i_ref['night'] and self.config['DAYTIME_CONTRAST_ENHANCE']:
+            # Contrast enhancement during the day
+            self.image_processor.contrast_clahe()
+        elif i_ref['night'] and self.config['NIGHT_CONTRAST_ENHANCE']:
+            # Contrast enhancement during night
+            self.image_processor.contrast_clahe()
 
-            self.image_processor.image_text()
 
+        self.image_processor.roi_composite()
 
-            processing_elapsed_s = time.time() - processing_start
-            logger.info('Image processed in %0.4f s', processing_elapsed_s)
 
+        if self.config['IMAGE_SCALE'] and self.config['IMAGE_SCALE'] != 100:
+            self.image_processor.scale_image()
 
-            #task.setSuccess('Image processed')
 
-            self.write_status_json(i_ref, adu, adu_average)  # write json status file
+        # blur
+        #self.image_processor.median_blur()
 
-            latest_file, new_filename = self.write_img(self.image_processor.image, i_ref)
+        # denoise
+        #self.image_processor.fastDenoise()
 
-            if new_filename:
-                image_entry = self._miscDb.addImage(
-                    new_filename,
-                    camera_id,
-                    exp_date,
-                    exposure,
-                    exp_elapsed,
-                    self.gain_v.value,
-                    self.bin_v.value,
-                    self.sensortemp_v.value,
-                    adu,
-                    self.target_adu_found,  # stable
-                    bool(self.moonmode_v.value),
-                    self.astrometric_data['moon_phase'],
-                    night=bool(self.night_v.value),
-                    adu_roi=self.config['ADU_ROI'],
-                    calibrated=i_ref['calibrated'],
-                    sqm=i_ref['sqm_value'],
-                    stars=len(i_ref['stars']),
-                    detections=len(i_ref['lines']),
-                )
+        self.image_processor.image_text()
+
+
+        # values may change before the persist stage runs
+        frame['image'] = self.image_processor.image
+        frame['adu'] = adu
+        frame['adu_average'] = adu_average
+        frame['target_adu_found'] = self.target_adu_found
+        frame['current_adu_target'] = self.current_adu_target
+        frame['astrometric_data'] = self.astrometric_data.copy()
+
+
+        processing_elapsed_s = time.time() - frame['processing_start']
+        logger.info('Image processed in %0.4f s', processing_elapsed_s)
+
+        return frame
+
+
+    def persistImage(self, frame):
+        ### Stage 3: encode and write files
+        i_ref = frame['i_ref']
+
+
+        # the image is encoded while the other files are written
+        encode_future = self.encoder.submit(frame['image'], self.config['IMAGE_FILE_TYPE'])
+
+
+        if self.config.get('IMAGE_SAVE_FITS'):
+            frame['fits_file'] = self.write_fit(frame)
+
+
+        if self.config.get('IMAGE_EXPORT_RAW'):
+            frame['raw_file'] = self.export_raw_image(frame)
+
+
+        #task.setSuccess('Image processed')
+
+        img_bytes = encode_future.result()
+
+        del frame['image']  # not needed by the commit stage
+
+        latest_file, new_filename = self.write_img(img_bytes, i_ref)
+
+        frame['latest_file'] = latest_file
+        frame['new_filename'] = new_filename
+
+        if latest_file:
+            frame['cache_key'] = self.cache_image(img_bytes, i_ref)
+
+
+        return frame
+
+
+    def commitImage(self, frame):
+        ### Stage 4: database, status, and upload tasks
+        # Everything for the frame is added to the session and committed in
+        # one transaction, off the path of the next frame.
+        i_ref = frame['i_ref']
+
+
+        if frame.get('fits_file'):
+            self._miscDb.addFitsImage(
+                frame['fits_file'],
+                i_ref['camera_id'],
+                i_ref['exp_date'],
+                i_ref['exposure'],
+                i_ref['gain'],
+                i_ref['bin'],
+                night=i_ref['night'],
+                commit=False,
+            )
+
+
+        if frame.get('raw_file') and frame['raw_future'].exception():
+            # write failure is logged by the encoder
+            logger.error('RAW image not recorded: %s', frame['raw_file'])
+        elif frame.get('raw_file'):
+            self._miscDb.addRawImage(
+                frame['raw_file'],
+                i_ref['camera_id'],
+                i_ref['exp_date'],
+                i_ref['exposure'],
+                i_ref['gain'],
+                i_ref['bin'],
+                night=i_ref['night'],
+                commit=False,
+            )
+
+
+        if frame['new_filename']:
+            image_entry = self._miscDb.addImage(
+                frame['new_filename'],
+                i_ref['camera_id'],
+                i_ref['exp_date'],
+                i_ref['exposure'],
+                i_ref['exp_elapsed'],
+                i_ref['gain'],
+                i_ref['bin'],
+                i_ref['sensortemp'],
+                frame['adu'],
+                frame['target_adu_found'],  # stable
+                i_ref['moonmode'],
+                frame['astrometric_data']['moon_phase'],
+                night=i_ref['night'],
+                adu_roi=self.config['ADU_ROI'],
+                calibrated=i_ref['calibrated'],
+                sqm=i_ref['sqm_value'],
+                stars=len(i_ref['stars']),
+                star_stats=i_ref['star_stats'],
+                detections=len(i_ref['lines']),
+                commit=False,
+            )
+        else:
+            # images not being saved
+            image_entry = None
+
+
+        latest_file = frame['latest_file']
+
+        if latest_file:
+            # build mqtt data
+            mqtt_data = {
+                'exposure' : round(i_ref['exposure'], 6),
+                'gain'     : i_ref['gain'],
+                'bin'      : i_ref['bin'],
+                'temp'     : round(i_ref['sensortemp'], 1),
+                'sunalt'   : round(frame['astrometric_data']['sun_alt'], 1),
+                'moonalt'  : round(frame['astrometric_data']['moon_alt'], 1),
+                'moonphase': round(frame['astrometric_data']['moon_phase'], 1),
+                'moonmode' : i_ref['moonmode'],
+                'night'    : i_ref['night'],
+                'sqm'      : round(i_ref['sqm_value'], 1),
+                'stars'    : len(i_ref['stars']),
+                'latitude' : round(self.latitude_v.value, 3),
+                'longitude': round(self.longitude_v.value, 3),
+                'sidereal_time': frame['astrometric_data']['sidereal_time'],
+            }
+
+            self.mqtt_publish(latest_file, mqtt_data, cache_key=frame['cache_key'])
+
+
+            self.upload_image(frame, latest_file, image_entry=image_entry, cache_key=frame['cache_key'])
+            self.upload_metadata(frame)
+
+
+        self.write_status_json(frame)  # write json status file
+
+
+        self._db_pending_frames += 1
+
+        if self.config.get('FOCUS_MODE', False):
+            # focus mode frames are batched
+            batch_frames = int(self.config.get('DB_FOCUS_BATCH_FRAMES', 10))
+
+            if self._db_pending_frames >= batch_frames:
+                self.commitDb()
             else:
-                # images not being saved
-                image_entry = None
+                self.commitDbIdle()
+        else:
+            self.commitDb()
+
+
+        frame_elapsed_s = time.time() - frame['processing_start']
+        logger.info('Frame completed in %0.4f s', frame_elapsed_s)
+
+
+    def commitDbIdle(self):
+        # frames may stop arriving, batched rows are not held indefinitely
+        if (time.time() - self._db_last_commit) > self.db_batch_seconds:
+            self.commitDb()
+
+
+    def commitDb(self):
+        self._db_last_commit = time.time()
 
+        if not self._db_pending_frames:
+            return
+
+        commit_start = time.time()
+
+        db.session.commit()
+
+        # tasks have an id after the commit
+        for task in self._db_pending_tasks:
+            self.upload_q.put({'task_id' : task.id})
+
+        commit_elapsed_s = time.time() - commit_start
+        logger.info('Committed %d frames, %d tasks in %0.4f s', self._db_pending_frames, len(self._db_pending_tasks), commit_elapsed_s)
+
+        self._db_pending_frames = 0
+        self._db_pending_tasks = list()
+
+
+    def _addUploadTask(self, jobdata):
+        upload_task = IndiAllSkyDbTaskQueueTable(
+            queue=TaskQueueQueue.UPLOAD,
+            state=TaskQueueState.QUEUED,
+            data=jobdata,
+        )
+        db.session.add(upload_task)
+
+        # the upload worker is notified after the commit
+        self._db_pending_tasks.append(upload_task)
 
-            if latest_file:
-                # build mqtt data
-                mqtt_data = {
-                    'exposure' : round(exposure, 6),
-                    'gain'     : self.gain_v.value,
-                    'bin'      : self.bin_v.value,
-                    'temp'     : round(self.sensortemp_v.value, 1),
-                    'sunalt'   : round(self.astrometric_data['sun_alt'], 1),
-                    'moonalt'  : round(self.astrometric_data['moon_alt'], 1),
-                    'moonphase': round(self.astrometric_data['moon_phase'], 1),
-                    'moonmode' : bool(self.moonmode_v.value),
-                    'night'    : bool(self.night_v.value),
-                    'sqm'      : round(i_ref['sqm_value'], 1),
-                    'stars'    : len(i_ref['stars']),
-                    'latitude' : round(self.latitude_v.value, 3),
-                    'longitude': round(self.longitude_v.value, 3),
-                    'sidereal_time': self.astrometric_data['sidereal_time'],
-                }
 
-                self.mqtt_publish(latest_file, mqtt_data)
+    def cache_image(self, img_bytes, i_ref):
+        if not self.image_cache:
+            return None
 
+        if not self.config.get('FILETRANSFER', {}).get('UPLOAD_IMAGE') and not self.config.get('MQTTPUBLISH', {}).get('ENABLE'):
+            # nothing will read the image
+            return None
 
-                self.upload_image(i_ref, latest_file, image_entry=image_entry)
-                self.upload_metadata(i_ref, adu, adu_average)
+        # the upload worker reads the encoded image from the cache instead of latest_file,
+        # which may already have been replaced by the next image
+        cache_key = 'ccd{0:d}_{1:s}'.format(i_ref['camera_id'], i_ref['exp_date'].strftime('%Y%m%d_%H%M%S'))
 
+        if not self.image_cache.put(cache_key, img_bytes):
+            return None
 
-    def upload_image(self, i_ref, latest_file, image_entry=None):
+        return cache_key
+
+
+    def upload_image(self, frame, latest_file, image_entry=None, cache_key=None):
         ### upload images
         if not self.config.get('FILETRANSFER', {}).get('UPLOAD_IMAGE'):
             #logger.warning('Image uploading disabled')
             return
 
-        if (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
-            next_image = int(self.config['FILETRANSFER']['UPLOAD_IMAGE']) - (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE']))
+        i_ref = frame['i_ref']
+
+        if (frame['image_count'] % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
+            next_image = int(self.config['FILETRANSFER']['UPLOAD_IMAGE']) - (frame['image_count'] % int(self.config['FILETRANSFER']['UPLOAD_IMAGE']))
             logger.info('Next image upload in %d images (%d s)', next_image, int(self.config['EXPOSURE_PERIOD'] * next_image))
             return
 
@@ -433,24 +802,17 @@ class ImageWorker(Process):
             'action'      : 'upload',
             'local_file'  : str(latest_file),
             'remote_file' : str(remote_file_p),
+            'cache_key'   : cache_key,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._addUploadTask(jobdata)
 
         if image_entry:
             # image was not saved
-            self._miscDb.addUploadedFlag(image_entry)
+            self._miscDb.addUploadedFlag(image_entry, commit=False)
 
 
-    def upload_metadata(self, i_ref, adu, adu_average):
+    def upload_metadata(self, frame):
         ### upload images
         if not self.config.get('FILETRANSFER', {}).get('UPLOAD_METADATA'):
             #logger.warning('Metadata uploading disabled')
@@ -460,8 +822,10 @@ class ImageWorker(Process):
             logger.warning('Metadata uploading disabled when image upload is disabled')
             return
 
+        i_ref = frame['i_ref']
+
         ### Only uploading metadata if image uploading is enabled
-        if (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
+        if (frame['image_count'] % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])) != 0:
             #next_image = int(self.config['FILETRANSFER']['UPLOAD_IMAGE']) - (self.image_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE']))
             #logger.info('Next image upload in %d images (%d s)', next_image, int(self.config['EXPOSURE_PERIOD'] * next_image))
             return
@@ -469,15 +833,15 @@ class ImageWorker(Process):
 
         metadata = {
             'device'              : self.config['CCD_NAME'],
-            'night'               : self.night_v.value,
-            'temp'                : self.sensortemp_v.value,
-            'gain'                : self.gain_v.value,
+            'night'               : int(i_ref['night']),
+            'temp'                : i_ref['sensortemp'],
+            'gain'                : i_ref['gain'],
             'exposure'            : i_ref['exposure'],
-            'stable_exposure'     : int(self.target_adu_found),
+            'stable_exposure'     : int(frame['target_adu_found']),
             'target_adu'          : self.target_adu,
-            'current_adu_target'  : self.current_adu_target,
-            'current_adu'         : adu,
-            'adu_average'         : adu_average,
+            'current_adu_target'  : frame['current_adu_target'],
+            'current_adu'         : frame['adu'],
+            'adu_average'         : frame['adu_average'],
             'sqm'                 : i_ref['sqm_value'],
             'stars'               : len(i_ref['stars']),
             'time'                : i_ref['exp_date'].strftime('%s'),
@@ -485,7 +849,7 @@ class ImageWorker(Process):
             'stars_data'          : self.getStarsData(i_ref['camera_id']),
             'latitude'            : self.latitude_v.value,
             'longitude'           : self.longitude_v.value,
-            'sidereal_time'       : self.astrometric_data['sidereal_time'],
+            'sidereal_time'       : frame['astrometric_data']['sidereal_time'],
         }
 
 
@@ -519,18 +883,10 @@ class ImageWorker(Process):
             'remove_local' : True,
         }
 
-        upload_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._addUploadTask(jobdata)
 
 
-    def mqtt_publish(self, latest_file, mq_data):
+    def mqtt_publish(self, latest_file, mq_data, cache_key=None):
         if not self.config.get('MQTTPUBLISH', {}).get('ENABLE'):
             #logger.warning('MQ publishing disabled')
             return
@@ -541,18 +897,11 @@ class ImageWorker(Process):
         jobdata = {
             'action'      : 'mqttpub',
             'local_file'  : str(latest_file),
+            'cache_key'   : cache_key,
             'mq_data'     : mq_data,
         }
 
-        mqtt_task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(mqtt_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : mqtt_task.id})
+        self._addUploadTask(jobdata)
 
 
     def getSqmData(self, camera_id):
@@ -605,10 +954,12 @@ class ImageWorker(Process):
         return stars_data
 
 
-    def write_fit(self, i_ref):
+    def write_fit(self, frame):
+        i_ref = frame['i_ref']
+
         f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
 
-        i_ref['hdulist'].writeto(f_tmpfile)
+        frame['hdulist'].writeto(f_tmpfile)
 
         f_tmpfile.flush()
         f_tmpfile.close()
@@ -616,7 +967,7 @@ class ImageWorker(Process):
 
         date_str = i_ref['exp_date'].strftime('%Y%m%d_%H%M%S')
         # raw light
-        folder = self.getImageFolder(i_ref['exp_date'])
+        folder = self.getImageFolder(i_ref['exp_date'], i_ref['night'])
         filename = folder.joinpath(self.filename_t.format(
             i_ref['camera_id'],
             date_str,
@@ -624,17 +975,6 @@ class ImageWorker(Process):
         ))
 
 
-        self._miscDb.addFitsImage(
-            filename,
-            i_ref['camera_id'],
-            i_ref['exp_date'],
-            i_ref['exposure'],
-            self.gain_v.value,
-            self.bin_v.value,
-            night=bool(self.night_v.value),
-        )
-
-
         file_dir = filename.parent
         if not file_dir.exists():
             file_dir.mkdir(mode=0o755, parents=True)
@@ -644,7 +984,7 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
-            return
+            return filename
 
         shutil.copy2(f_tmpfile.name, str(filename))  # copy file in place
         filename.chmod(0o644)
@@ -653,8 +993,10 @@ class ImageWorker(Process):
 
         logger.info('Finished writing fit file')
 
+        return filename
 
-    def export_raw_image(self, i_ref):
+
+    def export_raw_image(self, frame):
         if not self.config.get('IMAGE_EXPORT_RAW'):
             return
 
@@ -662,7 +1004,9 @@ class ImageWorker(Process):
             logger.error('IMAGE_EXPORT_FOLDER not defined')
             return
 
-        data = i_ref['hdulist'][0].data
+        i_ref = frame['i_ref']
+
+        data = frame['hdulist'][0].data
 
         if i_ref['image_bitpix'] == 8:
             # nothing to scale
@@ -702,9 +1046,14 @@ class ImageWorker(Process):
             raise Exception('Unsupported bit depth')
 
 
+        if scaled_data is data:
+            # the frame may be reused before the encoder is finished
+            scaled_data = data.copy()
+
+
         export_dir = Path(self.config['IMAGE_EXPORT_FOLDER'])
 
-        if self.night_v.value:
+        if i_ref['night']:
             # images should be written to previous day's folder until noon
             day_ref = i_ref['exp_date'] - timedelta(hours=12)
             timeofday_str = 'night'
@@ -735,84 +1084,43 @@ class ImageWorker(Process):
         ))
 
 
-        self._miscDb.addRawImage(
-            filename,
-            i_ref['camera_id'],
-            i_ref['exp_date'],
-            i_ref['exposure'],
-            self.gain_v.value,
-            self.bin_v.value,
-            night=bool(self.night_v.value),
-        )
-
-
         logger.info('RAW filename: %s', filename)
 
-        write_img_start = time.time()
-
-        if self.config['IMAGE_EXPORT_RAW'] in ('png',):
-            cv2.imwrite(str(filename), scaled_data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_EXPORT_RAW'] in ('tif', 'tiff'):
-            cv2.imwrite(str(filename), scaled_data, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
-        else:
+        if self.config['IMAGE_EXPORT_RAW'] not in ('png', 'tif', 'tiff'):
             raise Exception('Unknown file type: %s', self.config['IMAGE_EXPORT_RAW'])
 
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Raw image written in %0.4f s', write_img_elapsed_s)
-
+        # the commit stage waits for the write before the file is recorded
+        frame['raw_future'] = self.encoder.submitWrite(scaled_data, self.config['IMAGE_EXPORT_RAW'], filename)
 
-    def write_img(self, data, i_ref):
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
-        f_tmpfile.close()
+        return filename
 
-        tmpfile_name = Path(f_tmpfile.name)
-        tmpfile_name.unlink()  # remove tempfile, will be reused below
 
+    def write_img(self, img_bytes, i_ref):
+        # The encoded image is written once.  The timelapse file is renamed into
+        # place and the latest file is swapped in as a link to it, so the web
+        # server never sees a partially written file.
 
         write_img_start = time.time()
 
-        # write to temporary file
-        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            cv2.imwrite(str(tmpfile_name), data, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
-        else:
-            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
-
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
-
-
-        ### Always write the latest file for web access
         latest_file = self.image_dir.joinpath('latest.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
 
-        try:
-            latest_file.unlink()
-        except FileNotFoundError:
-            pass
-
-        shutil.copy2(str(tmpfile_name), str(latest_file))
-        latest_file.chmod(0o644)
-
 
         ### disable timelapse images in focus mode
         if self.config.get('FOCUS_MODE', False):
             logger.warning('Focus mode enabled, not saving timelapse image')
-            tmpfile_name.unlink()  # cleanup temp file
+            self._writeAtomic(latest_file, img_bytes)
             return None, None
 
 
         ### Do not write daytime image files if daytime timelapse is disabled
-        if not self.night_v.value and not self.config['DAYTIME_TIMELAPSE']:
+        if not i_ref['night'] and not self.config['DAYTIME_TIMELAPSE']:
             logger.info('Daytime timelapse is disabled')
-            tmpfile_name.unlink()  # cleanup temp file
+            self._writeAtomic(latest_file, img_bytes)
             return latest_file, None
 
 
         ### Write the timelapse file
-        folder = self.getImageFolder(i_ref['exp_date'])
+        folder = self.getImageFolder(i_ref['exp_date'], i_ref['night'])
 
         date_str = i_ref['exp_date'].strftime('%Y%m%d_%H%M%S')
         filename = folder.joinpath(self.filename_t.format(i_ref['camera_id'], date_str, self.config['IMAGE_FILE_TYPE']))
@@ -821,54 +1129,121 @@ class ImageWorker(Process):
 
         if filename.exists():
             logger.error('File exists: %s (skipping)', filename)
+            self._writeAtomic(latest_file, img_bytes)
             return latest_file, None
 
-        shutil.copy2(str(tmpfile_name), str(filename))
-        filename.chmod(0o644)
+        self._writeAtomic(filename, img_bytes)
 
 
-        ### Cleanup
-        tmpfile_name.unlink()
+        ### Always write the latest file for web access
+        self._linkLatest(filename, latest_file, img_bytes)
+
 
-        #logger.info('Finished writing files')
+        write_img_elapsed_s = time.time() - write_img_start
+        logger.info('Image written in %0.4f s', write_img_elapsed_s)
 
         return latest_file, filename
 
 
-    def write_status_json(self, i_ref, adu, adu_average):
+    def _writeAtomic(self, filename, img_bytes):
+        # temp file in the same folder, a rename does not cross filesystems
+        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', dir=str(filename.parent), prefix='.{0:s}_'.format(filename.name), suffix='.tmp', delete=False)
+
+        tmpfile_name = Path(f_tmpfile.name)
+
+        try:
+            f_tmpfile.write(img_bytes)
+            f_tmpfile.close()
+
+            tmpfile_name.chmod(0o644)
+            os.replace(str(tmpfile_name), str(filename))
+        except OSError:
+            f_tmpfile.close()
+
+            try:
+                tmpfile_name.unlink()
+            except FileNotFoundError:
+                pass
+
+            raise
+
+
+    def _linkLatest(self, filename, latest_file, img_bytes):
+        # the link is created beside the latest file and renamed over it
+        tmp_link = latest_file.parent.joinpath('.{0:s}.tmp'.format(latest_file.name))
+
+        try:
+            tmp_link.unlink()
+        except FileNotFoundError:
+            pass
+
+
+        try:
+            os.link(str(filename), str(tmp_link))
+            os.replace(str(tmp_link), str(latest_file))
+            return
+        except OSError as e:
+            # hard links are not possible across filesystems
+            logger.debug('Unable to hard link latest file: %s', str(e))
+
+
+        try:
+            os.symlink(os.path.relpath(str(filename), str(latest_file.parent)), str(tmp_link))
+            os.replace(str(tmp_link), str(latest_file))
+            return
+        except OSError as e:
+            # vfat
+            logger.warning('Unable to link latest file, writing a copy: %s', str(e))
+
+
+        self._writeAtomic(latest_file, img_bytes)
+
+
+    def write_status_json(self, frame):
+        i_ref = frame['i_ref']
+
         status = {
             'name'                : 'indi_json',
             'class'               : 'ccd',
             'device'              : self.config['CCD_NAME'],
-            'night'               : self.night_v.value,
-            'temp'                : self.sensortemp_v.value,
-            'gain'                : self.gain_v.value,
+            'night'               : int(i_ref['night']),
+            'temp'                : i_ref['sensortemp'],
+            'gain'                : i_ref['gain'],
             'exposure'            : i_ref['exposure'],
-            'stable_exposure'     : int(self.target_adu_found),
+            'stable_exposure'     : int(frame['target_adu_found']),
             'target_adu'          : self.target_adu,
-            'current_adu_target'  : self.current_adu_target,
-            'current_adu'         : adu,
-            'adu_average'         : adu_average,
+            'current_adu_target'  : frame['current_adu_target'],
+            'current_adu'         : frame['adu'],
+            'adu_average'         : frame['adu_average'],
             'sqm'                 : i_ref['sqm_value'],
             'stars'               : len(i_ref['stars']),
             'time'                : i_ref['exp_date'].strftime('%s'),
             'latitude'            : self.latitude_v.value,
             'longitude'           : self.longitude_v.value,
+            'encode_s'            : self.encoder.elapsed,
         }
 
 
         indi_allsky_status_p = Path('/var/lib/indi-allsky/indi_allsky_status.json')
 
-        with io.open(str(indi_allsky_status_p), 'w') as f_indi_status:
-            json.dump(status, f_indi_status, indent=4)
-            f_indi_status.flush()
-            f_indi_status.close()
+        # readers never see a partial file
+        f_tmp_status = tempfile.NamedTemporaryFile(mode='w', dir=str(indi_allsky_status_p.parent), prefix='.indi_allsky_status_', suffix='.tmp', delete=False)
+
+        try:
+            json.dump(status, f_tmp_status, indent=4)
+            f_tmp_status.close()
 
-        indi_allsky_status_p.chmod(0o644)
+            tmp_status_p = Path(f_tmp_status.name)
+            tmp_status_p.chmod(0o644)
+            os.replace(str(tmp_status_p), str(indi_allsky_status_p))
+        except OSError:
+            f_tmp_status.close()
+            Path(f_tmp_status.name).unlink()
+            raise
 
 
-    def getImageFolder(self, exp_date):
-        if self.night_v.value:
+    def getImageFolder(self, exp_date, night):
+        if night:
             # images should be written to previous day's folder until noon
             day_ref = exp_date - timedelta(hours=12)
             timeofday_str = 'night'
@@ -891,29 +1266,7 @@ class ImageWorker(Process):
         return hour_folder
 
 
-    def calculate_histogram(self, data, exposure):
-        if isinstance(self._adu_mask, type(None)):
-            # This only needs to be done once if a mask is not provided
-            self._generateAduMask(data)
-
-
-        if len(data.shape) == 2:
-            # mono
-            m_avg = cv2.mean(src=data, mask=self._adu_mask)[0]
-
-            logger.info('Greyscale mean: %0.2f', m_avg)
-
-            adu = m_avg
-        else:
-            data_mono = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
-
-            m_avg = cv2.mean(src=data_mono, mask=self._adu_mask)[0]
-
-            logger.info('Greyscale mean: %0.2f', m_avg)
-
-            adu = m_avg
-
-
+    def calculate_histogram(self, adu, exposure, exp_date):
         if adu <= 0.0:
             # ensure we do not divide by zero
             logger.warning('Zero average, setting a default of 0.1')
@@ -923,167 +1276,127 @@ class ImageWorker(Process):
         logger.info('Brightness average: %0.2f', adu)
 
 
-        # Brightness when the sun is in view (very short exposures) can change drastically when clouds pass through the view
-        # Setting a deviation that is too short can cause exposure flapping
-        if exposure < 0.001000:
-            # DAY
-            adu_dev = float(self.config.get('TARGET_ADU_DEV_DAY', 20))
-
-            target_adu_min = self.target_adu - adu_dev
-            target_adu_max = self.target_adu + adu_dev
-            current_adu_target_min = self.current_adu_target - adu_dev
-            current_adu_target_max = self.current_adu_target + adu_dev
+        new_exposure, adu_average = self.exposure_controller.calculate(exposure, adu, exp_date)
 
-            exp_scale_factor = 0.50  # scale exposure calculation
-            history_max_vals = 6     # number of entries to use to calculate average
-        else:
-            # NIGHT
-            adu_dev = float(self.config.get('TARGET_ADU_DEV', 10))
+        self.target_adu_found = self.exposure_controller.stable
+        self.current_adu_target = self.exposure_controller.current_adu_target
 
-            target_adu_min = self.target_adu - adu_dev
-            target_adu_max = self.target_adu + adu_dev
-            current_adu_target_min = self.current_adu_target - adu_dev
-            current_adu_target_max = self.current_adu_target + adu_dev
 
-            exp_scale_factor = 1.0  # scale exposure calculation
-            history_max_vals = 6    # number of entries to use to calculate average
+        if not isinstance(new_exposure, type(None)):
+            logger.warning('New calculated exposure: %0.6f', new_exposure)
+            with self.exposure_v.get_lock():
+                self.exposure_v.value = new_exposure
 
 
+        return adu, adu_average
 
-        if not self.target_adu_found:
-            self.recalculate_exposure(exposure, adu, target_adu_min, target_adu_max, exp_scale_factor)
-            return adu, 0.0
 
+    def _load_detection_mask(self):
+        detect_mask = self.config.get('DETECT_MASK', '')
 
-        self.hist_adu.append(adu)
-        self.hist_adu = self.hist_adu[(history_max_vals * -1):]  # remove oldest values, up to history_max_vals
-
-        logger.info('Current target ADU: %0.2f (%0.2f/%0.2f)', self.current_adu_target, current_adu_target_min, current_adu_target_max)
-        logger.info('Current ADU history: (%d) [%s]', len(self.hist_adu), ', '.join(['{0:0.2f}'.format(x) for x in self.hist_adu]))
-
-
-        adu_average = functools.reduce(lambda a, b: a + b, self.hist_adu) / len(self.hist_adu)
-        logger.info('ADU average: %0.2f', adu_average)
-
-
-        ### Need at least x values to continue
-        if len(self.hist_adu) < history_max_vals:
-            return adu, 0.0
+        if not detect_mask:
+            logger.warning('No detection mask defined')
+            return
 
 
-        ### only change exposure when 70% of the values exceed the max or minimum
-        if adu_average > current_adu_target_max:
-            logger.warning('ADU increasing beyond limits, recalculating next exposure')
-            self.target_adu_found = False
-        elif adu_average < current_adu_target_min:
-            logger.warning('ADU decreasing beyond limits, recalculating next exposure')
-            self.target_adu_found = False
+        detect_mask_p = Path(detect_mask)
 
-        return adu, adu_average
+        try:
+            if not detect_mask_p.exists():
+                logger.error('%s does not exist', detect_mask_p)
+                return
 
 
-    def recalculate_exposure(self, exposure, adu, target_adu_min, target_adu_max, exp_scale_factor):
+            if not detect_mask_p.is_file():
+                logger.error('%s is not a file', detect_mask_p)
+                return
 
-        # Until we reach a good starting point, do not calculate a moving average
-        if adu <= target_adu_max and adu >= target_adu_min:
-            logger.warning('Found target value for exposure')
-            self.current_adu_target = copy.copy(adu)
-            self.target_adu_found = True
-            self.hist_adu = []
+        except PermissionError as e:
+            logger.error(str(e))
             return
 
+        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
+        if isinstance(mask_data, type(None)):
+            logger.error('%s is not a valid image', detect_mask_p)
+            return
 
-        # Scale the exposure up and down based on targets
-        if adu > target_adu_max:
-            new_exposure = exposure - ((exposure - (exposure * (self.target_adu / adu))) * exp_scale_factor)
-        elif adu < target_adu_min:
-            new_exposure = exposure - ((exposure - (exposure * (self.target_adu / adu))) * exp_scale_factor)
-        else:
-            new_exposure = exposure
 
+        ### any compression artifacts will be set to black
+        #mask_data[mask_data < 255] = 0  # did not quite work
 
 
-        # Do not exceed the limits
-        if new_exposure < self.config['CCD_EXPOSURE_MIN']:
-            new_exposure = self.config['CCD_EXPOSURE_MIN']
-        elif new_exposure > self.config['CCD_EXPOSURE_MAX']:
-            new_exposure = self.config['CCD_EXPOSURE_MAX']
+        return mask_data
 
 
-        logger.warning('New calculated exposure: %0.6f', new_exposure)
-        with self.exposure_v.get_lock():
-            self.exposure_v.value = new_exposure
 
+class ImageWorkerStage(Thread):
 
-    def _generateAduMask(self, img):
-        logger.info('Generating mask based on ADU_ROI')
+    idle_timeout = 5.0  # seconds between idle_func calls without frames
 
-        image_height, image_width = img.shape[:2]
+    def __init__(self, name, app, func, in_q, out_q, idle_func=None, stop_func=None):
+        super(ImageWorkerStage, self).__init__()
 
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+        self.name = 'ImageStage-{0:s}'.format(name)
+        self.daemon = True
 
-        adu_roi = self.config.get('ADU_ROI', [])
+        self.app = app
+        self.func = func
+        self.idle_func = idle_func
+        self.stop_func = stop_func
 
-        try:
-            x1 = int(adu_roi[0] / self.bin_v.value)
-            y1 = int(adu_roi[1] / self.bin_v.value)
-            x2 = int(adu_roi[2] / self.bin_v.value)
-            y2 = int(adu_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for ADU calculations')
-            x1 = int((image_width / 2) - (image_width / 3))
-            y1 = int((image_height / 2) - (image_height / 3))
-            x2 = int((image_width / 2) + (image_width / 3))
-            y2 = int((image_height / 2) + (image_height / 3))
-
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
-        )
+        self.in_q = in_q
+        self.out_q = out_q
 
-        self._adu_mask = mask
+        self.error = None
 
 
-    def _load_detection_mask(self):
-        detect_mask = self.config.get('DETECT_MASK', '')
+    def run(self):
+        # each thread needs its own app context for database access
+        with self.app.app_context():
+            try:
+                self.saferun()
+            except Exception as e:
+                self.error = (str(e), traceback.format_exc())
+            finally:
+                # also runs when the stage fails
+                if self.stop_func:
+                    try:
+                        self.stop_func()
+                    except Exception as e:
+                        logger.error('%s stop failed: %s', self.name, str(e))
 
-        if not detect_mask:
-            logger.warning('No detection mask defined')
-            return
 
+    def saferun(self):
+        while True:
+            try:
+                frame = self.in_q.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                if self.idle_func:
+                    self.idle_func()
 
-        detect_mask_p = Path(detect_mask)
+                continue
 
-        try:
-            if not detect_mask_p.exists():
-                logger.error('%s does not exist', detect_mask_p)
-                return
 
+            if isinstance(frame, type(None)):
+                # stop marker
+                if self.out_q:
+                    self.out_q.put(None)
 
-            if not detect_mask_p.is_file():
-                logger.error('%s is not a file', detect_mask_p)
                 return
 
-        except PermissionError as e:
-            logger.error(str(e))
-            return
 
-        mask_data = cv2.imread(str(detect_mask_p), cv2.IMREAD_GRAYSCALE)  # mono
-        if isinstance(mask_data, type(None)):
-            logger.error('%s is not a valid image', detect_mask_p)
-            return
+            logger.info('%s queue depth: %d', self.name, self.in_q.qsize())
 
+            stage_start = time.time()
 
-        ### any compression artifacts will be set to black
-        #mask_data[mask_data < 255] = 0  # did not quite work
+            frame = self.func(frame)
 
+            stage_elapsed_s = time.time() - stage_start
+            logger.info('%s: %0.4f s', self.name, stage_elapsed_s)
 
-        return mask_data
+
+            if self.out_q:
+                self.out_q.put(frame)
 
 
 
@@ -1091,8 +1404,15 @@ class ImageProcessor(object):
 
     dark_temperature_range = 5.0  # dark must be within this range
 
+    master_dark_cache_size = 128 * 1024 * 1024  # bytes
+    master_dark_cache_temp_step = 1.0  # temperature bucket for cached master darks
+
     registration_exposure_thresh = 5.0
 
+    bit_depth_sample_step = 3  # odd step samples every color of the bayer pattern
+
+    roi_debayer_margin = 2  # pixels kept around the region of interest for debayering
+
     __cfa_bgr_map = {
         'GRBG' : cv2.COLOR_BAYER_GB2BGR,
         'RGGB' : cv2.COLOR_BAYER_BG2BGR,
@@ -1123,6 +1443,7 @@ class ImageProcessor(object):
         moonmode_v,
         astrometric_data,
         mask=None,
+        frame_ring=None,
     ):
         self.config = config
 
@@ -1143,23 +1464,64 @@ class ImageProcessor(object):
 
         self._detection_mask = mask
 
+        # region of interest in the final image orientation, computed once per frame size
+        self._roi = None
+        self._roi_key = None
+        self._roi_state = None  # None, 'roi' when the image only contains the region, 'full' when composited
+
+        # detection pyramid of the current frame
+        self._pyramid = None
+
+        self.frame_ring = frame_ring
+
         self.focus_mode = self.config.get('FOCUS_MODE', False)
 
+        # bit depth from the config or camera, otherwise tracked from the image data
+        self._camera_bit_depth = self._getCameraBitDepth()
+        self._tracked_bit_depth = dict()  # keyed by bits per pixel
+
         self.stack_method = self.config.get('IMAGE_STACK_METHOD', 'average')
         self.stack_count = self.config.get('IMAGE_STACK_COUNT', 1)
 
         # contains the current stacked image
         self._image = None
 
+        # merged dark and bad pixel maps, least recently used first
+        self._master_dark_cache = collections.OrderedDict()
+        self._master_dark_cache_bytes = 0
+
+        # in memory index of calibration frames
+        self._dark_library = IndiAllSkyDarkLibrary(IndiAllSkyDbDarkFrameTable)
+        self._bpm_library = IndiAllSkyDarkLibrary(IndiAllSkyDbBadPixelMapTable)
+        self._calibration_generation = None
+
+        self._miscDb = miscDb(self.config)
+
+        # persistent for the life of the image worker, started in the worker process
+        self._registration_pool = None
+
         # contains the raw image data, data will be newest to oldest
         self.image_list = [None]  # element will be removed on first image
 
+        # incremental stacking, frames are added and removed as the image list changes
+        if self.stack_method in ('average', 'mean'):
+            self._stack_accumulator = ImageStackAccumulator()
+        elif self.stack_method == 'rolling_maximum':
+            self._stack_accumulator = ImageStackRollingExtremum(numpy.maximum)
+        elif self.stack_method == 'rolling_minimum':
+            self._stack_accumulator = ImageStackRollingExtremum(numpy.minimum)
+        else:
+            self._stack_accumulator = None
+
         self._orb = IndiAllskyOrbGenerator(self.config)
         self._sqm = IndiAllskySqm(self.config, self.bin_v, mask=None)
         self._stars = IndiAllSkyStars(self.config, self.bin_v, mask=self._detection_mask)
         self._lineDetect = IndiAllskyDetectLines(self.config, self.bin_v, mask=self._detection_mask)
         self._draw = IndiAllSkyDraw(self.config, self.bin_v, mask=self._detection_mask)
-        self._scnr = IndiAllskyScnr(self.config)
+        self._color_balance = IndiAllSkyColorBalance(self.config)
+        self._stretch = IndiAllSkyStretch(self.config)
+        self._contrast = IndiAllSkyContrastEnhance(self.config)
+        self._adu_meter = IndiAllSkyAduMeter(self.config, self.bin_v, mask=self._detection_mask)
 
 
 
@@ -1182,20 +1544,10 @@ class ImageProcessor(object):
 
 
 
-    def add(self, filename, exposure, exp_date, exp_elapsed, camera_id):
+    def load(self, filename, exposure, exp_date, exp_elapsed, camera_id, frame_state):
         filename_p = Path(filename)
 
 
-        # clear old data as soon as possible
-        self.image = None  # clear current data
-        if self.night_v.value:
-            if len(self.image_list) == self.stack_count:
-                self.image_list.pop()  # remove last element
-        else:
-            # daytime
-            self.image_list.clear()  # daytime only has one image
-
-
         indi_rgb = True  # INDI returns array in the wrong order for cv2
 
         ### Open file
@@ -1242,8 +1594,8 @@ class ImageProcessor(object):
             hdulist[0].header['EXPTIME'] = float(exposure)
             hdulist[0].header['XBINNING'] = 1
             hdulist[0].header['YBINNING'] = 1
-            hdulist[0].header['GAIN'] = float(self.gain_v.value)
-            hdulist[0].header['CCD-TEMP'] = self.sensortemp_v.value
+            hdulist[0].header['GAIN'] = float(frame_state['gain'])
+            hdulist[0].header['CCD-TEMP'] = frame_state['sensortemp']
             hdulist[0].header['BITPIX'] = 16
             hdulist[0].header['SITELAT'] = self.latitude_v.value
             hdulist[0].header['SITELONG'] = self.longitude_v.value
@@ -1261,6 +1613,33 @@ class ImageProcessor(object):
             image_bayerpat = hdulist[0].header.get('BAYERPAT')
 
 
+        filename_p.unlink()  # no longer need the original file
+
+
+        return self._load(hdulist, image_bitpix, image_bayerpat, indi_rgb, exposure, exp_date, exp_elapsed, camera_id, frame_state)
+
+
+    def loadFrame(self, frame_slot, exposure, exp_date, exp_elapsed, camera_id, frame_state):
+        # the data is a view of the shared memory slot, no copy is made
+        data, frame_meta = self.frame_ring.get(frame_slot)
+
+        header = fits.Header.fromstring(frame_meta['header'])
+
+        # data is already scaled
+        header.remove('BZERO', ignore_missing=True)
+        header.remove('BSCALE', ignore_missing=True)
+
+        image_bitpix = header['BITPIX']
+        image_bayerpat = header.get('BAYERPAT')
+
+        hdu = fits.PrimaryHDU(data, header=header)
+        hdulist = fits.HDUList([hdu])
+
+
+        return self._load(hdulist, image_bitpix, image_bayerpat, True, exposure, exp_date, exp_elapsed, camera_id, frame_state, frame_slot=frame_slot)
+
+
+    def _load(self, hdulist, image_bitpix, image_bayerpat, indi_rgb, exposure, exp_date, exp_elapsed, camera_id, frame_state, frame_slot=None):
         # Override these
 
         hdulist[0].header['OBJECT'] = 'AllSky'
@@ -1291,9 +1670,6 @@ class ImageProcessor(object):
         #logger.info('Final HDU Header = %s', pformat(hdulist[0].header))
 
 
-        filename_p.unlink()  # no longer need the original file
-
-
         logger.info('Image bits: %d, cfa: %s', image_bitpix, str(image_bayerpat))
 
 
@@ -1312,7 +1688,7 @@ class ImageProcessor(object):
                 pass
 
 
-        image_bit_depth = self._detectBitDepth(hdulist)
+        image_bit_depth = self._detectBitDepth(hdulist, image_bitpix)
 
 
         image_data = {
@@ -1326,24 +1702,121 @@ class ImageProcessor(object):
             'image_bayerpat'   : image_bayerpat,
             'image_bit_depth'  : image_bit_depth,
             'indi_rgb'         : indi_rgb,
+            'night'            : frame_state['night'],
+            'gain'             : frame_state['gain'],
+            'bin'              : frame_state['bin'],
+            'sensortemp'       : frame_state['sensortemp'],
+            'moonmode'         : frame_state['moonmode'],
             'sqm_value'        : None,    # populated later
             'lines'            : list(),  # populated later
             'stars'            : list(),  # populated later
+            'star_stats'       : dict(),  # populated later
+            'frame_slot'       : frame_slot,
         }
 
+        return image_data
+
+
+    def insert(self, i_ref):
+        # clear old data as soon as possible
+        self._expireImages(i_ref['night'])
+
+        self.image_list.insert(0, i_ref)  # new image is first in list
+
+        self._pyramid = None
+
+
+    def _expireImages(self, night):
+        self.image = None  # clear current data
+
+        if night:
+            if len(self.image_list) == self.stack_count:
+                i_ref = self.image_list.pop()  # remove last element
+
+                if self._stack_accumulator:
+                    # must be removed from the stack before the data is released
+                    self._stack_accumulator.remove(i_ref)
+
+                self._releaseFrame(i_ref)
+        else:
+            # daytime
+            if self._stack_accumulator:
+                self._stack_accumulator.reset()
+
+            for i_ref in self.image_list:
+                self._releaseFrame(i_ref)
+
+            self.image_list.clear()  # daytime only has one image
+
+
+    def _releaseFrame(self, i_ref):
+        if isinstance(i_ref, type(None)):
+            return
+
+        if self._registration_pool:
+            self._registration_pool.releaseFrame(i_ref)
 
-        self.image_list.insert(0, image_data)  # new image is first in list
+        frame_slot = i_ref.get('frame_slot')
+        if isinstance(frame_slot, type(None)):
+            return
+
+        # drop the reference to the shared memory before the slot is reused
+        i_ref['hdulist'][0].data = None
+        self.frame_ring.release(frame_slot)
+
+
+    def startRegistration(self, processes=True):
+        if self._registration_pool:
+            return
+
+        # only imported when alignment is enabled
+        from . import registration
+
+        if not processes:
+            # processes must not be forked once threads are running
+            logger.warning('Registration processes were not started, registering in the image worker')
+            self._registration_pool = registration.IndiAllSkyRegistrationLocal()
+        elif registration.shared_memory:
+            self._registration_pool = registration.IndiAllSkyRegistrationPool(self.config.get('IMAGE_STACK_ALIGN_PROCESSES', 2))
+        else:
+            logger.warning('Registration processes require python 3.8, registering in the image worker')
+            self._registration_pool = registration.IndiAllSkyRegistrationLocal()
+
+        self._registration_pool.start()
+
+
+    def shutdown(self):
+        self._contrast.shutdown()
+
+        if not self._registration_pool:
+            return
+
+        for i_ref in self.image_list:
+            if isinstance(i_ref, type(None)):
+                continue
+
+            self._registration_pool.releaseFrame(i_ref)
+
+        self._registration_pool.shutdown()
+        self._registration_pool = None
+
+
+    def _detectBitDepth(self, hdulist, image_bitpix):
+        if image_bitpix == 8:
+            return 8
+
+        if self._camera_bit_depth:
+            return self._camera_bit_depth
 
 
-    def _detectBitDepth(self, hdulist):
         ### This will need some rework if cameras return signed int data
-        max_val = numpy.amax(hdulist[0].data)
-        logger.info('Image max value: %d', int(max_val))
+        step = self.bit_depth_sample_step
+        max_val = numpy.amax(hdulist[0].data[::step, ::step])  # decimated sample
 
-        # This method of detecting bit depth can cause the 16->8 bit conversion
-        # to stretch too much.  This most commonly happens with very low gains
-        # during the day when there are no hot pixels.  This can result in a
-        # trippy effect
+        # Detecting the bit depth from a single frame can cause the 16->8 bit
+        # conversion to stretch too much.  This most commonly happens with very
+        # low gains during the day when there are no hot pixels.  This can
+        # result in a trippy effect.  The tracked bit depth only increases.
         if max_val > 32768:
             image_bit_depth = 16
         elif max_val > 16384:
@@ -1363,18 +1836,42 @@ class ImageProcessor(object):
         else:
             image_bit_depth = 8
 
-        logger.info('Detected bit depth: %d', image_bit_depth)
 
-        return image_bit_depth
+        tracked_bit_depth = self._tracked_bit_depth.get(image_bitpix, 0)
+        if image_bit_depth > tracked_bit_depth:
+            logger.info('Detected bit depth: %d (sample max %d)', image_bit_depth, int(max_val))
+            self._tracked_bit_depth[image_bitpix] = image_bit_depth
+            return image_bit_depth
+
+        return tracked_bit_depth
+
+
+    def _getCameraBitDepth(self):
+        if self.config.get('IMAGE_BIT_DEPTH'):
+            return int(self.config['IMAGE_BIT_DEPTH'])
+
+
+        # some camera drivers report the ADC bit depth, others the container size
+        try:
+            ccd_bits = self.config['CCD_INFO']['CCD_INFO']['CCD_BITSPERPIXEL']['current']
+        except KeyError:
+            return None
+
+        if not ccd_bits:
+            return None
+
+        if 8 < int(ccd_bits) < 16:
+            logger.info('Camera bit depth: %d', int(ccd_bits))
+            return int(ccd_bits)
+
+        return None
 
 
     def getLatestImage(self):
         return self.image_list[0]
 
 
-    def calibrate(self):
-        i_ref = self.getLatestImage()
-
+    def calibrate(self, i_ref):
         if i_ref['calibrated']:
             # already calibrated
             return
@@ -1389,39 +1886,152 @@ class ImageProcessor(object):
 
 
     def _calibrate(self, data, exposure, camera_id, image_bitpix):
+        master_dark, hot_pixels = self._getMasterDark(exposure, camera_id, image_bitpix)
+
+        data_calibrated = cv2.subtract(data, master_dark)
+
+        if not isinstance(hot_pixels, type(None)):
+            # bad pixel map values that exceed a memory mapped dark
+            hot_index, hot_value = hot_pixels
+
+            hot_data = data.reshape(-1)[hot_index]
+            data_calibrated.reshape(-1)[hot_index] = numpy.where(hot_data > hot_value, hot_data - hot_value, 0)
+
+        return data_calibrated
+
+
+    def _getMasterDark(self, exposure, camera_id, image_bitpix):
+        # darks are stored with integer exposures and matched with exposure >= X
+        cache_key = (
+            camera_id,
+            image_bitpix,
+            int(self.gain_v.value),
+            int(self.bin_v.value),
+            math.ceil(exposure),
+            math.floor(self.sensortemp_v.value / self.master_dark_cache_temp_step),
+        )
+
+
+        generation = self._miscDb.getCalibrationGeneration()
+        if generation != self._calibration_generation:
+            logger.info('Calibration frames changed, reloading dark library')
+
+            self._dark_library.load()
+            self._bpm_library.load()
+
+            self._master_dark_cache.clear()
+            self._master_dark_cache_bytes = 0
+            self._calibration_generation = generation
+
+
+        cache_entry = self._master_dark_cache.get(cache_key)
+        if cache_entry:
+            if self._masterDarkCurrent(cache_entry):
+                self._master_dark_cache.move_to_end(cache_key)
+
+                if isinstance(cache_entry['master_dark'], type(None)):
+                    raise CalibrationNotFound(cache_entry['reason'])
+
+                return cache_entry['master_dark'], cache_entry['hot_pixels']
+
+            logger.info('Calibration file modified, reloading master dark')
+            self._evictMasterDark(cache_key)
+
+
+        file_list = list()  # files used to build the master dark
+
+        try:
+            master_dark, hot_pixels = self._loadMasterDark(exposure, camera_id, image_bitpix, file_list)
+        except CalibrationNotFound as e:
+            # remember the miss until the dark library changes
+            self._cacheMasterDark(cache_key, None, None, file_list, reason=str(e))
+            raise
+
+        self._cacheMasterDark(cache_key, master_dark, hot_pixels, file_list)
+
+        return master_dark, hot_pixels
+
+
+    def _cacheMasterDark(self, cache_key, master_dark, hot_pixels, file_list, reason=''):
+        if isinstance(master_dark, type(None)):
+            nbytes = 0
+        else:
+            if isinstance(master_dark, numpy.memmap):
+                # pages are owned by the page cache
+                nbytes = 0
+            else:
+                nbytes = master_dark.nbytes
+
+            if not isinstance(hot_pixels, type(None)):
+                nbytes += hot_pixels[0].nbytes + hot_pixels[1].nbytes
+
+            if nbytes > self.master_dark_cache_size:
+                logger.warning('Master dark too large to cache: %d bytes', nbytes)
+                return
+
+            master_dark.flags.writeable = False  # shared by all frames
+
+
+        self._master_dark_cache[cache_key] = {
+            'master_dark' : master_dark,
+            'hot_pixels'  : hot_pixels,
+            'file_list'   : file_list,
+            'nbytes'      : nbytes,
+            'reason'      : reason,
+        }
+        self._master_dark_cache_bytes += nbytes
+
+
+        # evict least recently used
+        while self._master_dark_cache_bytes > self.master_dark_cache_size:
+            old_key = next(iter(self._master_dark_cache))
+            self._evictMasterDark(old_key)
+
+
+    def _evictMasterDark(self, cache_key):
+        cache_entry = self._master_dark_cache.pop(cache_key)
+        self._master_dark_cache_bytes -= cache_entry['nbytes']
+
+
+    def _masterDarkCurrent(self, cache_entry):
+        for p_file, mtime in cache_entry['file_list']:
+            if self._getMtime(p_file) != mtime:
+                return False
+
+        return True
+
+
+    def _getMtime(self, p_file):
+        try:
+            return p_file.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+
+    def _loadMasterDark(self, exposure, camera_id, image_bitpix, file_list):
         # pick a bad pixel map that is closest to the exposure and temperature
         logger.info('Searching for bad pixel map: gain %d, exposure >= %0.1f, temp >= %0.1fc', self.gain_v.value, exposure, self.sensortemp_v.value)
-        bpm_entry = IndiAllSkyDbBadPixelMapTable.query\
-            .filter(IndiAllSkyDbBadPixelMapTable.camera_id == camera_id)\
-            .filter(IndiAllSkyDbBadPixelMapTable.bitdepth == image_bitpix)\
-            .filter(IndiAllSkyDbBadPixelMapTable.gain == self.gain_v.value)\
-            .filter(IndiAllSkyDbBadPixelMapTable.binmode == self.bin_v.value)\
-            .filter(IndiAllSkyDbBadPixelMapTable.exposure >= exposure)\
-            .filter(IndiAllSkyDbBadPixelMapTable.temp >= self.sensortemp_v.value)\
-            .filter(IndiAllSkyDbBadPixelMapTable.temp <= (self.sensortemp_v.value + self.dark_temperature_range))\
-            .order_by(
-                IndiAllSkyDbBadPixelMapTable.exposure.asc(),
-                IndiAllSkyDbBadPixelMapTable.temp.asc(),
-                IndiAllSkyDbBadPixelMapTable.createDate.asc(),
-            )\
-            .first()
+        bpm_entry = self._bpm_library.find(
+            camera_id,
+            image_bitpix,
+            self.gain_v.value,
+            self.bin_v.value,
+            exposure,
+            self.sensortemp_v.value,
+            self.dark_temperature_range,
+        )
 
         if not bpm_entry:
             logger.warning('Temperature matched bad pixel map not found: %0.2fc', self.sensortemp_v.value)
 
             # pick a bad pixel map that matches the exposure at the hightest temperature found
-            bpm_entry = IndiAllSkyDbBadPixelMapTable.query\
-                .filter(IndiAllSkyDbBadPixelMapTable.camera_id == camera_id)\
-                .filter(IndiAllSkyDbBadPixelMapTable.bitdepth == image_bitpix)\
-                .filter(IndiAllSkyDbBadPixelMapTable.gain == self.gain_v.value)\
-                .filter(IndiAllSkyDbBadPixelMapTable.binmode == self.bin_v.value)\
-                .filter(IndiAllSkyDbBadPixelMapTable.exposure >= exposure)\
-                .order_by(
-                    IndiAllSkyDbBadPixelMapTable.exposure.asc(),
-                    IndiAllSkyDbBadPixelMapTable.temp.desc(),
-                    IndiAllSkyDbBadPixelMapTable.createDate.asc(),
-                )\
-                .first()
+            bpm_entry = self._bpm_library.findFallback(
+                camera_id,
+                image_bitpix,
+                self.gain_v.value,
+                self.bin_v.value,
+                exposure,
+            )
 
 
             if not bpm_entry:
@@ -1438,37 +2048,27 @@ class ImageProcessor(object):
 
         # pick a dark frame that is closest to the exposure and temperature
         logger.info('Searching for dark frame: gain %d, exposure >= %0.1f, temp >= %0.1fc', self.gain_v.value, exposure, self.sensortemp_v.value)
-        dark_frame_entry = IndiAllSkyDbDarkFrameTable.query\
-            .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
-            .filter(IndiAllSkyDbDarkFrameTable.bitdepth == image_bitpix)\
-            .filter(IndiAllSkyDbDarkFrameTable.gain == self.gain_v.value)\
-            .filter(IndiAllSkyDbDarkFrameTable.binmode == self.bin_v.value)\
-            .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
-            .filter(IndiAllSkyDbDarkFrameTable.temp >= self.sensortemp_v.value)\
-            .filter(IndiAllSkyDbDarkFrameTable.temp <= (self.sensortemp_v.value + self.dark_temperature_range))\
-            .order_by(
-                IndiAllSkyDbDarkFrameTable.exposure.asc(),
-                IndiAllSkyDbDarkFrameTable.temp.asc(),
-                IndiAllSkyDbDarkFrameTable.createDate.asc(),
-            )\
-            .first()
+        dark_frame_entry = self._dark_library.find(
+            camera_id,
+            image_bitpix,
+            self.gain_v.value,
+            self.bin_v.value,
+            exposure,
+            self.sensortemp_v.value,
+            self.dark_temperature_range,
+        )
 
         if not dark_frame_entry:
             logger.warning('Temperature matched dark not found: %0.2fc', self.sensortemp_v.value)
 
             # pick a dark frame that matches the exposure at the hightest temperature found
-            dark_frame_entry = IndiAllSkyDbDarkFrameTable.query\
-                .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
-                .filter(IndiAllSkyDbDarkFrameTable.bitdepth == image_bitpix)\
-                .filter(IndiAllSkyDbDarkFrameTable.gain == self.gain_v.value)\
-                .filter(IndiAllSkyDbDarkFrameTable.binmode == self.bin_v.value)\
-                .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
-                .order_by(
-                    IndiAllSkyDbDarkFrameTable.exposure.asc(),
-                    IndiAllSkyDbDarkFrameTable.temp.desc(),
-                    IndiAllSkyDbDarkFrameTable.createDate.asc(),
-                )\
-                .first()
+            dark_frame_entry = self._dark_library.findFallback(
+                camera_id,
+                image_bitpix,
+                self.gain_v.value,
+                self.bin_v.value,
+                exposure,
+            )
 
 
             if not dark_frame_entry:
@@ -1486,40 +2086,77 @@ class ImageProcessor(object):
 
 
         if bpm_entry:
-            p_bpm = Path(bpm_entry.filename)
+            p_bpm = Path(bpm_entry['filename'])
+            file_list.append((p_bpm, self._getMtime(p_bpm)))
+
             if p_bpm.exists():
                 logger.info('Matched bad pixel map: %s', p_bpm)
-                with fits.open(p_bpm) as bpm_f:
-                    bpm = bpm_f[0].data
+                bpm = self._loadCalibrationFrame(p_bpm, file_list)
             else:
-                logger.error('Bad Pixel Map missing: %s', bpm_entry.filename)
+                logger.error('Bad Pixel Map missing: %s', bpm_entry['filename'])
                 bpm = None
         else:
             bpm = None
 
 
-        p_dark_frame = Path(dark_frame_entry.filename)
+        p_dark_frame = Path(dark_frame_entry['filename'])
+        file_list.append((p_dark_frame, self._getMtime(p_dark_frame)))
+
         if not p_dark_frame.exists():
-            logger.error('Dark file missing: %s', dark_frame_entry.filename)
-            raise CalibrationNotFound('Dark file missing: {0:s}'.format(dark_frame_entry.filename))
+            logger.error('Dark file missing: %s', dark_frame_entry['filename'])
+            raise CalibrationNotFound('Dark file missing: {0:s}'.format(dark_frame_entry['filename']))
 
 
         logger.info('Matched dark: %s', p_dark_frame)
 
-        with fits.open(p_dark_frame) as dark_f:
-            dark = dark_f[0].data
+        dark = self._loadCalibrationFrame(p_dark_frame, file_list)
+
+
+        hot_pixels = None
 
+        if isinstance(dark, numpy.memmap):
+            # Merging would copy the dark into memory, only keep the bad
+            # pixels that exceed the dark
+            master_dark = dark
+
+            if not isinstance(bpm, type(None)):
+                hot_index = numpy.flatnonzero(bpm > dark)
+                hot_value = bpm.reshape(-1)[hot_index]
 
-        if not isinstance(bpm, type(None)):
+                hot_pixels = (hot_index, hot_value)
+        elif not isinstance(bpm, type(None)):
             # merge bad pixel map and dark
             master_dark = numpy.maximum(bpm, dark)
         else:
-            master_dark = dark
+            master_dark = numpy.array(dark)  # detach from the fits file
 
 
-        data_calibrated = cv2.subtract(data, master_dark)
+        return master_dark, hot_pixels
 
-        return data_calibrated
+
+    def _loadCalibrationFrame(self, p_file, file_list):
+        # prefer the raw numpy copy of the frame which can be memory mapped
+        p_npy = p_file.with_suffix('.npy')
+
+        if p_npy.exists():
+            file_list.append((p_npy, self._getMtime(p_npy)))
+            return numpy.load(str(p_npy), mmap_mode='r')
+
+        with fits.open(p_file) as hdulist:
+            return hdulist[0].data
+
+
+    def calculateAdu(self):
+        i_ref = self.getLatestImage()
+
+        # sample the stacked data with the same stretch as the final image
+        stretch_func = functools.partial(
+            self._stretch.apply,
+            image_bitpix=i_ref['image_bitpix'],
+            image_bit_depth=i_ref['image_bit_depth'],
+        )
+
+        return self._adu_meter.measure(self.image, i_ref['image_bayerpat'], stretch_func)
 
 
     def calculateSqm(self):
@@ -1530,7 +2167,7 @@ class ImageProcessor(object):
             i_ref['sqm_value'] = 0
             return
 
-        i_ref['sqm_value'] = self._sqm.calculate(i_ref['hdulist'][0].data, i_ref['exposure'], self.gain_v.value)
+        i_ref['sqm_value'] = self._sqm.calculate(i_ref['hdulist'][0].data, i_ref['exposure'], i_ref['gain'])
 
 
     def stack(self):
@@ -1556,7 +2193,12 @@ class ImageProcessor(object):
 
         if stack_list_len == 1:
             # no reason to stack a single image
-            self.image = i_ref['hdulist'][0].data
+            if self.stack_count > 1:
+                # 8 bit data may be modified in place, the original is needed for stacking
+                self.image = i_ref['hdulist'][0].data.copy()
+            else:
+                self.image = i_ref['hdulist'][0].data
+
             return
 
 
@@ -1571,14 +2213,39 @@ class ImageProcessor(object):
             raise Exception('Unknown bits per pixel')
 
 
-        stacker = ImageStacker()
+        stacker = ImageStacker(
+            memory_budget=int(self.config.get('IMAGE_STACK_MEMORY_MB', 200)) * 1024 * 1024,
+            registration_pool=self._registration_pool,
+        )
 
 
         if self.config.get('IMAGE_STACK_ALIGN') and i_ref['exposure'] > self.registration_exposure_thresh:
             # only perform registration once the exposure exceeds 5 seconds
 
+            if self._stack_accumulator:
+                # registered data changes with every reference frame
+                self._stack_accumulator.reset()
+
+            # the process pool is only started before the pipeline threads
+            self.startRegistration(processes=False)
+            stacker.registration_pool = self._registration_pool
+
             stack_i_ref_list = list(filter(lambda x: x['exposure'] > self.registration_exposure_thresh, stack_i_ref_list))
             stack_data_list = stacker.register(stack_i_ref_list)
+        elif self._stack_accumulator:
+            stack_start = time.time()
+
+            # only the newest frame is added, the oldest was removed when it expired
+            self._stack_accumulator.sync(stack_i_ref_list)
+            self.image = self._stack_accumulator.result(numpy_type)
+
+            if self.config.get('IMAGE_STACK_SPLIT'):
+                self.image = self._splitscreen(i_ref['hdulist'][0].data, self.image)
+
+            stack_elapsed_s = time.time() - stack_start
+            logger.info('Stacked %d images (%s) in %0.4f s', stack_list_len, self.stack_method, stack_elapsed_s)
+
+            return
         else:
             # stack unaligned images
             stack_data_list = [x['hdulist'][0].data for x in stack_i_ref_list]
@@ -1604,6 +2271,182 @@ class ImageProcessor(object):
         logger.info('Stacked %d images (%s) in %0.4f s', len(stack_data_list), self.stack_method, stack_elapsed_s)
 
 
+    def _getRoi(self, raw_shape, bayered, bin_value):
+        roi_key = (raw_shape, bayered, bin_value)
+        if roi_key == self._roi_key:
+            return self._roi
+
+        self._roi_key = roi_key
+        self._roi = None
+
+
+        raw_height, raw_width = raw_shape
+
+        rotate = self.config.get('IMAGE_ROTATE')
+        if rotate in ('ROTATE_90_CLOCKWISE', 'ROTATE_90_COUNTERCLOCKWISE'):
+            height, width = raw_width, raw_height
+        else:
+            height, width = raw_height, raw_width
+
+
+        if self.config.get('IMAGE_CROP_ROI'):
+            roi_mode = 'crop'
+
+            # divide the coordinates by binning value
+            x1 = int(self.config['IMAGE_CROP_ROI'][0] / bin_value)
+            y1 = int(self.config['IMAGE_CROP_ROI'][1] / bin_value)
+            x2 = int(self.config['IMAGE_CROP_ROI'][2] / bin_value)
+            y2 = int(self.config['IMAGE_CROP_ROI'][3] / bin_value)
+        elif self.config.get('IMAGE_ROI_MASK') and not isinstance(self._detection_mask, type(None)):
+            roi_mode = 'mask'
+
+            if self._detection_mask.shape[:2] != (height, width):
+                logger.error('Detection mask dimensions do not match the image, ROI disabled')
+                return
+
+            x1, y1, mask_w, mask_h = cv2.boundingRect(self._detection_mask)
+            x2 = x1 + mask_w
+            y2 = y1 + mask_h
+        else:
+            return
+
+
+        x1 = min(max(x1, 0), width)
+        y1 = min(max(y1, 0), height)
+        x2 = min(max(x2, 0), width)
+        y2 = min(max(y2, 0), height)
+
+        if x2 <= x1 or y2 <= y1:
+            logger.error('Invalid region of interest: %d, %d, %d, %d', x1, y1, x2, y2)
+            return
+
+        if (x2 - x1) * (y2 - y1) == height * width:
+            # nothing to skip
+            return
+
+
+        # undo the flips, then the rotation, to find the region in the raw frame
+        rx1, ry1, rx2, ry2 = x1, y1, x2, y2
+
+        if self.config.get('IMAGE_FLIP_H'):
+            rx1, rx2 = width - rx2, width - rx1
+
+        if self.config.get('IMAGE_FLIP_V'):
+            ry1, ry2 = height - ry2, height - ry1
+
+        if rotate == 'ROTATE_90_CLOCKWISE':
+            rx1, ry1, rx2, ry2 = ry1, raw_height - rx2, ry2, raw_height - rx1
+        elif rotate == 'ROTATE_90_COUNTERCLOCKWISE':
+            rx1, ry1, rx2, ry2 = raw_width - ry2, rx1, raw_width - ry1, rx2
+        elif rotate == 'ROTATE_180':
+            rx1, ry1, rx2, ry2 = raw_width - rx2, raw_height - ry2, raw_width - rx1, raw_height - ry1
+
+
+        if bayered:
+            # keep the bayer pattern phase and enough neighbors for the
+            # interpolation, the margin is removed after debayering
+            dx1 = max((rx1 - self.roi_debayer_margin) & ~1, 0)
+            dy1 = max((ry1 - self.roi_debayer_margin) & ~1, 0)
+            dx2 = min((rx2 + self.roi_debayer_margin + 1) & ~1, raw_width)
+            dy2 = min((ry2 + self.roi_debayer_margin + 1) & ~1, raw_height)
+        else:
+            dx1, dy1, dx2, dy2 = rx1, ry1, rx2, ry2
+
+
+        self._roi = {
+            'mode'   : roi_mode,
+            'shape'  : (height, width),
+            'final'  : (x1, y1, x2, y2),
+            'raw'    : (dx1, dy1, dx2, dy2),
+            'trim'   : (rx1 - dx1, ry1 - dy1, rx2 - dx1, ry2 - dy1),
+        }
+
+        logger.info(
+            'Processing region of interest (%s): %d x %d of %d x %d',
+            roi_mode,
+            x2 - x1,
+            y2 - y1,
+            width,
+            height,
+        )
+
+        return self._roi
+
+
+    def roi_crop(self):
+        # only the region of interest is debayered and processed after this
+        i_ref = self.getLatestImage()
+
+        self._roi_state = None
+
+        if not self.config.get('IMAGE_ROI_PROCESSING', True):
+            return
+
+        if i_ref['night'] and self.config.get('DETECT_METEORS'):
+            # line detection would find the edges of the black border
+            return
+
+
+        bayered = len(self.image.shape) == 2 and bool(i_ref['image_bayerpat'])
+
+        roi = self._getRoi(self.image.shape[:2], bayered, i_ref['bin'])
+        if not roi:
+            return
+
+
+        dx1, dy1, dx2, dy2 = roi['raw']
+        self.image = self.image[dy1:dy2, dx1:dx2]
+
+        self._roi_state = 'roi'
+
+
+    def _roi_trim(self, data):
+        if self._roi_state != 'roi':
+            return data
+
+        tx1, ty1, tx2, ty2 = self._roi['trim']
+
+        return data[ty1:ty2, tx1:tx2]
+
+
+    def roi_expand(self):
+        # composite the region into a black frame for full frame coordinates
+        if self._roi_state != 'roi':
+            return
+
+        height, width = self._roi['shape']
+        x1, y1, x2, y2 = self._roi['final']
+
+        full_image = numpy.zeros((height, width) + self.image.shape[2:], dtype=self.image.dtype)
+        full_image[y1:y2, x1:x2] = self.image
+
+        self.image = full_image
+        self._roi_state = 'full'
+
+
+    def roi_reduce(self):
+        if self._roi_state != 'full':
+            return
+
+        if self.image.shape[:2] != self._roi['shape']:
+            logger.error('Image is not a full frame composite, not reducing to the region of interest')
+            self._roi_state = None
+            return
+
+        x1, y1, x2, y2 = self._roi['final']
+
+        self.image = self.image[y1:y2, x1:x2]
+        self._roi_state = 'roi'
+
+
+    def roi_composite(self):
+        # black border outside of the detection mask region
+        if not self._roi or self._roi['mode'] != 'mask':
+            return
+
+        self.roi_expand()
+
+
     def debayer(self):
         i_ref = self.getLatestImage()
 
@@ -1622,15 +2465,17 @@ class ImageProcessor(object):
             return
 
 
-        if self.config.get('NIGHT_GRAYSCALE') and self.night_v.value:
+        if self.config.get('NIGHT_GRAYSCALE') and i_ref['night']:
             debayer_algorithm = self.__cfa_gray_map[image_bayerpat]
-        elif self.config.get('DAYTIME_GRAYSCALE') and not self.night_v.value:
+        elif self.config.get('DAYTIME_GRAYSCALE') and not i_ref['night']:
             debayer_algorithm = self.__cfa_gray_map[image_bayerpat]
         else:
             debayer_algorithm = self.__cfa_bgr_map[image_bayerpat]
 
         debayered_data_bgr = cv2.cvtColor(self.image, debayer_algorithm)
-        self.image = debayered_data_bgr
+
+        # remove the interpolation margin around the region of interest
+        self.image = self._roi_trim(debayered_data_bgr)
 
 
     def convert_16bit_to_8bit(self):
@@ -1640,14 +2485,11 @@ class ImageProcessor(object):
 
 
     def _convert_16bit_to_8bit(self, image_bitpix, image_bit_depth):
-        if image_bitpix == 8:
-            return
-
-        logger.info('Resampling image from %d to 8 bits', image_bitpix)
-
-        div_factor = int((2 ** image_bit_depth) / 255)
+        if image_bitpix == 16:
+            logger.info('Resampling image from %d to 8 bits', image_bitpix)
 
-        self.image = (self.image / div_factor).astype(numpy.uint8)
+        # 8 bit data is only changed by non-linear curves
+        self.image = self._stretch.apply(self.image, image_bitpix, image_bit_depth)
 
 
     def rotate(self, rotate_enum):
@@ -1666,7 +2508,7 @@ class ImageProcessor(object):
             i_ref['lines'] = list
             return
 
-        i_ref['lines'] = self._lineDetect.detectLines(self.image)
+        i_ref['lines'] = self._lineDetect.detectLines(self.image, pyramid=self._getPyramid())
 
 
     def detectStars(self):
@@ -1677,7 +2519,17 @@ class ImageProcessor(object):
             i_ref['stars'] = list()
             return
 
-        i_ref['stars'] = self._stars.detectObjects(self.image)
+        i_ref['stars'] = self._stars.detectObjects(self.image, pyramid=self._getPyramid())
+        i_ref['star_stats'] = self._stars.statistics(i_ref['stars'], i_ref['exposure'])
+
+
+    def _getPyramid(self):
+        # built once per frame and shared by the detectors, the pyramid
+        # keeps a copy of the image so drawn lines are not detected as stars
+        if isinstance(self._pyramid, type(None)):
+            self._pyramid = IndiAllSkyImagePyramid(self.image)
+
+        return self._pyramid
 
 
     def drawDetections(self):
@@ -1689,11 +2541,20 @@ class ImageProcessor(object):
 
 
     def crop_image(self):
+        if self._roi_state in ('roi', 'full') and self._roi['mode'] == 'crop':
+            # only the cropped region was processed, a composite for
+            # detection is reduced back to the region
+            self.roi_reduce()
+            return
+
+
+        i_ref = self.getLatestImage()
+
         # divide the coordinates by binning value
-        x1 = int(self.config['IMAGE_CROP_ROI'][0] / self.bin_v.value)
-        y1 = int(self.config['IMAGE_CROP_ROI'][1] / self.bin_v.value)
-        x2 = int(self.config['IMAGE_CROP_ROI'][2] / self.bin_v.value)
-        y2 = int(self.config['IMAGE_CROP_ROI'][3] / self.bin_v.value)
+        x1 = int(self.config['IMAGE_CROP_ROI'][0] / i_ref['bin'])
+        y1 = int(self.config['IMAGE_CROP_ROI'][1] / i_ref['bin'])
+        x2 = int(self.config['IMAGE_CROP_ROI'][2] / i_ref['bin'])
+        y2 = int(self.config['IMAGE_CROP_ROI'][3] / i_ref['bin'])
 
 
         self.image = self.image[
@@ -1705,53 +2566,16 @@ class ImageProcessor(object):
         logger.info('New cropped size: %d x %d', new_width, new_height)
 
 
-    def scnr(self, algo):
-        if self.focus_mode:
-            # disable processing in focus mode
-            return
-
-        try:
-            scnr_function = getattr(self._scnr, algo)
-            self.image = scnr_function(self.image)
-        except AttributeError:
-            logger.error('Unknown SCNR algorithm: %s', algo)
-
-
-    def white_balance_manual_bgr(self):
+    def color_balance(self):
         if self.focus_mode:
             # disable processing in focus mode
             return
 
-
-        if len(self.image.shape) == 2:
-            # mono
-            return
-
-
-        if not self.config.get('WBB_FACTOR'):
-            logger.error('Missing WBB_FACTOR setting')
-            return
-
-        if not self.config.get('WBG_FACTOR'):
-            logger.error('Missing WBG_FACTOR setting')
-            return
-
-        if not self.config.get('WBR_FACTOR'):
-            logger.error('Missing WBR_FACTOR setting')
-            return
-
-        WBB_FACTOR = float(self.config.get('WBB_FACTOR'))
-        WBG_FACTOR = float(self.config.get('WBG_FACTOR'))
-        WBR_FACTOR = float(self.config.get('WBR_FACTOR'))
-
-        b, g, r = cv2.split(self.image)
-
-        logger.info('Applying manual color balance settings')
-        wbb = cv2.multiply(b, WBB_FACTOR)
-        wbg = cv2.multiply(g, WBG_FACTOR)
-        wbr = cv2.multiply(r, WBR_FACTOR)
-
-        self.image = cv2.merge([wbb, wbg, wbr])
+        self.image = self._color_balance.balance(
+            self.image,
+            scnr_algo=self.config.get('SCNR_ALGORITHM'),
+            auto_wb=self.config.get('AUTO_WB'),
+        )
 
 
     #def white_balance_bgr_2(self):
@@ -1793,69 +2617,13 @@ class ImageProcessor(object):
     #    self.image = data_denoise
 
 
-    def white_balance_auto_bgr(self):
-        if self.focus_mode:
-            # disable processing in focus mode
-            return
-
-        if len(self.image.shape) == 2:
-            # mono
-            return
-
-        ### This seems to work
-        b, g, r = cv2.split(self.image)
-        b_avg = cv2.mean(b)[0]
-        g_avg = cv2.mean(g)[0]
-        r_avg = cv2.mean(r)[0]
-
-        # Find the gain of each channel
-        k = (b_avg + g_avg + r_avg) / 3
-
-        try:
-            kb = k / b_avg
-        except ZeroDivisionError:
-            kb = k / 0.1
-
-        try:
-            kg = k / g_avg
-        except ZeroDivisionError:
-            kg = k / 0.1
-
-        try:
-            kr = k / r_avg
-        except ZeroDivisionError:
-            kr = k / 0.1
-
-        b = cv2.addWeighted(src1=b, alpha=kb, src2=0, beta=0, gamma=0)
-        g = cv2.addWeighted(src1=g, alpha=kg, src2=0, beta=0, gamma=0)
-        r = cv2.addWeighted(src1=r, alpha=kr, src2=0, beta=0, gamma=0)
-
-        self.image = cv2.merge([b, g, r])
-
-
     def contrast_clahe(self):
         if self.focus_mode:
             # disable processing in focus mode
             return
 
         ### ohhhh, contrasty
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-
-        if len(self.image.shape) == 2:
-            # mono
-            self.image = clahe.apply(self.image)
-            return
-
-        # color, apply to luminance
-        lab = cv2.cvtColor(self.image, cv2.COLOR_BGR2LAB)
-
-        l, a, b = cv2.split(lab)
-
-        cl = clahe.apply(l)
-
-        new_lab = cv2.merge((cl, a, b))
-
-        self.image = cv2.cvtColor(new_lab, cv2.COLOR_LAB2BGR)
+        self.image = self._contrast.apply(self.image)
 
 
     #def equalizeHistogram(self, data):
@@ -2041,13 +2809,13 @@ class ImageProcessor(object):
 
 
         if self.config.get('TEMP_DISPLAY') == 'f':
-            sensortemp = ((self.sensortemp_v.value * 9.0) / 5.0) + 32
+            sensortemp = ((i_ref['sensortemp'] * 9.0) / 5.0) + 32
             temp_unit = 'F'
         elif self.config.get('TEMP_DISPLAY') == 'k':
-            sensortemp = self.sensortemp_v.value + 273.15
+            sensortemp = i_ref['sensortemp'] + 273.15
             temp_unit = 'K'
         else:
-            sensortemp = self.sensortemp_v.value
+            sensortemp = i_ref['sensortemp']
             temp_unit = 'C'
 
 
@@ -2055,7 +2823,7 @@ class ImageProcessor(object):
             'timestamp'    : i_ref['exp_date'],
             'ts'           : i_ref['exp_date'],  # shortcut
             'exposure'     : i_ref['exposure'],
-            'gain'         : self.gain_v.value,
+            'gain'         : i_ref['gain'],
             'temp'         : sensortemp,  # hershey fonts do not support degree symbol
             'temp_unit'    : temp_unit,
             'sqm'          : i_ref['sqm_value'],
@@ -2072,9 +2840,9 @@ class ImageProcessor(object):
 
 
         # stacking data
-        if self.night_v.value:
+        if i_ref['night']:
             if self.config.get('IMAGE_STACK_COUNT', 1) > 1:
-                label_data['stack_method'] = self.config.get('IMAGE_STACK_METHOD', 'average').capitalize()
+                label_data['stack_method'] = self.config.get('IMAGE_STACK_METHOD', 'average').replace('_', ' ').capitalize()
                 label_data['stack_count'] = self.config.get('IMAGE_STACK_COUNT', 1)
             else:
                 label_data['stack_method'] = 'Off'
@@ -2101,7 +2869,7 @@ class ImageProcessor(object):
 
 
         # Add moon mode indicator
-        if self.moonmode_v.value:
+        if i_ref['moonmode']:
             self.drawText(
                 self.image,
                 '* Moon Mode *',
@@ -2113,7 +2881,7 @@ class ImageProcessor(object):
 
 
         # Add eclipse indicator
-        if self.astrometric_data['sun_moon_sep'] < 1.25 and self.night_v.value:
+        if self.astrometric_data['sun_moon_sep'] < 1.25 and i_ref['night']:
             # Lunar eclipse (earth's penumbra is large)
             self.drawText(
                 self.image,
@@ -2124,7 +2892,7 @@ class ImageProcessor(object):
 
             line_offset += self.config['TEXT_PROPERTIES']['FONT_HEIGHT']
 
-        elif self.astrometric_data['sun_moon_sep'] > 179.0 and not self.night_v.value:
+        elif self.astrometric_data['sun_moon_sep'] > 179.0 and not i_ref['night']:
             # Solar eclipse
             self.drawText(
                 self.image,
@@ -2219,8 +2987,211 @@ class ImageProcessor(object):
         return extra_lines
 
 
+class ImageStackAccumulator(object):
+    # Running uint32 sum of the frames in the stack.  Frames are added as they
+    # enter the image list and subtracted as they expire, each frame only
+    # costs one add and one subtract regardless of the stack count.
+
+    def __init__(self):
+        self._sum = None
+        self._i_ref_list = list()
+
+
+    def reset(self):
+        self._sum = None
+        self._i_ref_list = list()
+
+
+    def _contains(self, i_ref):
+        for x in self._i_ref_list:
+            if x is i_ref:
+                return True
+
+        return False
+
+
+    def add(self, i_ref):
+        data = i_ref['hdulist'][0].data
+
+        if isinstance(self._sum, type(None)):
+            self._sum = data.astype(numpy.uint32)
+        else:
+            numpy.add(self._sum, data, out=self._sum, casting='unsafe')
+
+        self._i_ref_list.append(i_ref)
+
+
+    def remove(self, i_ref):
+        if not self._contains(i_ref):
+            return
+
+        numpy.subtract(self._sum, i_ref['hdulist'][0].data, out=self._sum, casting='unsafe')
+
+        self._i_ref_list = [x for x in self._i_ref_list if x is not i_ref]
+
+
+    def sync(self, stack_i_ref_list):
+        for x in self._i_ref_list:
+            if not any(x is i_ref for i_ref in stack_i_ref_list):
+                # frame left the stack without being subtracted
+                logger.warning('Rebuilding stack sum')
+                self.reset()
+                break
+
+
+        for i_ref in stack_i_ref_list:
+            if self._contains(i_ref):
+                continue
+
+            if not isinstance(self._sum, type(None)) and self._sum.shape != i_ref['hdulist'][0].data.shape:
+                # binning or camera change, older frames are discarded
+                logger.warning('Frame size changed, resetting stack sum')
+                self.reset()
+
+            self.add(i_ref)
+
+
+    def result(self, numpy_type):
+        # integer division is the same as the floor of the mean
+        return (self._sum // len(self._i_ref_list)).astype(numpy_type)
+
+
+
+class ImageStackRollingExtremum(object):
+    # Sliding window max/min using two stacks.  New frames are folded into a
+    # single back array.  When the oldest frame expires and the front stack
+    # is empty, the back frames are moved to the front as suffix extrema.
+    # The window extremum is the front suffix of the oldest frame combined
+    # with the back array, amortized 3 operations per frame.
+
+    def __init__(self, func):
+        self._func = func  # numpy.maximum or numpy.minimum
+
+        self._front = list()  # (i_ref, suffix), oldest first
+        self._back = None
+        self._back_list = list()  # i_refs folded into back, oldest first
+
+
+    def reset(self):
+        self._front = list()
+        self._back = None
+        self._back_list = list()
+
+
+    def _contains(self, i_ref):
+        for x, suffix in self._front:
+            if x is i_ref:
+                return True
+
+        for x in self._back_list:
+            if x is i_ref:
+                return True
+
+        return False
+
+
+    def _members(self):
+        return [x for x, suffix in self._front] + self._back_list
+
+
+    def add(self, i_ref):
+        data = i_ref['hdulist'][0].data
+
+        if isinstance(self._back, type(None)):
+            self._back = data.copy()
+        else:
+            self._func(self._back, data, out=self._back)
+
+        self._back_list.append(i_ref)
+
+
+    def remove(self, i_ref):
+        if not self._contains(i_ref):
+            return
+
+        if not self._front:
+            self._flip()
+
+        if self._front[0][0] is not i_ref:
+            # frames must expire oldest first
+            logger.warning('Unexpected frame order, resetting rolling stack')
+            self.reset()
+            return
+
+        self._front.pop(0)
+
+
+    def _flip(self):
+        suffix = None
+        front = list()
+
+        for i_ref in reversed(self._back_list):
+            data = i_ref['hdulist'][0].data
+
+            if isinstance(suffix, type(None)):
+                suffix = data.copy()
+            else:
+                suffix = self._func(suffix, data)
+
+            front.insert(0, (i_ref, suffix))
+
+        self._front = front
+        self._back = None
+        self._back_list = list()
+
+
+    def sync(self, stack_i_ref_list):
+        for x in self._members():
+            if not any(x is i_ref for i_ref in stack_i_ref_list):
+                # frame left the stack without being removed
+                logger.warning('Rebuilding rolling stack')
+                self.reset()
+                break
+
+
+        # stack list is newest first
+        for i_ref in reversed(stack_i_ref_list):
+            if self._contains(i_ref):
+                continue
+
+            members = self._members()
+            if members and members[0]['hdulist'][0].data.shape != i_ref['hdulist'][0].data.shape:
+                # binning or camera change, older frames are discarded
+                logger.warning('Frame size changed, resetting rolling stack')
+                self.reset()
+
+            self.add(i_ref)
+
+
+    def result(self, numpy_type):
+        if not self._front:
+            return self._back.copy()
+
+        if isinstance(self._back, type(None)):
+            return self._front[0][1].copy()
+
+        return self._func(self._front[0][1], self._back)
+
+
+
 class ImageStacker(object):
 
+    sigmaclip_sigma = 3.0
+
+    registration_residual_thresh = 2.0  # pixels, composed transform error limit
+
+    def __init__(self, memory_budget=200 * 1024 * 1024, workers=None, registration_pool=None):
+        # working memory limit for median and sigma clip stacking
+        self.memory_budget = memory_budget
+
+        self.registration_pool = registration_pool
+
+        if workers:
+            self.workers = workers
+        else:
+            self.workers = os.cpu_count() or 1
+
+
     def mean(self, *args, **kwargs):
         # alias for average
         return self.average(*args, **kwargs)
@@ -2250,73 +3221,180 @@ class ImageStacker(object):
         return image_min
 
 
+    def rolling_maximum(self, *args, **kwargs):
+        # alias for maximum, registered frames are stacked in full
+        return self.maximum(*args, **kwargs)
+
+
+    def rolling_minimum(self, *args, **kwargs):
+        # alias for minimum, registered frames are stacked in full
+        return self.minimum(*args, **kwargs)
+
+
+    def median(self, stack_data_list, numpy_type):
+        # data is copied to a tile, then partitioned
+        bytes_per_element = stack_data_list[0].itemsize * 2
+
+        return self._tiled(stack_data_list, numpy_type, self._medianTile, bytes_per_element)
+
+
+    def _medianTile(self, tile, numpy_type):
+        return numpy.floor(numpy.median(tile, axis=0)).astype(numpy_type)
+
+
+    def sigmaclip(self, stack_data_list, numpy_type):
+        # tile, float32 data, deviations, partition and mask
+        bytes_per_element = stack_data_list[0].itemsize + 13
+
+        return self._tiled(stack_data_list, numpy_type, self._sigmaclipTile, bytes_per_element)
+
+
+    def _sigmaclipTile(self, tile, numpy_type):
+        data = tile.astype(numpy.float32)
+
+        # median and MAD are not skewed by a single bright frame (satellites, planes)
+        center = numpy.median(data, axis=0)
+        deviation = numpy.abs(data - center)
+        mad_std = numpy.median(deviation, axis=0) * 1.4826
+
+        mask = deviation <= (mad_std * self.sigmaclip_sigma)
+
+        count = numpy.maximum(numpy.count_nonzero(mask, axis=0), 1)
+        clipped_mean = numpy.sum(data, axis=0, where=mask) / count
+
+        return numpy.floor(clipped_mean).astype(numpy_type)
+
+
+    def _tiled(self, stack_data_list, numpy_type, tile_func, bytes_per_element):
+        # Process horizontal tiles so the working memory stays under the
+        # budget, numpy releases the GIL so tiles run in parallel
+        image_height = stack_data_list[0].shape[0]
+        row_elements = stack_data_list[0][0].size
+        stack_count = len(stack_data_list)
+
+        tile_budget = self.memory_budget / self.workers
+        tile_rows = int(tile_budget / (stack_count * row_elements * bytes_per_element))
+        tile_rows = min(max(tile_rows, 1), image_height)
+
+        logger.info('Stacking in %d row tiles with %d threads', tile_rows, self.workers)
+
+
+        stacked_image = numpy.empty(stack_data_list[0].shape, dtype=numpy_type)
+
+        def stack_tile(y):
+            tile = numpy.stack([x[y:y + tile_rows] for x in stack_data_list])
+            stacked_image[y:y + tile_rows] = tile_func(tile, numpy_type)
+
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # list() raises any exceptions from the threads
+            list(executor.map(stack_tile, range(0, image_height, tile_rows)))
+
+
+        return stacked_image
+
+
     def register(self, stack_i_ref_list):
+        # Each frame caches the transform from its predecessor, older frames
+        # are aligned by composing the transforms along the chain.  Where the
+        # chain is broken or the error grows too large, the frame becomes an
+        # anchor that is registered directly to the reference.  The transforms
+        # are found and applied in the registration process pool.
         reference_i_ref = stack_i_ref_list[0]
 
-        reg_data_list = [reference_i_ref['hdulist'][0].data]  # add target to final list
+        reg_start = time.time()
 
-        reference_crop = self._crop(reference_i_ref['hdulist'][0].data)
 
-        reg_start = time.time()
+        # normally only the newest frame needs a new link
+        link_pair_list = list()
+        for newer_i_ref, i_ref in zip(stack_i_ref_list[:-1], stack_i_ref_list[1:]):
+            link = newer_i_ref.get('registration')
+            if link and link['exp_date'] == i_ref['exp_date']:
+                continue
 
-        for i_ref in stack_i_ref_list[1:]:
-            i_crop = self._crop = i_ref['hdulist'][0].data
+            link_pair_list.append((newer_i_ref, i_ref))
 
-            # detection_sigma default = 5
-            # max_control_points default = 50
-            # min_area default = 5
 
-            try:
-                ### Find transform using a crop of the image
-                transform, (source_list, target_list) = astroalign.find_transform(
-                    i_crop,
-                    reference_crop,
-                    detection_sigma=7,
-                    max_control_points=100,
-                    min_area=15,
-                )
+        link_result_list = self.registration_pool.findTransforms([(i_ref, newer_i_ref) for newer_i_ref, i_ref in link_pair_list])
 
-                reg_data, footprint = astroalign.apply_transform(
-                    transform,
-                    i_ref['hdulist'][0],
-                    reference_i_ref['hdulist'][0],
-                )
+        for (newer_i_ref, i_ref), result in zip(link_pair_list, link_result_list):
+            # failures are cached as well
+            transform, residual = result if result else (None, None)
 
-                ### Register full image
-                #reg_data, footprint = astroalign.register(
-                #    i_ref['hdulist'][0],
-                #    reference_i_ref['hdulist'][0],
-                #    detection_sigma=7,
-                #    max_control_points=100,
-                #    min_area=15,
-                #)
-            except astroalign.MaxIterError as e:
-                logger.error('Image registration failure: %s', str(e))
-                continue
-            except ValueError as e:
-                logger.error('Image registration failure: %s', str(e))
+            newer_i_ref['registration'] = {
+                'exp_date'  : i_ref['exp_date'],
+                'transform' : transform,
+                'residual'  : residual,
+            }
+
+
+        # compose the transforms from each frame to its anchor
+        chain_list = list()  # (frame index, anchor index, transform to anchor)
+        anchor_idx = 0  # reference
+        chain_transform = None  # identity
+        chain_error = 0.0
+
+        for idx in range(1, len(stack_i_ref_list)):
+            link = stack_i_ref_list[idx - 1]['registration']
+
+            if isinstance(link['transform'], type(None)):
+                anchor_idx = idx
+                chain_transform = None
+                chain_error = 0.0
+            elif (chain_error + link['residual']) > self.registration_residual_thresh:
+                logger.warning('Composed registration error %0.2f px, registering directly', chain_error + link['residual'])
+                anchor_idx = idx
+                chain_transform = None
+                chain_error = 0.0
+            else:
+                if isinstance(chain_transform, type(None)):
+                    chain_transform = link['transform']
+                else:
+                    chain_transform = link['transform'] + chain_transform  # apply link first
+
+                chain_error += link['residual']
+
+            chain_list.append((idx, anchor_idx, chain_transform))
+
+
+        # anchors are registered directly to the reference
+        anchor_idx_list = [idx for idx, anchor_idx, chain_transform in chain_list if idx == anchor_idx]
+        anchor_result_list = self.registration_pool.findTransforms([(stack_i_ref_list[idx], reference_i_ref) for idx in anchor_idx_list])
+
+        anchor_transform_map = {0 : None}
+        for idx, result in zip(anchor_idx_list, anchor_result_list):
+            if result:
+                anchor_transform_map[idx] = result[0]
+
+
+        transform_list = list()
+        for idx, anchor_idx, chain_transform in chain_list:
+            if anchor_idx not in anchor_transform_map:
+                # anchor could not be registered
                 continue
 
-            reg_data_list.append(reg_data)
+            anchor_transform = anchor_transform_map[anchor_idx]
 
+            if isinstance(chain_transform, type(None)):
+                transform = anchor_transform
+            elif isinstance(anchor_transform, type(None)):
+                transform = chain_transform
+            else:
+                transform = chain_transform + anchor_transform
 
-        reg_elapsed_s = time.time() - reg_start
-        logger.info('Registered %d+1 images in %0.4f s', len(stack_i_ref_list) - 1, reg_elapsed_s)  # reference image is not aligned
+            transform_list.append((transform, stack_i_ref_list[idx]))
 
-        return reg_data_list
 
+        reg_data_list = [reference_i_ref['hdulist'][0].data]  # add target to final list
 
-    def _crop(self, image):
-        image_height, image_width = image.shape[:2]
+        for reg_data in self.registration_pool.applyTransforms(transform_list, reference_i_ref):
+            if isinstance(reg_data, type(None)):
+                continue
 
-        x1 = int((image_width / 3) - (image_width / 3))
-        y1 = int((image_height / 3) - (image_height / 3))
-        x2 = int((image_width / 3) + (image_width / 3))
-        y2 = int((image_height / 3) + (image_height / 3))
+            reg_data_list.append(reg_data)
 
 
-        return image[
-            y1:y2,
-            x1:x2,
-        ]
+        reg_elapsed_s = time.time() - reg_start
+        logger.info('Registered %d+1 images in %0.4f s (%d processes)', len(reg_data_list) - 1, reg_elapsed_s, self.registration_pool.workers)  # reference image is not aligned
 
+        return reg_data_list
@@ -0,0 +1,180 @@
+import struct
+import logging
+
+from multiprocessing import Array
+from multiprocessing import Lock
+from multiprocessing import Value
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyImageCache(object):
+    # Keeps the encoded bytes of the most recent images in shared memory so
+    # the upload worker does not need to read the files back from disk.
+    # Each slot is a separate shared memory segment laid out as
+    #   [ 8 byte data length | 8 byte key length | key ... | encoded data ]
+    # A new image replaces the oldest slot.  Segments are allocated on first
+    # use and only grown when a larger image arrives.
+
+    header_size = 512
+    key_size_max = header_size - 16
+
+
+    def __init__(self, slots, name_prefix):
+        self._slots = int(slots)
+        self._name_prefix = str(name_prefix)
+
+        self._lock = Lock()  # shared between processes
+        self._size = Array('q', self._slots, lock=False)  # allocated segment size, 0 = not allocated
+        self._serial = Array('q', self._slots, lock=False)  # age of the slot contents, 0 = empty
+        self._next_serial = Value('q', 1, lock=False)
+
+        # per process mapping of attached segments
+        self._shm = dict()
+
+        # worker processes forked after this share the tracker, a tracker
+        # started by a worker would unlink the segments when the worker exits
+        resource_tracker.ensure_running()
+
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @slots.setter
+    def slots(self, *args):
+        pass  # read only
+
+
+    def _slotName(self, idx):
+        return '{0:s}_{1:d}'.format(self._name_prefix, idx)
+
+
+    def _attach(self, idx, min_size=0):
+        shm_size = self._size[idx]
+
+        if shm_size < min_size:
+            # slot needs a larger segment
+            self._detach(idx)
+            self._unlink(idx)
+
+            shm = shared_memory.SharedMemory(name=self._slotName(idx), create=True, size=min_size)
+
+            self._size[idx] = shm.size
+            self._shm[idx] = shm
+
+            return shm
+
+
+        shm = self._shm.get(idx)
+        if shm and shm.size == shm_size:
+            return shm
+
+
+        # segment was reallocated by another process
+        self._detach(idx)
+
+        shm = shared_memory.SharedMemory(name=self._slotName(idx), create=False)
+        self._shm[idx] = shm
+
+        return shm
+
+
+    def _detach(self, idx):
+        shm = self._shm.pop(idx, None)
+        if not shm:
+            return
+
+        shm.close()
+
+
+    def _unlink(self, idx):
+        try:
+            shm = shared_memory.SharedMemory(name=self._slotName(idx), create=False)
+        except FileNotFoundError:
+            return
+
+        shm.close()
+        shm.unlink()
+
+        self._size[idx] = 0
+        self._serial[idx] = 0
+
+
+    def _find(self, key_bytes):
+        for idx in range(self._slots):
+            if not self._serial[idx]:
+                continue
+
+            shm = self._attach(idx)
+
+            key_len = struct.unpack_from('<Q', shm.buf, 8)[0]
+            if bytes(shm.buf[16:16 + key_len]) == key_bytes:
+                return idx, shm
+
+        return None, None
+
+
+    def put(self, key, data):
+        """Store the encoded image, returns False if the image could not be cached"""
+        key_bytes = str(key).encode()
+        if len(key_bytes) > self.key_size_max:
+            logger.error('Image cache key too large: %d bytes', len(key_bytes))
+            return False
+
+
+        with self._lock:
+            idx, shm = self._find(key_bytes)
+
+            if isinstance(idx, type(None)):
+                # oldest slot
+                idx = min(range(self._slots), key=lambda x: self._serial[x])
+
+            self._serial[idx] = 0  # invalid until written
+
+            try:
+                shm = self._attach(idx, min_size=self.header_size + len(data))
+            except OSError as e:
+                logger.error('Unable to allocate image cache slot: %s', str(e))
+                return False
+
+
+            struct.pack_into('<QQ', shm.buf, 0, len(data), len(key_bytes))
+            shm.buf[16:16 + len(key_bytes)] = key_bytes
+            shm.buf[self.header_size:self.header_size + len(data)] = data
+
+            self._serial[idx] = self._next_serial.value
+            self._next_serial.value += 1
+
+
+        return True
+
+
+    def get(self, key):
+        """Returns a copy of the encoded image or None if it is no longer cached"""
+        key_bytes = str(key).encode()
+
+        with self._lock:
+            try:
+                idx, shm = self._find(key_bytes)
+            except FileNotFoundError:
+                # cache was closed
+                return None
+
+            if isinstance(idx, type(None)):
+                return None
+
+            data_len = struct.unpack_from('<Q', shm.buf, 0)[0]
+
+            return bytes(shm.buf[self.header_size:self.header_size + data_len])
+
+
+    def close(self):
+        with self._lock:
+            for idx in range(self._slots):
+                self._detach(idx)
+                self._unlink(idx)
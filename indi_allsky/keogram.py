@@ -7,6 +7,8 @@ from datetime import datetime
 import logging
 from pprint import pformat
 
+from .encoder import IndiAllSkyEncoder
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -36,6 +38,8 @@ class KeogramGenerator(object):
         self.timestamps_list = list()
         self.image_processing_elapsed_s = 0
 
+        self._encoder = IndiAllSkyEncoder(self.config)
+
 
     @property
     def angle(self):
@@ -141,20 +145,12 @@ class KeogramGenerator(object):
         self.applyLabels(keogram_resized)
 
 
-        write_img_start = time.time()
-
         logger.warning('Creating keogram: %s', outfile)
-        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            cv2.imwrite(str(outfile), keogram_resized, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            cv2.imwrite(str(outfile), keogram_resized, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            cv2.imwrite(str(outfile), keogram_resized, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
-        else:
-            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
 
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
+        try:
+            self._encoder.write(keogram_resized, self.config['IMAGE_FILE_TYPE'], outfile)
+        finally:
+            self._encoder.shutdown()
 
 
     def rotate(self, image):
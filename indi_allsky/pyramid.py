@@ -0,0 +1,40 @@
+import cv2
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyImagePyramid(object):
+    # Grey scale pyramid of the processed frame shared by the detectors.
+    # Level 0 is the full resolution luminance, each following level is
+    # half the size of the previous.  Level 0 is a copy made when the
+    # pyramid is created, so lines and stars drawn on the image afterwards
+    # are not detected.  The other levels are built on first use.
+
+    def __init__(self, data):
+        self._data = data
+
+        if len(data.shape) == 2:
+            self._levels = [data.copy()]
+        else:
+            self._levels = [cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)]
+
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, *args):
+        pass  # read only
+
+
+    def level(self, n):
+        while len(self._levels) <= n:
+            self._levels.append(cv2.pyrDown(self._levels[-1]))
+
+
+        return self._levels[n]
+
@@ -0,0 +1,341 @@
+import time
+import multiprocessing
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # requires python 3.8
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+    resource_tracker = None
+
+import astroalign
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyRegistrationPool(object):
+    # Persistent process pool for image registration.  Each frame is copied
+    # once into a shared memory segment that lives as long as the frame is in
+    # the stack.  Workers attach to the segments by name, only the transforms
+    # are pickled.
+
+    start_timeout = 60.0
+
+
+    def __init__(self, workers):
+        self._workers = max(int(workers), 1)
+        self._executor = None
+
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, *args):
+        pass  # read only
+
+
+    def start(self):
+        if self._executor:
+            return
+
+        start = time.time()
+
+        # workers must share the resource tracker, otherwise each worker
+        # would unlink the segments it attached to when it exits
+        resource_tracker.ensure_running()
+
+        # python 3.9+ only forks a worker when no worker is idle.  Every
+        # worker waits on the barrier until all of them are forked, so each
+        # ping forks a new worker and none are forked later from a thread.
+        mp_context = multiprocessing.get_context('fork')
+        barrier = mp_context.Barrier(self._workers)
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=mp_context,
+            initializer=_initWorker,
+            initargs=(barrier, self.start_timeout),
+        )
+
+        ping_list = [self._executor.submit(_ping) for x in range(self._workers)]
+        for future in ping_list:
+            future.result()
+
+        start_elapsed_s = time.time() - start
+        logger.info('Started %d registration processes in %0.4f s', self._workers, start_elapsed_s)
+
+
+    def shutdown(self):
+        if not self._executor:
+            return
+
+        # results are always collected, nothing is pending
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+    def shareFrame(self, i_ref):
+        data = i_ref['hdulist'][0].data
+
+        shm = i_ref.get('registration_shm')
+        if not shm:
+            shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+
+            frame = numpy.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            frame[:] = data
+            del frame  # release buffer export
+
+            i_ref['registration_shm'] = shm
+
+        return shm.name, data.shape, data.dtype.str
+
+
+    def releaseFrame(self, i_ref):
+        shm = i_ref.pop('registration_shm', None)
+        if not shm:
+            return
+
+        shm.close()
+        shm.unlink()
+
+
+    def findTransforms(self, pair_list):
+        """Returns a (transform, residual) tuple for each (source, target) pair, None on failure"""
+        future_list = list()
+        for source_i_ref, target_i_ref in pair_list:
+            future = self._executor.submit(
+                _findTransform,
+                self.shareFrame(source_i_ref),
+                self.shareFrame(target_i_ref),
+            )
+            future_list.append(future)
+
+
+        result_list = list()
+        for future in future_list:
+            try:
+                result_list.append(future.result())
+            except (astroalign.MaxIterError, ValueError) as e:
+                logger.error('Image registration failure: %s', str(e))
+                result_list.append(None)
+
+        return result_list
+
+
+    def applyTransforms(self, transform_list, reference_i_ref):
+        """Returns the registered data for each (transform, i_ref) pair, None on failure"""
+        target_shape = reference_i_ref['hdulist'][0].data.shape
+
+        task_list = list()
+        for transform, i_ref in transform_list:
+            source_desc = self.shareFrame(i_ref)
+            source_dtype = numpy.dtype(source_desc[2])
+
+            output_shm = shared_memory.SharedMemory(create=True, size=int(numpy.prod(target_shape)) * source_dtype.itemsize)
+            output_desc = (output_shm.name, target_shape, source_dtype.str)
+
+            future = self._executor.submit(_applyTransform, transform, source_desc, output_desc)
+            task_list.append((future, output_shm, output_desc))
+
+
+        result_list = list()
+        for future, output_shm, output_desc in task_list:
+            try:
+                future.result()
+
+                output = numpy.ndarray(output_desc[1], dtype=output_desc[2], buffer=output_shm.buf)
+                result_list.append(output.copy())
+                del output  # release buffer export
+            except ValueError as e:
+                logger.error('Image registration failure: %s', str(e))
+                result_list.append(None)
+            finally:
+                output_shm.close()
+                output_shm.unlink()
+
+        return result_list
+
+
+
+
+class IndiAllSkyRegistrationLocal(object):
+    # Registration in the calling process, used when shared memory is not
+    # available (python 3.7).  Same interface as the process pool.
+
+    def __init__(self, *args):
+        pass
+
+
+    @property
+    def workers(self):
+        return 1
+
+    @workers.setter
+    def workers(self, *args):
+        pass  # read only
+
+
+    def start(self):
+        pass
+
+
+    def shutdown(self):
+        pass
+
+
+    def releaseFrame(self, i_ref):
+        pass
+
+
+    def findTransforms(self, pair_list):
+        """Returns a (transform, residual) tuple for each (source, target) pair, None on failure"""
+        result_list = list()
+        for source_i_ref, target_i_ref in pair_list:
+            try:
+                result = _findTransformData(
+                    source_i_ref['hdulist'][0].data,
+                    target_i_ref['hdulist'][0].data,
+                )
+                result_list.append(result)
+            except (astroalign.MaxIterError, ValueError) as e:
+                logger.error('Image registration failure: %s', str(e))
+                result_list.append(None)
+
+        return result_list
+
+
+    def applyTransforms(self, transform_list, reference_i_ref):
+        """Returns the registered data for each (transform, i_ref) pair, None on failure"""
+        target_shape = reference_i_ref['hdulist'][0].data.shape
+
+        result_list = list()
+        for transform, i_ref in transform_list:
+            data = i_ref['hdulist'][0].data
+
+            try:
+                result_list.append(_applyTransformData(transform, data, target_shape, data.dtype))
+            except ValueError as e:
+                logger.error('Image registration failure: %s', str(e))
+                result_list.append(None)
+
+        return result_list
+
+
+
+### Functions below run in the worker processes
+
+def _initWorker(barrier, timeout):
+    barrier.wait(timeout)
+
+
+def _ping():
+    return True
+
+
+def _attach(desc):
+    name, shape, dtype = desc
+
+    shm = shared_memory.SharedMemory(name=name, create=False)
+    data = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=shm.buf)
+
+    return shm, data
+
+
+def _copyFrame(desc, crop=False):
+    # the segment is closed before any work so exceptions cannot hold a view
+    shm, data = _attach(desc)
+
+    if crop:
+        frame = _crop(data).copy()
+    else:
+        frame = data.copy()
+
+    del data  # release buffer export
+    shm.close()
+
+    return frame
+
+
+def _crop(image):
+    image_height, image_width = image.shape[:2]
+
+    x1 = int((image_width / 3) - (image_width / 3))
+    y1 = int((image_height / 3) - (image_height / 3))
+    x2 = int((image_width / 3) + (image_width / 3))
+    y2 = int((image_height / 3) + (image_height / 3))
+
+
+    return image[
+        y1:y2,
+        x1:x2,
+    ]
+
+
+def _findTransform(source_desc, target_desc):
+    return _findTransformData(
+        _copyFrame(source_desc, crop=True),
+        _copyFrame(target_desc, crop=True),
+        cropped=True,
+    )
+
+
+def _findTransformData(source, target, cropped=False):
+    # detection_sigma default = 5
+    # max_control_points default = 50
+    # min_area default = 5
+
+    if not cropped:
+        source = _crop(source)
+        target = _crop(target)
+
+    ### Find transform using a crop of the image
+    transform, (source_list, target_list) = astroalign.find_transform(
+        source,
+        target,
+        detection_sigma=7,
+        max_control_points=100,
+        min_area=15,
+    )
+
+    # RMS distance of the control points after the transform
+    residual = float(numpy.sqrt(numpy.mean(numpy.sum((transform(source_list) - target_list) ** 2, axis=1))))
+
+    return transform, residual
+
+
+def _applyTransform(transform, source_desc, output_desc):
+    reg_data = _applyTransformData(
+        transform,
+        _copyFrame(source_desc),
+        output_desc[1],
+        numpy.dtype(output_desc[2]),
+    )
+
+    output_shm, output = _attach(output_desc)
+    output[:] = reg_data
+    del output  # release buffer export
+    output_shm.close()
+
+
+def _applyTransformData(transform, source, output_shape, output_dtype):
+    reg_data, footprint = astroalign.apply_transform(
+        transform,
+        source,
+        numpy.empty(output_shape, dtype=numpy.uint8),  # only the target shape is used
+    )
+
+    if numpy.issubdtype(output_dtype, numpy.integer):
+        # registered data is float
+        type_info = numpy.iinfo(output_dtype)
+        numpy.clip(numpy.rint(reg_data), type_info.min, type_info.max, out=reg_data)
+
+    return reg_data.astype(output_dtype)
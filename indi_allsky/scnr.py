@@ -61,8 +61,7 @@ class IndiAllskyScnr(object):
 
         start = time.time()
 
-        m = numpy.add(r, b) * 0.5
-        g = numpy.minimum(g, m.astype(numpy.uint8))
+        g = self._average_neutral_green(b, g, r)
 
         elapsed_s = time.time() - start
         logger.info('SCNR average neutral in %0.4f s', elapsed_s)
@@ -82,8 +81,7 @@ class IndiAllskyScnr(object):
 
         start = time.time()
 
-        m = numpy.maximum(r, b)
-        g = numpy.minimum(g, m)
+        g = self._maximum_neutral_green(b, g, r)
 
         elapsed_s = time.time() - start
         logger.info('SCNR maximum neutral in %0.4f s', elapsed_s)
@@ -91,3 +89,17 @@ class IndiAllskyScnr(object):
         return cv2.merge((b, g, r))
 
 
+    def neutral_green(self, algo, b, g, r):
+        """Returns the neutralized green channel, raises AttributeError for unknown algorithms"""
+        green_function = getattr(self, '_{0:s}_green'.format(algo))
+        return green_function(b, g, r)
+
+
+    def _average_neutral_green(self, b, g, r):
+        m = numpy.add(r, b) * 0.5
+        return numpy.minimum(g, m.astype(numpy.uint8))
+
+
+    def _maximum_neutral_green(self, b, g, r):
+        m = numpy.maximum(r, b)
+        return numpy.minimum(g, m)
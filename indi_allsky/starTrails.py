@@ -1,4 +1,3 @@
-import os
 import cv2
 import numpy
 import time
@@ -6,6 +5,8 @@ from pathlib import Path
 import tempfile
 import logging
 
+from .encoder import IndiAllSkyEncoder
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -38,6 +39,9 @@ class StarTrailGenerator(object):
         self._timelapse_frame_count = 0
         self._timelapse_frame_list = list()
 
+        # timelapse frames are written in the background
+        self._encoder = IndiAllSkyEncoder(self.config)
+
 
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
@@ -187,17 +191,9 @@ class StarTrailGenerator(object):
 
             f_tmp_frame_p = Path(f_tmp_frame.name)
 
-            if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-                cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
-            elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-                cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-            elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-                cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
-            else:
-                raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
-
-            # put original mtime on file
-            os.utime(f_tmp_frame_p, times=(image_mtime, image_mtime))
+            # cv2.max() returns a new array, the trail image is not modified while encoding
+            # original mtime is put on the file
+            self._encoder.submitWrite(self.trail_image, self.config['IMAGE_FILE_TYPE'], f_tmp_frame_p, mtime=image_mtime)
 
             self._timelapse_frame_list.append(f_tmp_frame_p)
             self._timelapse_frame_count += 1
@@ -216,23 +212,18 @@ class StarTrailGenerator(object):
             self.trail_image = self.placeholder_image
 
 
-        write_img_start = time.time()
-
         logger.warning('Creating star trail: %s', outfile)
-        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-            cv2.imwrite(str(outfile), self.trail_image, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-            cv2.imwrite(str(outfile), self.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            cv2.imwrite(str(outfile), self.trail_image, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
-        else:
-            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
 
-        write_img_elapsed_s = time.time() - write_img_start
-        logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
+        try:
+            self._encoder.write(self.trail_image, self.config['IMAGE_FILE_TYPE'], outfile)
+        finally:
+            # wait for the timelapse frames
+            self._encoder.shutdown()
 
 
     def cleanup(self):
+        self._encoder.shutdown()
+
         # cleanup the folder
         self.timelapse_tmpdir.cleanup()
 
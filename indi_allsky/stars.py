@@ -4,14 +4,33 @@ import cv2
 import numpy
 import logging
 
+from .pyramid import IndiAllSkyImagePyramid
+
 
 logger = logging.getLogger('indi_allsky')
 
 
 class IndiAllSkyStars(object):
+    # Star detection engines selected with DETECT_STARS_METHOD
+    #   peaks   - template match with local maxima suppression
+    #   legacy  - template match with the original de-duplication loop
+    #   extract - threshold above a background mesh model, faster and not
+    #             affected by the gradient around the moon
+    # Each star is returned as (x, y, flux, fwhm, ellipticity)
 
     _distanceThreshold = 10
 
+    background_box_size = 64  # pixels per background mesh cell
+    extract_filter_sigma = 1.0
+    extract_min_area = 3
+    extract_max_area = 400
+    extract_noise_sample_step = 4
+
+    pyramid_threshold_factor = 0.75  # candidates are accepted below the detection threshold
+    pyramid_block_size = 64  # full resolution blocks matched around candidates
+
+    limiting_mag_percentile = 95  # faintest stars for the limiting magnitude estimate
+
 
     def __init__(self, config, bin_v, mask=None):
         self.config = config
@@ -47,26 +66,197 @@ class IndiAllSkyStars(object):
 
         self.star_template_w, self.star_template_h = self.star_template.shape[::-1]
 
+        # offset from the match position to the center of the template
+        template_moments = cv2.moments(self.star_template)
+        self._template_cx = template_moments['m10'] / template_moments['m00']
+        self._template_cy = template_moments['m01'] / template_moments['m00']
+
+
+        # peaks and legacy use template matching, extract uses the background model
+        self._method = self.config.get('DETECT_STARS_METHOD', 'peaks')
+        if self._method not in ('peaks', 'legacy', 'extract'):
+            logger.error('Unknown star detection method: %s', self._method)
+            self._method = 'peaks'
+
+        self._subpixel = self.config.get('DETECT_STARS_SUBPIXEL', False)
+
+        # template matching starts on a downsampled pyramid level
+        self._pyramid_levels = min(max(int(self.config.get('DETECT_STARS_PYRAMID', 0)), 0), 2)
+        self._coarse_templates = dict()
+
+        # peaks closer than the distance threshold are the same star
+        self._nms_kernel = numpy.ones((self._distanceThreshold * 2 - 1, self._distanceThreshold * 2 - 1), dtype=numpy.uint8)
+
+        # extraction threshold above the background noise
+        self._extract_sigma = self.config.get('DETECT_STARS_SIGMA', 5.0)
 
-    def detectObjects(self, original_data):
+        # flux aperture and background annulus, relative to the star center
+        self._flux_radius = 3
+        self._background_radius = 7
+
+
+    def detectObjects(self, original_data, pyramid=None):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_data)
 
-        masked_img = cv2.bitwise_and(original_data, original_data, mask=self._sqm_mask)
+        if isinstance(pyramid, type(None)):
+            pyramid = IndiAllSkyImagePyramid(original_data)
 
-        if len(original_data.shape) == 2:
-            # gray scale or bayered
-            grey_img = masked_img
-        else:
-            # assume color
-            grey_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+        grey_img = cv2.bitwise_and(pyramid.level(0), pyramid.level(0), mask=self._sqm_mask)
 
 
         sep_start = time.time()
 
 
-        result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
+        if self._method == 'extract':
+            x, y = self._extractSources(grey_img)
+        elif self._pyramid_levels:
+            x, y = self._matchPyramid(grey_img, pyramid)
+        else:
+            result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
+            x, y = self._matchPeaks(result)
+
+
+        blobs = self._measure(grey_img, x, y)
+
+
+        sep_elapsed_s = time.time() - sep_start
+        logger.info('Star detection (%s) in %0.4f s', self._method, sep_elapsed_s)
+
+        logger.info('Found %d objects', len(blobs))
+
+        self._drawCircles(original_data, blobs)
+
+        return blobs
+
+
+    def _matchPeaks(self, result):
+        if self._method == 'legacy':
+            peak_list = self._findPeaksLegacy(result)
+        else:
+            peak_list = self._findPeaks(result)
+
+        return self._peakCenters(result, peak_list)
+
+
+    def _matchPyramid(self, grey_img, pyramid):
+        # candidates from a downsampled level, only the blocks containing
+        # candidates are matched at full resolution
+        level = self._pyramid_levels
+        scale = 2 ** level
+
+        coarse_img = pyramid.level(level)
+        coarse_template, coarse_cx, coarse_cy = self._coarseTemplate(level)
+
+        coarse_mask = cv2.resize(self._sqm_mask, (coarse_img.shape[1], coarse_img.shape[0]), interpolation=cv2.INTER_NEAREST)
+        coarse_img = cv2.bitwise_and(coarse_img, coarse_img, mask=coarse_mask)
+
+        coarse_result = cv2.matchTemplate(coarse_img, coarse_template, cv2.TM_CCOEFF_NORMED)
+
+
+        # local maxima above the reduced threshold
+        candidate_mask = cv2.compare(coarse_result, cv2.dilate(coarse_result, numpy.ones((3, 3), dtype=numpy.uint8)), cv2.CMP_GE)
+        candidate_mask[coarse_result < self._detectionThreshold * self.pyramid_threshold_factor] = 0
+
+        candidate_y, candidate_x = numpy.nonzero(candidate_mask)
+
+
+        result_height = grey_img.shape[0] - self.star_template_h + 1
+        result_width = grey_img.shape[1] - self.star_template_w + 1
+
+        block = self.pyramid_block_size
+        pad = scale * 2  # position uncertainty of the coarse level
+
+        # coarse result to full result coordinates
+        offset_x = int(round((coarse_cx * scale) - self._template_cx))
+        offset_y = int(round((coarse_cy * scale) - self._template_cy))
+
+        blocks_h = -(-result_height // block)
+        blocks_w = -(-result_width // block)
+
+        block_x = numpy.clip(((candidate_x * scale) + offset_x) // block, 0, blocks_w - 1)
+        block_y = numpy.clip(((candidate_y * scale) + offset_y) // block, 0, blocks_h - 1)
+
+        block_mask = numpy.zeros((blocks_h, blocks_w), dtype=numpy.bool_)
+        block_mask[block_y, block_x] = True
+
+
+        # the response outside of the matched blocks is below any threshold
+        result = numpy.full((result_height, result_width), -1.0, dtype=numpy.float32)
+
+        for by in range(blocks_h):
+            row = block_mask[by]
+            if not row.any():
+                continue
+
+            # runs of neighboring blocks are matched together
+            edges = numpy.diff(numpy.concatenate(([0], row.view(numpy.int8), [0])))
+            run_starts = numpy.flatnonzero(edges == 1)
+            run_ends = numpy.flatnonzero(edges == -1)
+
+            y1 = max((by * block) - pad, 0)
+            y2 = min(((by + 1) * block) + pad, result_height)
+
+            for run_start, run_end in zip(run_starts, run_ends):
+                x1 = max((run_start * block) - pad, 0)
+                x2 = min((run_end * block) + pad, result_width)
+
+                window = grey_img[y1:y2 + self.star_template_h - 1, x1:x2 + self.star_template_w - 1]
+                result[y1:y2, x1:x2] = cv2.matchTemplate(window, self.star_template, cv2.TM_CCOEFF_NORMED)
+
+
+        logger.info(
+            'Matched %d of %d blocks from %d candidates on pyramid level %d',
+            numpy.count_nonzero(block_mask),
+            block_mask.size,
+            len(candidate_x),
+            level,
+        )
+
+        return self._matchPeaks(result)
+
+
+    def _coarseTemplate(self, level):
+        template = self._coarse_templates.get(level)
+        if not isinstance(template, type(None)):
+            return template
+
+
+        coarse_template = self.star_template
+        for x in range(level):
+            coarse_template = cv2.pyrDown(coarse_template)
+
+        template_moments = cv2.moments(coarse_template)
+
+        template = (
+            coarse_template,
+            template_moments['m10'] / template_moments['m00'],
+            template_moments['m01'] / template_moments['m00'],
+        )
+
+        self._coarse_templates[level] = template
+
+        return template
+
+
+    def _findPeaks(self, result):
+        # local maxima of the match response, any smaller response within
+        # the distance threshold is suppressed
+        dilated = cv2.dilate(result, self._nms_kernel)
+
+        peak_mask = cv2.compare(result, dilated, cv2.CMP_GE)
+        peak_mask[result < self._detectionThreshold] = 0
+
+
+        # neighboring pixels with the same response are a single peak
+        n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(peak_mask, connectivity=8)
+
+        return numpy.rint(centroids[1:]).astype(numpy.int32)  # label 0 is the background
+
+
+    def _findPeaksLegacy(self, result):
+        # original de-duplication, the first point found in each area is kept
         result_filter = numpy.where(result >= self._detectionThreshold)
 
         blobs = list()
@@ -80,14 +270,252 @@ class IndiAllSkyStars(object):
                 blobs.append(pt)
 
 
-        sep_elapsed_s = time.time() - sep_start
-        logger.info('Star detection in %0.4f s', sep_elapsed_s)
+        return numpy.array(blobs, dtype=numpy.int32).reshape((-1, 2))
 
-        logger.info('Found %d objects', len(blobs))
 
-        self._drawCircles(original_data, blobs)
+    def _peakCenters(self, result, peak_list):
+        # star centers in image coordinates
+        px = peak_list[:, 0]
+        py = peak_list[:, 1]
 
-        return blobs
+        x = px + self._template_cx
+        y = py + self._template_cy
+
+
+        if self._subpixel and len(peak_list):
+            # parabola through the response of the neighboring pixels
+            r_pad = cv2.copyMakeBorder(result, 1, 1, 1, 1, cv2.BORDER_REPLICATE)
+
+            r_c = r_pad[py + 1, px + 1]
+            r_l = r_pad[py + 1, px]
+            r_r = r_pad[py + 1, px + 2]
+            r_t = r_pad[py, px + 1]
+            r_b = r_pad[py + 2, px + 1]
+
+            denom_x = r_l - (2 * r_c) + r_r
+            denom_y = r_t - (2 * r_c) + r_b
+
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                dx = numpy.where(denom_x < 0, (r_l - r_r) / (2 * denom_x), 0.0)
+                dy = numpy.where(denom_y < 0, (r_t - r_b) / (2 * denom_y), 0.0)
+
+            x = x + numpy.clip(dx, -0.5, 0.5)
+            y = y + numpy.clip(dy, -0.5, 0.5)
+
+
+        return x, y
+
+
+    def _extractSources(self, grey_img):
+        # pixels above the background model by the threshold, grouped into sources
+        background, rms = self._backgroundMesh(grey_img)
+
+        sub_img = grey_img.astype(numpy.float32) - background
+
+        # matched filter for detection only
+        filtered_img = cv2.GaussianBlur(sub_img, (0, 0), self.extract_filter_sigma)
+
+        # the filter reduces the noise, measured since image noise is not independent between pixels
+        sample_mask = self._sqm_mask[::self.extract_noise_sample_step, ::self.extract_noise_sample_step] > 0
+        sub_sample = sub_img[::self.extract_noise_sample_step, ::self.extract_noise_sample_step][sample_mask]
+        filtered_sample = filtered_img[::self.extract_noise_sample_step, ::self.extract_noise_sample_step][sample_mask]
+
+        sub_mad = numpy.median(numpy.abs(sub_sample - numpy.median(sub_sample))) if sub_sample.size else 0.0
+        filtered_mad = numpy.median(numpy.abs(filtered_sample - numpy.median(filtered_sample))) if filtered_sample.size else 0.0
+
+        if sub_mad > 0:
+            noise_factor = min(filtered_mad / sub_mad, 1.0)
+        else:
+            noise_factor = 1.0
+
+        detect_mask = cv2.compare(filtered_img, rms * (self._extract_sigma * noise_factor), cv2.CMP_GT)
+        detect_mask[self._sqm_mask == 0] = 0
+
+
+        n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(detect_mask, connectivity=8)
+
+        area = stats[:, cv2.CC_STAT_AREA]
+
+
+        # flux weighted centroids of each source
+        ys, xs = numpy.nonzero(labels)
+        pixel_labels = labels[ys, xs]
+        weights = numpy.maximum(sub_img[ys, xs], 0.0)
+
+        flux = numpy.bincount(pixel_labels, weights=weights, minlength=n_labels)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x = numpy.bincount(pixel_labels, weights=weights * xs, minlength=n_labels) / flux
+            y = numpy.bincount(pixel_labels, weights=weights * ys, minlength=n_labels) / flux
+
+
+        source_filter = (area >= self.extract_min_area) & (area <= self.extract_max_area) & (flux > 0)
+        source_filter[0] = False  # background label
+
+        return x[source_filter], y[source_filter]
+
+
+    def _backgroundMesh(self, grey_img):
+        # median and noise of coarse cells, interpolated to full resolution
+        box = self.background_box_size
+
+        image_height, image_width = grey_img.shape[:2]
+
+        mesh_h = -(-image_height // box)
+        mesh_w = -(-image_width // box)
+
+        pad_y = (mesh_h * box) - image_height
+        pad_x = (mesh_w * box) - image_width
+
+        data = cv2.copyMakeBorder(grey_img, 0, pad_y, 0, pad_x, cv2.BORDER_CONSTANT, value=0)
+        mask = cv2.copyMakeBorder(self._sqm_mask, 0, pad_y, 0, pad_x, cv2.BORDER_CONSTANT, value=0)
+
+
+        # one row per cell
+        cells = data.reshape(mesh_h, box, mesh_w, box).transpose(0, 2, 1, 3).reshape(mesh_h * mesh_w, box * box)
+        mask_cells = mask.reshape(mesh_h, box, mesh_w, box).transpose(0, 2, 1, 3).reshape(mesh_h * mesh_w, box * box)
+
+        valid = numpy.count_nonzero(mask_cells, axis=1)
+
+
+        # masked pixels are 0 and sort first, percentiles are taken from the valid pixels
+        cells = numpy.sort(cells, axis=1, kind='stable')
+
+        cell_idx = numpy.arange(mesh_h * mesh_w)
+        first_valid = (box * box) - valid
+
+        def percentile(q):
+            idx = numpy.minimum(first_valid + (valid * q).astype(numpy.int32), (box * box) - 1)
+            return cells[cell_idx, idx].astype(numpy.float32)
+
+        median = percentile(0.5)
+        sigma = numpy.maximum((percentile(0.75) - percentile(0.25)) / 1.349, 1.0)
+
+
+        # mostly masked cells use the typical value of the other cells
+        good = valid >= (box * box) // 2
+        if numpy.any(good):
+            median[~good] = numpy.median(median[good])
+            sigma[~good] = numpy.median(sigma[good])
+
+
+        # median filter the mesh to remove stars and small artifacts
+        median_mesh = cv2.medianBlur(median.reshape(mesh_h, mesh_w), 3)
+        sigma_mesh = cv2.medianBlur(sigma.reshape(mesh_h, mesh_w), 3)
+
+        background = cv2.resize(median_mesh, (mesh_w * box, mesh_h * box), interpolation=cv2.INTER_LINEAR)
+        rms = cv2.resize(sigma_mesh, (mesh_w * box, mesh_h * box), interpolation=cv2.INTER_LINEAR)
+
+        return background[:image_height, :image_width], rms[:image_height, :image_width]
+
+
+    def _measure(self, grey_img, x, y):
+        # background subtracted flux, FWHM and ellipticity at the star centers
+        if not len(x):
+            return list()
+
+
+        image_height, image_width = grey_img.shape[:2]
+
+        r = self._background_radius
+        offsets = numpy.arange(-r, r + 1)
+        off_x, off_y = numpy.meshgrid(offsets, offsets)
+        dist2 = (off_x ** 2) + (off_y ** 2)
+
+        aperture = dist2 <= self._flux_radius ** 2
+        core = dist2 <= (self._flux_radius + 1) ** 2
+        annulus = (dist2 > (self._flux_radius + 1) ** 2) & (dist2 <= r ** 2)
+
+
+        # patches are shifted inside the image at the edges, the moments
+        # below are still taken about the star center
+        cx = numpy.clip(numpy.rint(x).astype(numpy.int32), r, image_width - 1 - r)
+        cy = numpy.clip(numpy.rint(y).astype(numpy.int32), r, image_height - 1 - r)
+
+        # gather from the flattened image, take() is much faster than 2D fancy indexing
+        patch_index = ((cy * image_width) + cx)[:, None, None] + ((off_y * image_width) + off_x)[None, :, :]
+
+        patches = numpy.take(grey_img, patch_index).astype(numpy.float32)
+
+
+        # median by partition, cheaper than a full sort
+        annulus_data = patches[:, annulus]
+        annulus_count = annulus_data.shape[1]
+        mid = annulus_count // 2
+        if annulus_count % 2:
+            background = numpy.partition(annulus_data, mid, axis=1)[:, mid]
+        else:
+            annulus_data = numpy.partition(annulus_data, (mid - 1, mid), axis=1)
+            background = (annulus_data[:, mid - 1] + annulus_data[:, mid]) / 2
+
+        patches -= background[:, None, None]
+
+        flux = numpy.maximum(patches[:, aperture].sum(axis=1), 0.0)
+
+
+        # second moments about the star center
+        weights = numpy.maximum(patches[:, core], 0.0)
+        dx = off_x[core][None, :] - (x - cx)[:, None]
+        dy = off_y[core][None, :] - (y - cy)[:, None]
+
+        weights_sum = weights.sum(axis=1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            i_xx = (weights * (dx ** 2)).sum(axis=1) / weights_sum
+            i_yy = (weights * (dy ** 2)).sum(axis=1) / weights_sum
+            i_xy = (weights * dx * dy).sum(axis=1) / weights_sum
+
+        valid = weights_sum > 0
+        i_xx = numpy.where(valid, i_xx, 0.0)
+        i_yy = numpy.where(valid, i_yy, 0.0)
+        i_xy = numpy.where(valid, i_xy, 0.0)
+
+        fwhm = 2.3548 * numpy.sqrt((i_xx + i_yy) / 2)
+
+
+        # axis ratio from the eigenvalues of the moment matrix
+        spread = numpy.sqrt((((i_xx - i_yy) / 2) ** 2) + (i_xy ** 2))
+        major = ((i_xx + i_yy) / 2) + spread
+        minor = numpy.maximum(((i_xx + i_yy) / 2) - spread, 0.0)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ellipticity = numpy.where(major > 0, 1.0 - numpy.sqrt(minor / major), 0.0)
+
+
+        return list(zip(x.tolist(), y.tolist(), flux.tolist(), fwhm.tolist(), ellipticity.tolist()))
+
+
+    def statistics(self, blob_list, exposure):
+        # per frame summary of the detected stars
+        stats = {
+            'fwhm'         : None,
+            'flux'         : None,
+            'ellipticity'  : None,
+            'limiting_mag' : None,
+        }
+
+        if not blob_list:
+            return stats
+
+
+        blob_data = numpy.array(blob_list, dtype=numpy.float64)
+
+        flux = blob_data[:, 2]
+        measured = flux > 0
+
+        if not numpy.any(measured):
+            return stats
+
+
+        stats['fwhm'] = float(numpy.median(blob_data[measured, 3]))
+        stats['flux'] = float(numpy.median(flux[measured]))
+        stats['ellipticity'] = float(numpy.median(blob_data[measured, 4]))
+
+        # instrumental magnitude of the faint end of the detections, normalized by exposure
+        instrumental_mag = -2.5 * numpy.log10(flux[measured] / max(exposure, 0.000001))
+        stats['limiting_mag'] = float(numpy.percentile(instrumental_mag, self.limiting_mag_percentile))
+
+        return stats
 
 
     def _generateSqmMask(self, img):
@@ -135,11 +563,11 @@ class IndiAllSkyStars(object):
 
         logger.info('Draw circles around objects')
         for blob in blob_list:
-            x, y = blob
+            x, y = blob[:2]
 
             center = (
-                int(x + (self.star_template_w / 2)) + 1,
-                int(y + (self.star_template_h / 2)) + 1,
+                int(round(x)),
+                int(round(y)),
             )
 
             cv2.circle(
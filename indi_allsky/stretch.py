@@ -0,0 +1,115 @@
+import time
+import math
+import logging
+
+import cv2
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyStretch(object):
+    # Converts image data to 8 bits through a lookup table built from the
+    # configured curve.  The table is cached per bit depth, so each frame
+    # only costs one table lookup per pixel.
+    #
+    #   linear - original divide by 2^(bit depth) / 255
+    #   gamma  - x^(1 / gamma)
+    #   asinh  - asinh(factor * x) / asinh(factor)
+    #   mtf    - PixInsight midtones transfer function with shadow clipping
+
+    def __init__(self, config):
+        self.config = config
+
+        stretch_config = self.config.get('IMAGE_STRETCH', {})
+
+        self.curve = stretch_config.get('CURVE', 'linear')
+        self.gamma = float(stretch_config.get('GAMMA', 2.2))
+        self.asinh_factor = float(stretch_config.get('ASINH_FACTOR', 20.0))
+        self.mtf_midtones = float(stretch_config.get('MTF_MIDTONES', 0.25))
+        self.mtf_shadows = float(stretch_config.get('MTF_SHADOWS', 0.0))
+
+        # (image_bitpix, image_bit_depth) -> table
+        self._lut_cache = dict()
+
+
+    def apply(self, data, image_bitpix, image_bit_depth):
+        if image_bitpix == 8 and self.curve == 'linear':
+            # nothing to do
+            return data
+
+
+        lut = self._getLut(image_bitpix, image_bit_depth)
+
+        if image_bitpix == 8:
+            return cv2.LUT(data, lut)
+
+        return lut[data]
+
+
+    def _getLut(self, image_bitpix, image_bit_depth):
+        lut_key = (image_bitpix, image_bit_depth)
+
+        lut = self._lut_cache.get(lut_key)
+        if not isinstance(lut, type(None)):
+            return lut
+
+
+        start = time.time()
+
+        try:
+            curve_function = getattr(self, '_{0:s}'.format(self.curve))
+        except AttributeError:
+            logger.error('Unknown stretch curve: %s', self.curve)
+            curve_function = self._linear
+
+
+        values = numpy.arange(2 ** image_bitpix, dtype=numpy.float64)
+        lut = curve_function(values, image_bit_depth)
+
+        self._lut_cache[lut_key] = lut
+
+        elapsed_s = time.time() - start
+        logger.info('Built %s stretch table for %d bit data in %0.4f s', self.curve, image_bit_depth, elapsed_s)
+
+        return lut
+
+
+    def _normalize(self, values, image_bit_depth):
+        max_val = (2 ** image_bit_depth) - 1
+        return numpy.clip(values / max_val, 0.0, 1.0)
+
+
+    def _to8bit(self, y):
+        return numpy.rint(numpy.clip(y, 0.0, 1.0) * 255).astype(numpy.uint8)
+
+
+    def _linear(self, values, image_bit_depth):
+        div_factor = int((2 ** image_bit_depth) / 255)
+
+        # same result as the original float division, values above the bit depth are clipped
+        return numpy.minimum(values / div_factor, 255).astype(numpy.uint8)
+
+
+    def _gamma(self, values, image_bit_depth):
+        x = self._normalize(values, image_bit_depth)
+        return self._to8bit(numpy.power(x, 1.0 / self.gamma))
+
+
+    def _asinh(self, values, image_bit_depth):
+        x = self._normalize(values, image_bit_depth)
+        return self._to8bit(numpy.arcsinh(self.asinh_factor * x) / math.asinh(self.asinh_factor))
+
+
+    def _mtf(self, values, image_bit_depth):
+        x = self._normalize(values, image_bit_depth)
+
+        # shadow clipping
+        c0 = min(max(self.mtf_shadows, 0.0), 0.99)
+        x = numpy.clip((x - c0) / (1.0 - c0), 0.0, 1.0)
+
+        m = min(max(self.mtf_midtones, 0.001), 0.999)
+
+        return self._to8bit(((m - 1) * x) / (((2 * m) - 1) * x - m))
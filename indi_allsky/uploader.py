@@ -28,6 +28,7 @@ class FileUploader(Process):
         config,
         error_q,
         upload_q,
+        image_cache=None,
     ):
         super(FileUploader, self).__init__()
 
@@ -38,6 +39,8 @@ class FileUploader(Process):
         self.error_q = error_q
         self.upload_q = upload_q
 
+        self.image_cache = image_cache
+
 
     def run(self):
         ### use this as a method to log uncaught exceptions
@@ -85,10 +88,21 @@ class FileUploader(Process):
             local_file = task.data.get('local_file')
             remote_file = task.data.get('remote_file')
             remove_local = task.data.get('remove_local')
+            cache_key = task.data.get('cache_key')
 
             mq_data = task.data.get('mq_data')
 
 
+            # the encoded image is still in memory, no need to read the file
+            if cache_key and self.image_cache:
+                local_data = self.image_cache.get(cache_key)
+
+                if isinstance(local_data, type(None)):
+                    logger.warning('Image %s is no longer cached, reading %s', cache_key, local_file)
+            else:
+                local_data = None
+
+
             # Build parameters
             if action == 'upload':
                 connect_kwargs = {
@@ -102,6 +116,7 @@ class FileUploader(Process):
 
                 put_kwargs = {
                     'local_file'  : Path(local_file),
+                    'local_data'  : local_data,
                     'remote_file' : Path(remote_file),
                 }
 
@@ -130,6 +145,7 @@ class FileUploader(Process):
 
                 put_kwargs = {
                     'local_file'  : Path(local_file),
+                    'local_data'  : local_data,
                     'base_topic'  : self.config['MQTTPUBLISH']['BASE_TOPIC'],
                     'qos'         : self.config['MQTTPUBLISH']['QOS'],
                     'mq_data'     : mq_data,
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Accuracy and speed of the decimated ADU meter compared with the full frame
+# measurement (debayer, stretch, grayscale, masked mean)
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stretch import IndiAllSkyStretch
+from indi_allsky.aduMeter import IndiAllSkyAduMeter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class AduMeterReport(object):
+
+    width  = 3008
+    height = 3008
+
+    image_bit_depth = 12
+
+    stride_list = (2, 4, 8, 16, 32)
+    rounds = 5
+
+    config = {
+        'IMAGE_FLIP_V' : True,
+        'IMAGE_FLIP_H' : True,
+    }
+
+
+    def __init__(self):
+        self.bin_v = FakeValue(1)
+        self._stretch = IndiAllSkyStretch(self.config)  # linear
+
+        self.stretch_func = lambda x: self._stretch.apply(x, 16, self.image_bit_depth)
+
+
+    def main(self):
+        for scene, level in (('night', 150), ('twilight', 800), ('day', 2500)):
+            data = self.generateScene(level)
+
+            start = time.time()
+            for x in range(self.rounds):
+                full_adu = self.fullFrame(data)
+            full_s = (time.time() - start) / self.rounds
+
+            logger.info('*** %s - full frame ADU %0.2f in %0.4f s ***', scene, full_adu, full_s)
+
+
+            for stride in self.stride_list:
+                config = dict(self.config)
+                config['ADU_METER_STRIDE'] = stride
+
+                meter = IndiAllSkyAduMeter(config, self.bin_v)
+                meter.measure(data, 'RGGB', self.stretch_func)  # generate mask
+
+                start = time.time()
+                for x in range(self.rounds):
+                    adu = meter.measure(data, 'RGGB', self.stretch_func)
+                meter_s = (time.time() - start) / self.rounds
+
+                logger.info(
+                    'Stride %2d - ADU %0.2f, error %0.3f (%0.2f%%), %0.4f s (%0.1fx)',
+                    stride,
+                    adu,
+                    adu - full_adu,
+                    abs(adu - full_adu) / full_adu * 100,
+                    meter_s,
+                    full_s / meter_s,
+                )
+
+
+    def generateScene(self, level):
+        # radial vignette, smooth sky gradient, stars and noise
+        y, x = numpy.mgrid[0:self.height, 0:self.width]
+        r = numpy.hypot(y - (self.height / 2), x - (self.width / 2)) / (min(self.height, self.width) / 2)
+
+        sky = level * numpy.clip(1.2 - r, 0.0, 1.0) * (1.0 + (0.3 * x / self.width))
+        sky += numpy.random.normal(0, level * 0.05 + 5, size=sky.shape)
+
+        star_count = 2000
+        sy = numpy.random.randint(self.height, size=star_count)
+        sx = numpy.random.randint(self.width, size=star_count)
+        sky[sy, sx] += numpy.random.uniform(500, 4000, size=star_count)
+
+        return numpy.clip(sky, 0, (2 ** self.image_bit_depth) - 1).astype(numpy.uint16)
+
+
+    def fullFrame(self, data):
+        data_bgr = cv2.cvtColor(data, cv2.COLOR_BAYER_BG2BGR)  # RGGB
+        data_8bit = self._stretch.apply(data_bgr, 16, self.image_bit_depth)
+
+        data_8bit = cv2.flip(data_8bit, 0)
+        data_8bit = cv2.flip(data_8bit, 1)
+
+        mask = numpy.zeros(data_8bit.shape[:2], dtype=numpy.uint8)
+        cv2.rectangle(
+            img=mask,
+            pt1=(int((self.width / 2) - (self.width / 3)), int((self.height / 2) - (self.height / 3))),
+            pt2=(int((self.width / 2) + (self.width / 3)), int((self.height / 2) + (self.height / 3))),
+            color=(255),
+            thickness=cv2.FILLED,
+        )
+
+        data_mono = cv2.cvtColor(data_8bit, cv2.COLOR_BGR2GRAY)
+
+        return cv2.mean(src=data_mono, mask=mask)[0]
+
+
+class FakeValue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+if __name__ == "__main__":
+    r = AduMeterReport()
+    r.main()
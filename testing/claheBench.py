@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Compare the original per frame CLAHE with LAB split/merge to the cached
+# CLAHE implementation with YCrCb luminance and banded threads
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.contrast import IndiAllSkyContrastEnhance
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class ClaheBench(object):
+
+    size_list = (
+        (1920, 1080),  # 1080p
+        (3840, 2160),  # 4k
+        (5472, 3648),  # 20mp
+    )
+
+    band_list = (1, 2, 4)
+
+    rounds = 5
+
+
+    def main(self):
+        for width, height in self.size_list:
+            self.bench(width, height)
+
+
+    def bench(self, width, height):
+        logger.info('*** Generating %d x %d frame ***', width, height)
+
+        noise = numpy.random.randint(256, size=(height, width, 3), dtype=numpy.uint8)
+        data = cv2.GaussianBlur(noise, (0, 0), 3)
+
+
+        original_s, original_data = self.timeit(self.original, data)
+        logger.info('Original LAB: %0.4f s/frame', original_s)
+
+
+        lab_contrast = IndiAllSkyContrastEnhance({'IMAGE_CLAHE_LUMINANCE' : 'lab'})
+        lab_s, lab_data = self.timeit(lab_contrast.apply, data)
+        lab_contrast.shutdown()
+
+        logger.info('Cached LAB: %0.4f s/frame', lab_s)
+        self.compare(original_data, lab_data)
+
+
+        for bands in self.band_list:
+            contrast = IndiAllSkyContrastEnhance({
+                'IMAGE_CLAHE_LUMINANCE' : 'ycrcb',
+                'IMAGE_CLAHE_BANDS'     : bands,
+            })
+
+            ycrcb_s, ycrcb_data = self.timeit(contrast.apply, data)
+            contrast.shutdown()
+
+            logger.info('YCrCb %d bands: %0.4f s/frame', bands, ycrcb_s)
+
+            if bands == 1:
+                ycrcb_single_data = ycrcb_data
+            else:
+                self.compare(ycrcb_single_data, ycrcb_data)
+
+
+    def timeit(self, func, data):
+        # warm up
+        result = func(data)
+
+        start = time.time()
+        for x in range(self.rounds):
+            result = func(data)
+
+        return (time.time() - start) / self.rounds, result
+
+
+    def compare(self, a, b):
+        diff = numpy.abs(a.astype(numpy.int16) - b.astype(numpy.int16))
+        logger.info(' Max difference: %d, pixels different: %d', int(diff.max()), int(numpy.count_nonzero(diff)))
+
+
+    def original(self, data):
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+
+        lab = cv2.cvtColor(data, cv2.COLOR_BGR2LAB)
+
+        l, a, b = cv2.split(lab)
+
+        cl = clahe.apply(l)
+
+        new_lab = cv2.merge((cl, a, b))
+
+        return cv2.cvtColor(new_lab, cv2.COLOR_LAB2BGR)
+
+
+if __name__ == "__main__":
+    logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+    b = ClaheBench()
+    b.main()
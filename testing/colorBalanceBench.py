@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Compare the original 16 to 8 bit, SCNR and white balance chain with the
+# lookup table implementation
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.scnr import IndiAllskyScnr
+from indi_allsky.colorBalance import IndiAllSkyColorBalance
+from indi_allsky.stretch import IndiAllSkyStretch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class ColorBalanceBench(object):
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    ### 4k
+    #width  = 3840
+    #height = 2160
+
+    image_bit_depth = 12
+    rounds = 10
+
+    config = {
+        'SCNR_ALGORITHM' : 'average_neutral',
+        'WBR_FACTOR'     : 1.3,
+        'WBG_FACTOR'     : 0.9,
+        'WBB_FACTOR'     : 1.1,
+        'AUTO_WB'        : True,
+    }
+
+
+    def __init__(self):
+        logger.info('*** Generating %d x %d %d bit frame ***', self.width, self.height, self.image_bit_depth)
+
+        bayer = numpy.random.randint(2 ** self.image_bit_depth, size=(self.height, self.width), dtype=numpy.uint16)
+        self.data = cv2.cvtColor(bayer, cv2.COLOR_BAYER_BG2BGR)
+
+        self._scnr = IndiAllskyScnr(self.config)
+        self._color_balance = IndiAllSkyColorBalance(self.config)
+        self._stretch = IndiAllSkyStretch(self.config)  # linear
+
+
+    def main(self):
+        start = time.time()
+        for x in range(self.rounds):
+            original_data = self.original(self.data)
+        original_s = (time.time() - start) / self.rounds
+
+        start = time.time()
+        for x in range(self.rounds):
+            lut_data = self.lut(self.data)
+        lut_s = (time.time() - start) / self.rounds
+
+
+        logger.info('Original: %0.4f s/frame, LUT: %0.4f s/frame', original_s, lut_s)
+
+        diff = numpy.abs(original_data.astype(numpy.int16) - lut_data.astype(numpy.int16))
+        logger.info('Max difference: %d, pixels different: %d', int(diff.max()), int(numpy.count_nonzero(diff)))
+
+
+    def original(self, data):
+        div_factor = int((2 ** self.image_bit_depth) / 255)
+        image = (data / div_factor).astype(numpy.uint8)
+
+        scnr_function = getattr(self._scnr, self.config['SCNR_ALGORITHM'])
+        image = scnr_function(image)
+
+
+        b, g, r = cv2.split(image)
+        wbb = cv2.multiply(b, self.config['WBB_FACTOR'])
+        wbg = cv2.multiply(g, self.config['WBG_FACTOR'])
+        wbr = cv2.multiply(r, self.config['WBR_FACTOR'])
+        image = cv2.merge([wbb, wbg, wbr])
+
+
+        b, g, r = cv2.split(image)
+        b_avg = cv2.mean(b)[0]
+        g_avg = cv2.mean(g)[0]
+        r_avg = cv2.mean(r)[0]
+
+        k = (b_avg + g_avg + r_avg) / 3
+
+        b = cv2.addWeighted(src1=b, alpha=k / b_avg, src2=0, beta=0, gamma=0)
+        g = cv2.addWeighted(src1=g, alpha=k / g_avg, src2=0, beta=0, gamma=0)
+        r = cv2.addWeighted(src1=r, alpha=k / r_avg, src2=0, beta=0, gamma=0)
+
+        return cv2.merge([b, g, r])
+
+
+    def lut(self, data):
+        image = self._stretch.apply(data, 16, self.image_bit_depth)
+
+        return self._color_balance.balance(
+            image,
+            scnr_algo=self.config['SCNR_ALGORITHM'],
+            auto_wb=self.config['AUTO_WB'],
+        )
+
+
+if __name__ == "__main__":
+    b = ColorBalanceBench()
+    b.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Compare dark frame matching with SQL queries against the in memory index
+
+import sys
+import time
+import random
+from pathlib import Path
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.flask import db
+from indi_allsky.flask.models import IndiAllSkyDbCameraTable
+from indi_allsky.flask.models import IndiAllSkyDbDarkFrameTable
+from indi_allsky.darkLibrary import IndiAllSkyDarkLibrary
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class DarkLibraryBench(object):
+
+    dark_count = 5000
+    lookup_count = 1000
+
+    dark_temperature_range = 5.0
+
+    gain_list = (0, 50, 100, 150, 200, 250)
+    bin_list = (1, 2)
+    bitdepth_list = (8, 16)
+
+
+    def __init__(self):
+        # private in memory database
+        engine = create_engine('sqlite://')
+        db.Model.metadata.create_all(engine)
+
+        self.session = Session(engine)
+
+
+    def main(self):
+        self.populate()
+
+        lookup_list = list()
+        for x in range(self.lookup_count):
+            lookup_list.append((
+                1,  # camera_id
+                random.choice(self.bitdepth_list),
+                random.choice(self.gain_list),
+                random.choice(self.bin_list),
+                random.uniform(0.0, 65.0),  # exposure
+                random.uniform(-10.0, 40.0),  # temp
+            ))
+
+
+        logger.info('*** SQL queries ***')
+        sql_start = time.time()
+
+        sql_results = [self.sqlLookup(*x) for x in lookup_list]
+
+        sql_elapsed_s = time.time() - sql_start
+        logger.info('%d lookups in %0.4f s (%0.6f s per frame)', self.lookup_count, sql_elapsed_s, sql_elapsed_s / self.lookup_count)
+
+
+        logger.info('*** Index ***')
+        library = IndiAllSkyDarkLibrary(IndiAllSkyDbDarkFrameTable)
+
+        load_start = time.time()
+        library.load(query=self.session.query(IndiAllSkyDbDarkFrameTable))
+        load_elapsed_s = time.time() - load_start
+        logger.info('Index loaded in %0.4f s', load_elapsed_s)
+
+        index_start = time.time()
+
+        index_results = [self.indexLookup(library, *x) for x in lookup_list]
+
+        index_elapsed_s = time.time() - index_start
+        logger.info('%d lookups in %0.4f s (%0.6f s per frame)', self.lookup_count, index_elapsed_s, index_elapsed_s / self.lookup_count)
+
+
+        mismatch = len([1 for a, b in zip(sql_results, index_results) if a != b])
+        logger.info('Mismatched results: %d', mismatch)
+
+
+    def populate(self):
+        logger.info('Generating %d dark frames', self.dark_count)
+
+        camera = IndiAllSkyDbCameraTable(
+            name='benchmark',
+        )
+        self.session.add(camera)
+        self.session.commit()
+
+        now = datetime.now()
+
+        for x in range(self.dark_count):
+            dark = IndiAllSkyDbDarkFrameTable(
+                camera_id=camera.id,
+                filename='/tmp/dark_{0:d}.fit'.format(x),
+                createDate=now - timedelta(minutes=x),
+                bitdepth=random.choice(self.bitdepth_list),
+                exposure=random.randint(1, 60),
+                gain=random.choice(self.gain_list),
+                binmode=random.choice(self.bin_list),
+                temp=round(random.uniform(-5.0, 35.0), 1),
+            )
+            self.session.add(dark)
+
+        self.session.commit()
+
+
+    def sqlLookup(self, camera_id, bitdepth, gain, binmode, exposure, temp):
+        dark_frame_entry = self.session.query(IndiAllSkyDbDarkFrameTable)\
+            .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
+            .filter(IndiAllSkyDbDarkFrameTable.bitdepth == bitdepth)\
+            .filter(IndiAllSkyDbDarkFrameTable.gain == gain)\
+            .filter(IndiAllSkyDbDarkFrameTable.binmode == binmode)\
+            .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
+            .filter(IndiAllSkyDbDarkFrameTable.temp >= temp)\
+            .filter(IndiAllSkyDbDarkFrameTable.temp <= (temp + self.dark_temperature_range))\
+            .order_by(
+                IndiAllSkyDbDarkFrameTable.exposure.asc(),
+                IndiAllSkyDbDarkFrameTable.temp.asc(),
+                IndiAllSkyDbDarkFrameTable.createDate.asc(),
+            )\
+            .first()
+
+        if not dark_frame_entry:
+            dark_frame_entry = self.session.query(IndiAllSkyDbDarkFrameTable)\
+                .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
+                .filter(IndiAllSkyDbDarkFrameTable.bitdepth == bitdepth)\
+                .filter(IndiAllSkyDbDarkFrameTable.gain == gain)\
+                .filter(IndiAllSkyDbDarkFrameTable.binmode == binmode)\
+                .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
+                .order_by(
+                    IndiAllSkyDbDarkFrameTable.exposure.asc(),
+                    IndiAllSkyDbDarkFrameTable.temp.desc(),
+                    IndiAllSkyDbDarkFrameTable.createDate.asc(),
+                )\
+                .first()
+
+        if not dark_frame_entry:
+            return None
+
+        return dark_frame_entry.id
+
+
+    def indexLookup(self, library, camera_id, bitdepth, gain, binmode, exposure, temp):
+        dark_frame_entry = library.find(camera_id, bitdepth, gain, binmode, exposure, temp, self.dark_temperature_range)
+
+        if not dark_frame_entry:
+            dark_frame_entry = library.findFallback(camera_id, bitdepth, gain, binmode, exposure)
+
+        if not dark_frame_entry:
+            return None
+
+        return dark_frame_entry['id']
+
+
+if __name__ == "__main__":
+    b = DarkLibraryBench()
+    b.main()
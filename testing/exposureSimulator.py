@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Replay the images of one night (or day) from the database through the
+# exposure controllers and compare how quickly they converge on the target ADU
+#
+# The sky brightness of each stored image is ADU / exposure.  The simulated
+# ADU of a frame is the sky brightness at that time multiplied by the exposure
+# chosen by the controller.
+
+import sys
+import math
+import json
+import argparse
+from pathlib import Path
+from datetime import datetime
+from collections import OrderedDict
+import logging
+
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+import indi_allsky
+
+# setup flask context for db access
+app = indi_allsky.flask.create_app()
+app.app_context().push()
+
+from indi_allsky.flask.models import IndiAllSkyDbImageTable
+from indi_allsky import exposure as exposure_controllers
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+# controllers log every frame
+logging.getLogger('indi_allsky').setLevel(logging.ERROR)
+
+
+class ExposureSimulator(object):
+
+    controller_list = ('step', 'pid', 'model')
+
+    linear_adu_min = 1.0
+    linear_adu_max = 250.0
+
+
+    def __init__(self, config, day_date, night, camera_id):
+        self.config = config
+        self.day_date = day_date
+        self.night = night
+        self.camera_id = camera_id
+
+        if not self.config.get('CCD_EXPOSURE_MIN'):
+            # normally detected from the camera
+            self.config['CCD_EXPOSURE_MIN'] = 0.0001
+
+        if not self.config.get('EXPOSURE_PERIOD_DAY'):
+            self.config['EXPOSURE_PERIOD_DAY'] = self.config['EXPOSURE_PERIOD']
+
+        self.latitude_v = FakeValue(float(self.config['LOCATION_LATITUDE']))
+        self.longitude_v = FakeValue(float(self.config['LOCATION_LONGITUDE']))
+
+
+    def main(self):
+        image_query = IndiAllSkyDbImageTable.query\
+            .filter(IndiAllSkyDbImageTable.dayDate == self.day_date)\
+            .filter(IndiAllSkyDbImageTable.night == self.night)
+
+        if self.camera_id:
+            image_query = image_query.filter(IndiAllSkyDbImageTable.camera_id == self.camera_id)
+
+        image_list = image_query.order_by(IndiAllSkyDbImageTable.createDate.asc()).all()
+
+        logger.info('Replaying %d images from %s', len(image_list), self.day_date.strftime('%Y-%m-%d'))
+
+
+        # sky brightness from the images in the linear range
+        sky_time_list = list()
+        sky_brightness_list = list()
+        for image in image_list:
+            if not (self.linear_adu_min <= image.adu <= self.linear_adu_max):
+                continue
+
+            sky_time_list.append(image.createDate.timestamp())
+            sky_brightness_list.append(math.log(image.adu / image.exposure))
+
+
+        if len(sky_time_list) < 2:
+            logger.error('Not enough images to model the sky brightness')
+            return
+
+
+        date_list = [x.createDate for x in image_list]
+        log_sky_array = numpy.interp([x.timestamp() for x in date_list], sky_time_list, sky_brightness_list)
+
+
+        target_adu = float(self.config['TARGET_ADU'])
+        adu_dev = float(self.config.get('TARGET_ADU_DEV', 10))
+
+        for classname in self.controller_list:
+            controller_class = getattr(exposure_controllers, classname)
+            controller = controller_class(self.config, self.latitude_v, self.longitude_v)
+
+            exposure = image_list[0].exposure
+
+            in_range = 0
+            changes = 0
+            streak = 0
+            max_streak = 0
+            error_list = list()
+
+            for exp_date, log_sky in zip(date_list, log_sky_array):
+                adu = min(max(math.exp(log_sky) * exposure, 0.1), 255.0)
+
+                if abs(adu - target_adu) <= adu_dev:
+                    in_range += 1
+                    streak = 0
+                else:
+                    streak += 1
+                    max_streak = max(streak, max_streak)
+
+                error_list.append(abs(math.log(adu / target_adu)))
+
+                new_exposure, adu_average = controller.calculate(exposure, adu, exp_date)
+                if not isinstance(new_exposure, type(None)):
+                    exposure = new_exposure
+                    changes += 1
+
+
+            logger.info(
+                '%-5s - in range: %0.1f%%, mean error: %0.1f%%, longest miss: %d frames, exposure changes: %d',
+                classname,
+                100 * in_range / len(date_list),
+                100 * (math.exp(numpy.mean(error_list)) - 1),
+                max_streak,
+                changes,
+            )
+
+
+class FakeValue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--config',
+        '-c',
+        help='config file',
+        type=argparse.FileType('r'),
+        default='/etc/indi-allsky/config.json',
+    )
+    argparser.add_argument(
+        '--date',
+        '-d',
+        help='day date (YYYY-MM-DD)',
+        type=str,
+        required=True,
+    )
+    argparser.add_argument(
+        '--day',
+        help='replay the day instead of the night',
+        dest='night',
+        action='store_false',
+    )
+    argparser.add_argument(
+        '--cameraId',
+        '-C',
+        help='camera id (0 == all)',
+        type=int,
+        default=0,
+    )
+
+    args = argparser.parse_args()
+
+    config = json.loads(args.config.read(), object_pairs_hook=OrderedDict)
+    day_date = datetime.strptime(args.date, '%Y-%m-%d').date()
+
+    s = ExposureSimulator(config, day_date, args.night, args.cameraId)
+    s.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Compare the full frame Hough meteor detection with the frame difference
+# detection on a synthetic night sequence with a static edge, flickering
+# branches and a meteor
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.detectLines import IndiAllskyDetectLines
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class MeteorDetectBench(object):
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    frame_count = 12
+    meteor_frame = 8
+
+    star_count = 3000
+
+    config = {
+        'IMAGE_FOLDER'           : '/tmp',
+        'DETECT_METEORS_HISTORY' : 5,
+    }
+
+    method_list = ('hough', 'difference')
+
+
+    class bin_v(object):
+        value = 1
+
+
+    def main(self):
+        frame_list = self.generate()
+
+        # detect in the whole frame
+        mask = numpy.full((self.height, self.width), 255, dtype=numpy.uint8)
+
+        for method in self.method_list:
+            method_config = dict(self.config)
+            method_config['DETECT_METEORS_METHOD'] = method
+            detect = IndiAllskyDetectLines(method_config, self.bin_v, mask=mask)
+
+            elapsed_list = list()
+            detected_list = list()
+            for frame in frame_list:
+                start = time.time()
+                lines = detect.detectLines(frame)
+                elapsed_list.append(time.time() - start)
+
+                detected_list.append(len(lines))
+
+
+            logger.info(
+                '%s: %0.4f s/frame, lines per frame %s (meteor in frame %d)',
+                method,
+                sum(elapsed_list) / len(elapsed_list),
+                detected_list,
+                self.meteor_frame,
+            )
+
+
+    def generate(self):
+        numpy.random.seed(1)
+
+        x = numpy.random.uniform(0, self.width, self.star_count)
+        y = numpy.random.uniform(0, self.height, self.star_count)
+        peak = numpy.random.uniform(20, 150, self.star_count)
+
+        # milky way band, the edges are found by canny
+        yy, xx = numpy.mgrid[0:self.height, 0:self.width]
+        band = 25 * (numpy.abs((yy - (0.5 * xx)) - 100) < 150)
+
+        frame_list = list()
+        for f in range(self.frame_count):
+            data = numpy.random.normal(20, 2, (self.height, self.width)).astype(numpy.float32)
+            data += band
+
+            # sky rotation
+            angle = numpy.radians(0.25 * f)
+            cx = self.width / 2
+            cy = self.height / 2
+            sx = cx + ((x - cx) * numpy.cos(angle)) - ((y - cy) * numpy.sin(angle))
+            sy = cy + ((x - cx) * numpy.sin(angle)) + ((y - cy) * numpy.cos(angle))
+
+            for px, py, pk in zip(sx, sy, peak):
+                ix = int(px)
+                iy = int(py)
+                if ix < 2 or iy < 2 or ix > self.width - 3 or iy > self.height - 3:
+                    continue
+
+                data[iy - 1:iy + 2, ix - 1:ix + 2] += pk * 0.3
+                data[iy, ix] += pk * 0.7
+
+
+            # branches that flicker in the wind
+            for i in range(3):
+                wiggle = numpy.random.randint(-1, 2)
+                cv2.line(data, (100 + (i * 40), 1080), (300 + (i * 60) + wiggle, 700), 120 + (30 * (f % 2)), 3)
+
+
+            if f == self.meteor_frame:
+                cv2.line(data, (1200, 200), (1500, 380), 90, 2)
+
+
+            data = numpy.clip(data, 0, 255).astype(numpy.uint8)
+            frame_list.append(cv2.cvtColor(data, cv2.COLOR_GRAY2BGR))
+
+
+        return frame_list
+
+
+if __name__ == "__main__":
+    logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+    b = MeteorDetectBench()
+    b.main()
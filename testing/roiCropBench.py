@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Compare the region of interest crop with the baseline full frame crop for
+# each rotation, flip and detection combination
+
+import sys
+import time
+import itertools
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.image import ImageProcessor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class RoiCropBench(object):
+
+    width  = 3096
+    height = 2080
+
+    crop_roi = [401, 203, 2500, 1701]  # odd offsets to check the bayer phase
+
+    rotate_list = (None, 'ROTATE_90_CLOCKWISE', 'ROTATE_90_COUNTERCLOCKWISE', 'ROTATE_180')
+
+
+    def main(self):
+        numpy.random.seed(1)
+        noise = numpy.random.randint(4096, size=(self.height, self.width), dtype=numpy.uint16)
+        data = cv2.GaussianBlur(noise, (0, 0), 2)
+
+        failures = 0
+        roi_total_s = 0.0
+        full_total_s = 0.0
+
+        for rotate, flip_v, flip_h, detect_stars, detect_draw in itertools.product(self.rotate_list, (False, True), (False, True), (False, True), (False, True)):
+            config = {
+                'IMAGE_CROP_ROI'  : self.crop_roi,
+                'IMAGE_ROTATE'    : rotate,
+                'IMAGE_FLIP_V'    : flip_v,
+                'IMAGE_FLIP_H'    : flip_h,
+                'DETECT_STARS'    : detect_stars,
+                'DETECT_DRAW'     : detect_draw,
+                'DETECT_METEORS'  : False,
+            }
+
+            full_config = dict(config)
+            full_config['IMAGE_ROI_PROCESSING'] = False
+
+            full_s, full_image = self.process(full_config, data)
+            roi_s, roi_image = self.process(config, data)
+
+            full_total_s += full_s
+            roi_total_s += roi_s
+
+            if full_image.shape != roi_image.shape or numpy.any(full_image != roi_image):
+                failures += 1
+                logger.error(
+                    'Mismatch rotate %s, flip v %s, flip h %s, stars %s, draw %s: %s vs %s',
+                    rotate,
+                    flip_v,
+                    flip_h,
+                    detect_stars,
+                    detect_draw,
+                    str(roi_image.shape),
+                    str(full_image.shape),
+                )
+
+
+        logger.info('Full frame: %0.4f s, region of interest: %0.4f s', full_total_s, roi_total_s)
+        logger.info('%d mismatches', failures)
+
+
+    def process(self, config, data):
+        # the geometry steps of ImageWorker.processImage() at night
+        image_processor = ImageProcessor.__new__(ImageProcessor)
+        image_processor.config = config
+        image_processor.focus_mode = False
+        image_processor._detection_mask = None
+        image_processor._roi = None
+        image_processor._roi_key = None
+        image_processor._roi_state = None
+        image_processor.image_list = [{'image_bayerpat' : 'RGGB', 'night' : True, 'bin' : 1}]
+
+        start = time.time()
+
+        image_processor.image = data
+        image_processor.roi_crop()
+        image_processor.debayer()
+
+        if config['IMAGE_ROTATE']:
+            image_processor.rotate(getattr(cv2, config['IMAGE_ROTATE']))
+
+        if config['IMAGE_FLIP_V']:
+            image_processor.flip(0)
+
+        if config['IMAGE_FLIP_H']:
+            image_processor.flip(1)
+
+        if config['DETECT_STARS']:
+            image_processor.roi_expand()
+        elif config['DETECT_DRAW']:
+            image_processor.roi_expand()
+
+        image_processor.crop_image()
+        image_processor.roi_reduce()
+        image_processor.roi_composite()
+
+        return time.time() - start, image_processor.image
+
+
+if __name__ == "__main__":
+    logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+    b = RoiCropBench()
+    b.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Compare the folded maximum stack with the rolling maximum stack
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.image import ImageStacker
+from indi_allsky.image import ImageStackRollingExtremum
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StackRollingBench(object):
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    ### 4k
+    #width  = 3840
+    #height = 2160
+
+    stack_count_list = (2, 3, 5, 10, 15, 20, 30)
+    frames = 60
+
+
+    def __init__(self):
+        logger.info('*** Generating %d random %d x %d frames ***', self.frames, self.width, self.height)
+
+        self.frame_list = list()
+        for x in range(self.frames):
+            data = numpy.random.randint(((2 ** 16) - 1), size=(self.height, self.width), dtype=numpy.uint16)
+            self.frame_list.append({'hdulist' : [FakeHdu(data)]})
+
+
+    def main(self):
+        for stack_count in self.stack_count_list:
+            fold_s = self.fold(stack_count)
+            rolling_s = self.rolling(stack_count)
+
+            logger.info(
+                'Stack %2d - fold: %0.4f s/frame, rolling: %0.4f s/frame',
+                stack_count,
+                fold_s,
+                rolling_s,
+            )
+
+
+    def fold(self, stack_count):
+        stacker = ImageStacker()
+
+        image_list = list()
+
+        start = time.time()
+
+        for i_ref in self.frame_list:
+            if len(image_list) == stack_count:
+                image_list.pop()
+
+            image_list.insert(0, i_ref)
+
+            stacker.maximum([x['hdulist'][0].data for x in image_list], numpy.uint16)
+
+        return (time.time() - start) / self.frames
+
+
+    def rolling(self, stack_count):
+        stacker = ImageStackRollingExtremum(numpy.maximum)
+
+        image_list = list()
+
+        start = time.time()
+
+        for i_ref in self.frame_list:
+            if len(image_list) == stack_count:
+                stacker.remove(image_list.pop())
+
+            image_list.insert(0, i_ref)
+
+            stacker.sync(image_list)
+            stacker.result(numpy.uint16)
+
+        return (time.time() - start) / self.frames
+
+
+class FakeHdu(object):
+    def __init__(self, data):
+        self.data = data
+
+
+if __name__ == "__main__":
+    b = StackRollingBench()
+    b.main()
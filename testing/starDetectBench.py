@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Compare the star detection engines with the original de-duplication
+
+import sys
+import argparse
+import time
+from pathlib import Path
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stars import IndiAllSkyStars
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StarDetectBench(object):
+
+    config = {
+        'IMAGE_FOLDER'          : '/tmp',
+        'DETECT_STARS_THOLD'    : 0.6,
+        'DETECT_STARS_SUBPIXEL' : True,
+    }
+
+    method_list = ('legacy', 'peaks', 'extract')
+
+    match_distance = 3  # pixels
+
+
+    class bin_v(object):
+        value = 1
+
+
+    def main(self, image_list, threshold):
+        self.config['DETECT_STARS_THOLD'] = threshold
+
+        for image in image_list:
+            self.bench(image)
+
+
+    def bench(self, image):
+        data = cv2.imread(str(image), cv2.IMREAD_UNCHANGED)
+        if isinstance(data, type(None)):
+            logger.error('%s is not a valid image', image)
+            return
+
+        image_height, image_width = data.shape[:2]
+        logger.info('*** %s: %d x %d ***', image, image_width, image_height)
+
+        # detect in the whole frame
+        mask = numpy.full((image_height, image_width), 255, dtype=numpy.uint8)
+
+
+        blobs_dict = dict()
+        for method in self.method_list:
+            method_config = dict(self.config)
+            method_config['DETECT_STARS_METHOD'] = method
+            stars = IndiAllSkyStars(method_config, self.bin_v, mask=mask)
+
+            start = time.time()
+            blobs_dict[method] = stars.detectObjects(data)
+            method_s = time.time() - start
+
+            if blobs_dict[method]:
+                fwhm = numpy.median(numpy.array(blobs_dict[method])[:, 3])
+            else:
+                fwhm = 0.0
+
+            logger.info('%s: %d stars in %0.4f s, median FWHM %0.2f px', method, len(blobs_dict[method]), method_s, fwhm)
+
+
+        legacy_blobs = blobs_dict['legacy']
+        if not legacy_blobs:
+            return
+
+        legacy_xy = numpy.array(legacy_blobs)[:, :2]
+
+        for method in self.method_list[1:]:
+            if not blobs_dict[method]:
+                continue
+
+            method_xy = numpy.array(blobs_dict[method])[:, :2]
+
+            # nearest detection for each legacy star
+            dist = numpy.sqrt(((legacy_xy[:, None, :] - method_xy[None, :, :]) ** 2).sum(axis=2))
+            nearest = dist.min(axis=1)
+
+            matched = nearest <= self.match_distance
+            logger.info(
+                '%s matched: %d of %d legacy stars within %d px, mean offset %0.2f px',
+                method,
+                numpy.count_nonzero(matched),
+                len(legacy_blobs),
+                self.match_distance,
+                float(nearest[matched].mean()) if numpy.any(matched) else 0.0,
+            )
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        'images',
+        help='Input images',
+        type=str,
+        nargs='+',
+    )
+    argparser.add_argument(
+        '--threshold',
+        '-t',
+        help='detection threshold [default: 0.6]',
+        type=float,
+        default=0.6,
+    )
+
+    args = argparser.parse_args()
+
+    logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+    b = StarDetectBench()
+    b.main(args.images, args.threshold)
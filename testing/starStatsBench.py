@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Time the per star photometry and per frame star statistics
+
+import sys
+import time
+from pathlib import Path
+import logging
+
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stars import IndiAllSkyStars
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class StarStatsBench(object):
+
+    ### 1k
+    width  = 1920
+    height = 1080
+
+    star_count_list = (100, 500, 2000, 5000)
+
+    star_sigma = 1.2  # pixels, FWHM 2.8
+    exposure = 15.0
+
+    rounds = 10
+
+    config = {
+        'IMAGE_FOLDER' : '/tmp',
+    }
+
+
+    class bin_v(object):
+        value = 1
+
+
+    def main(self):
+        stars = IndiAllSkyStars(self.config, self.bin_v)
+
+        for star_count in self.star_count_list:
+            data, x, y = self.generate(star_count)
+
+            start = time.time()
+            for r in range(self.rounds):
+                blob_list = stars._measure(data, x, y)
+            measure_s = (time.time() - start) / self.rounds
+
+            start = time.time()
+            for r in range(self.rounds):
+                star_stats = stars.statistics(blob_list, self.exposure)
+            stats_s = (time.time() - start) / self.rounds
+
+            logger.info(
+                '%d stars: photometry %0.4f s, statistics %0.4f s, FWHM %0.2f (expected %0.2f), ellipticity %0.3f, limiting mag %0.2f',
+                star_count,
+                measure_s,
+                stats_s,
+                star_stats['fwhm'],
+                2.3548 * self.star_sigma,
+                star_stats['ellipticity'],
+                star_stats['limiting_mag'],
+            )
+
+
+    def generate(self, star_count):
+        data = numpy.random.normal(20, 2, (self.height, self.width)).astype(numpy.float32)
+
+        x = numpy.random.uniform(10, self.width - 10, star_count)
+        y = numpy.random.uniform(10, self.height - 10, star_count)
+        peak = numpy.random.uniform(20, 200, star_count)
+
+        offsets = numpy.arange(-6, 7)
+        for sx, sy, sp in zip(x, y, peak):
+            ix = int(sx)
+            iy = int(sy)
+
+            gx = numpy.exp(-((offsets + ix - sx) ** 2) / (2 * self.star_sigma ** 2))
+            gy = numpy.exp(-((offsets + iy - sy) ** 2) / (2 * self.star_sigma ** 2))
+
+            data[iy - 6:iy + 7, ix - 6:ix + 7] += sp * numpy.outer(gy, gx)
+
+
+        return numpy.clip(data, 0, 255).astype(numpy.uint8), x, y
+
+
+if __name__ == "__main__":
+    logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+    b = StarStatsBench()
+    b.main()